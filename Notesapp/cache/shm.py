@@ -0,0 +1,301 @@
+"""Shared-memory cache backend for small, hot values.
+
+Entries live in a fixed-size hash table in a memory-mapped file, so
+every worker process on a host shares them without a network or
+database round trip. A table-wide flock makes each operation atomic
+across processes; incr and add in particular never lose updates.
+
+Meant for rate-limit counters (see RATELIMIT_USE_CACHE and
+common.ratelimit, which counts with add and incr), not general
+caching: integers are stored natively and other values are pickled,
+but pickles must fit in VALUE_SIZE bytes. When the probe window of a
+key is full, the entry closest to expiring is evicted.
+
+Settings:
+    LOCATION: path of the table file; a tmpfs path such as /dev/shm
+        keeps it out of disk writeback.
+    OPTIONS['SLOTS']: number of entries in the table.
+"""
+
+from django.core.cache.backends.base import BaseCache, DEFAULT_TIMEOUT
+import fcntl
+import hashlib
+import mmap
+import os
+import pickle
+import struct
+import threading
+import time
+
+# Table layout: header, then SLOTS fixed-size slots
+HEADER = struct.Struct('<8sQ')
+MAGIC = b'SHMCACH1'
+VALUE_SIZE = 40 # Bytes available to pickled values
+# Slot: key digest, expiry (0 for never), kind, pickle length, int, pickle
+SLOT = struct.Struct('<16sdBHq%ds' % VALUE_SIZE)
+KIND_EMPTY = 0
+KIND_INT = 1
+KIND_PICKLE = 2
+KIND_DELETED = 3
+PROBE_LIMIT = 16 # Slots searched for a key before evicting
+DEFAULT_SLOTS = 65536
+
+
+class SharedMemoryCache(BaseCache):
+    """Cache backend storing entries in a shared memory-mapped table."""
+
+    def __init__(self, location, params):
+        super(SharedMemoryCache, self).__init__(params)
+
+        options = params.get('OPTIONS', {})
+
+        self.path = location
+        self.slots = int(options.get('SLOTS', DEFAULT_SLOTS))
+        self._pid = None
+        self._file = None
+        self._map = None
+        self._lock = threading.Lock()
+
+    def _open(self):
+        """Maps the table file, creating it if needed.
+
+        Reopened after fork, since flock locks are shared by processes
+        holding the same open file.
+        """
+
+        if self._pid == os.getpid():
+            return
+
+        descriptor = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        size = HEADER.size + SLOT.size * self.slots
+
+        fcntl.flock(descriptor, fcntl.LOCK_EX)
+
+        try:
+            if os.fstat(descriptor).st_size != size:
+                os.ftruncate(descriptor, 0)
+                os.ftruncate(descriptor, size)
+
+            mapped = mmap.mmap(descriptor, size)
+
+            if HEADER.unpack_from(mapped) != (MAGIC, self.slots):
+                mapped[:] = bytes(size)
+                HEADER.pack_into(mapped, 0, MAGIC, self.slots)
+        finally:
+            fcntl.flock(descriptor, fcntl.LOCK_UN)
+
+        self._file = descriptor
+        self._map = mapped
+        self._pid = os.getpid()
+
+    def _locked(self):
+        """Returns context manager holding the table lock."""
+
+        with self._lock:
+            self._open()
+
+        return _TableLock(self)
+
+    def _digest(self, key, version):
+        """Returns 16-byte digest of the full cache key."""
+
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+
+        # Never all zeroes, so empty slots can't match
+        return hashlib.md5(key.encode('utf-8')).digest()[:15] + b'\x01'
+
+    def _offset(self, index):
+        return HEADER.size + SLOT.size * index
+
+    def _find(self, digest, now):
+        """Finds slot for digest. Must be called with the lock held.
+
+        Returns:
+            Tuple of slot offset holding the live key or None, and
+            offset of the best slot to write a new entry to.
+        """
+
+        start = int.from_bytes(digest[:8], 'little') % self.slots
+        free = None
+        oldest = None
+        oldest_expiry = None
+
+        for step in range(PROBE_LIMIT):
+            offset = self._offset((start + step) % self.slots)
+            slot_digest, expiry, kind = SLOT.unpack_from(self._map,
+                                                         offset)[:3]
+
+            if kind == KIND_EMPTY:
+                return None, free if free is not None else offset
+
+            expired = expiry and expiry <= now
+
+            if slot_digest == digest and kind != KIND_DELETED:
+                if not expired:
+                    return offset, offset
+
+                if free is None:
+                    free = offset
+            elif free is None and (kind == KIND_DELETED or expired):
+                free = offset
+
+            # Entries that never expire are evicted last
+            rank = expiry or float('inf')
+
+            if oldest is None or rank < oldest_expiry:
+                oldest, oldest_expiry = offset, rank
+
+        return None, free if free is not None else oldest
+
+    def _read(self, offset):
+        """Returns value stored in slot at offset."""
+
+        kind, length, number, payload = SLOT.unpack_from(self._map,
+                                                         offset)[2:]
+
+        if kind == KIND_INT:
+            return number
+
+        return pickle.loads(payload[:length])
+
+    def _write(self, offset, digest, value, expiry):
+        """Stores value in slot at offset."""
+
+        if type(value) is int and -2 ** 63 <= value < 2 ** 63:
+            SLOT.pack_into(self._map, offset, digest, expiry, KIND_INT, 0,
+                           value, b'')
+            return
+
+        payload = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+        if len(payload) > VALUE_SIZE:
+            raise ValueError('Value too large for shared memory cache.')
+
+        SLOT.pack_into(self._map, offset, digest, expiry, KIND_PICKLE,
+                       len(payload), 0, payload)
+
+    def _expiry(self, timeout):
+        """Returns stored expiry for timeout; 0 means never."""
+
+        if timeout == DEFAULT_TIMEOUT:
+            timeout = self.default_timeout
+
+        if timeout is None:
+            return 0
+
+        return time.time() + timeout
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        digest = self._digest(key, version)
+
+        with self._locked():
+            found, offset = self._find(digest, time.time())
+
+            if found is not None:
+                return False
+
+            self._write(offset, digest, value, self._expiry(timeout))
+
+        return True
+
+    def get(self, key, default=None, version=None):
+        digest = self._digest(key, version)
+
+        with self._locked():
+            found = self._find(digest, time.time())[0]
+
+            if found is None:
+                return default
+
+            return self._read(found)
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        digest = self._digest(key, version)
+
+        with self._locked():
+            offset = self._find(digest, time.time())[1]
+            self._write(offset, digest, value, self._expiry(timeout))
+
+    def delete(self, key, version=None):
+        digest = self._digest(key, version)
+
+        with self._locked():
+            found = self._find(digest, time.time())[0]
+
+            if found is not None:
+                SLOT.pack_into(self._map, found, digest, 0, KIND_DELETED, 0,
+                               0, b'')
+
+    def has_key(self, key, version=None):
+        digest = self._digest(key, version)
+
+        with self._locked():
+            return self._find(digest, time.time())[0] is not None
+
+    def incr(self, key, delta=1, version=None):
+        """Increments value atomically, keeping its expiry.
+
+        Raises:
+            ValueError: if key does not exist.
+        """
+
+        digest = self._digest(key, version)
+
+        with self._locked():
+            found = self._find(digest, time.time())[0]
+
+            if found is None:
+                raise ValueError("Key '%s' not found" % key)
+
+            value = self._read(found) + delta
+            expiry = SLOT.unpack_from(self._map, found)[1]
+            self._write(found, digest, value, expiry)
+
+        return value
+
+    def get_many(self, keys, version=None):
+        digests = [(key, self._digest(key, version)) for key in keys]
+        values = {}
+
+        with self._locked():
+            now = time.time()
+
+            for key, digest in digests:
+                found = self._find(digest, now)[0]
+
+                if found is not None:
+                    values[key] = self._read(found)
+
+        return values
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        digests = [(self._digest(key, version), value)
+                   for key, value in data.items()]
+        expiry = self._expiry(timeout)
+
+        with self._locked():
+            now = time.time()
+
+            for digest, value in digests:
+                offset = self._find(digest, now)[1]
+                self._write(offset, digest, value, expiry)
+
+    def clear(self):
+        with self._locked():
+            self._map[HEADER.size:] = bytes(SLOT.size * self.slots)
+
+
+class _TableLock(object):
+    """Holds the thread lock and the table flock of a cache."""
+
+    def __init__(self, cache):
+        self.cache = cache
+
+    def __enter__(self):
+        self.cache._lock.acquire()
+        fcntl.flock(self.cache._file, fcntl.LOCK_EX)
+
+    def __exit__(self, *exc_info):
+        fcntl.flock(self.cache._file, fcntl.LOCK_UN)
+        self.cache._lock.release()
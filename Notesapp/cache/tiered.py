@@ -0,0 +1,359 @@
+"""Two-tier cache backend: a local LRU in front of a shared cache.
+
+Reads are served from a bounded in-process LRU when possible and fall
+through to the shared cache otherwise, so hot keys cost no round trip.
+Local copies are trusted for at most LOCAL_TIMEOUT seconds, which
+bounds how stale a value changed by another process may be; writes,
+deletes, add and incr always go to the shared cache first.
+
+get_or_set() adds stampede protection. Values it stores are refreshed
+early: once a value passes its timeout, one worker takes a lock key in
+the shared cache and recomputes it while the rest keep being served the
+old value for up to GRACE_TIME more seconds.
+
+get_local(), set_local() and delete_local() use the local tier alone,
+for values whose source of truth is not the shared cache; sessions are
+cached this way, see Notesapp.sessions.
+
+Settings:
+    LOCATION: alias of the shared cache in CACHES.
+    OPTIONS['LOCAL_ENTRIES']: entries kept in the local LRU.
+    OPTIONS['LOCAL_TIMEOUT']: seconds local copies are trusted.
+    OPTIONS['GRACE_TIME']: seconds stale values are served by
+        get_or_set while one worker recomputes them.
+"""
+
+from collections import OrderedDict, namedtuple
+from django.core.cache import get_cache
+from django.core.cache.backends.base import BaseCache, DEFAULT_TIMEOUT
+import threading
+import time
+
+DEFAULT_LOCAL_ENTRIES = 1000
+DEFAULT_LOCAL_TIMEOUT = 5
+DEFAULT_GRACE_TIME = 30
+LOCK_WAIT = 0.05 # Seconds between checks while another worker computes
+LOCK_POLLS = 20 # Checks before computing the value anyway
+
+# Value stored by get_or_set, with the time it should be recomputed
+Refreshing = namedtuple('Refreshing', ('value', 'refresh'))
+
+_missing = object()
+
+
+class TieredCache(BaseCache):
+    """Cache backend with a local LRU over a shared cache alias."""
+
+    def __init__(self, location, params):
+        super(TieredCache, self).__init__(params)
+
+        options = params.get('OPTIONS', {})
+
+        self.shared_alias = location
+        self.local_entries = int(options.get('LOCAL_ENTRIES',
+                                             DEFAULT_LOCAL_ENTRIES))
+        self.local_timeout = options.get('LOCAL_TIMEOUT',
+                                         DEFAULT_LOCAL_TIMEOUT)
+        self.grace_time = options.get('GRACE_TIME', DEFAULT_GRACE_TIME)
+        self._shared = None
+        self._local = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = dict.fromkeys(('local_hits', 'shared_hits', 'misses',
+                                     'evictions', 'lock_waits',
+                                     'recomputes'), 0)
+
+    @property
+    def shared(self):
+        """Shared cache, resolved on first use."""
+
+        if self._shared is None:
+            self._shared = get_cache(self.shared_alias)
+
+        return self._shared
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self._stats[name] += amount
+
+    def stats(self):
+        """Returns dict of this process's counters and local size."""
+
+        with self._lock:
+            stats = dict(self._stats)
+            stats['local_size'] = len(self._local)
+
+        return stats
+
+    # Local tier
+
+    def _local_get(self, key):
+        """Returns unexpired local copy of key, or _missing."""
+
+        with self._lock:
+            entry = self._local.get(key)
+
+            if entry is None:
+                return _missing
+
+            value, expiry = entry
+
+            if expiry <= time.time():
+                del self._local[key]
+                return _missing
+
+            self._local.move_to_end(key)
+
+            return value
+
+    def _backend_expiry(self, timeout):
+        """Returns epoch seconds timeout ends at, or None for never."""
+
+        if timeout == DEFAULT_TIMEOUT:
+            timeout = self.default_timeout
+
+        if timeout is None:
+            return None
+
+        return time.time() + timeout
+
+    def _local_set(self, key, value, timeout=DEFAULT_TIMEOUT):
+        """Stores local copy for at most LOCAL_TIMEOUT seconds."""
+
+        expiry = time.time() + self.local_timeout
+        backend_timeout = self._backend_expiry(timeout)
+
+        if backend_timeout is not None:
+            expiry = min(expiry, backend_timeout)
+
+        with self._lock:
+            self._local[key] = (value, expiry)
+            self._local.move_to_end(key)
+
+            while len(self._local) > self.local_entries:
+                self._local.popitem(last=False)
+                self._stats['evictions'] += 1
+
+    def _local_delete(self, key):
+        with self._lock:
+            self._local.pop(key, None)
+
+    # Cache API; keys are versioned by the shared cache
+
+    def _local_key(self, key, version):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+
+        return key
+
+    def get(self, key, default=None, version=None):
+        value = self._get(key, version)
+
+        if value is _missing:
+            return default
+
+        if isinstance(value, Refreshing):
+            return value.value
+
+        return value
+
+    def _get(self, key, version):
+        """Returns raw stored value of key from either tier, or _missing."""
+
+        local_key = self._local_key(key, version)
+        value = self._local_get(local_key)
+
+        if value is not _missing:
+            self._count('local_hits')
+            return value
+
+        value = self.shared.get(key, _missing, version=version)
+
+        if value is _missing:
+            self._count('misses')
+            return value
+
+        self._count('shared_hits')
+        self._local_set(local_key, value)
+
+        return value
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        self.shared.set(key, value, timeout, version=version)
+        self._local_set(self._local_key(key, version), value, timeout)
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        added = self.shared.add(key, value, timeout, version=version)
+
+        if added:
+            self._local_set(self._local_key(key, version), value, timeout)
+
+        return added
+
+    def delete(self, key, version=None):
+        self.shared.delete(key, version=version)
+        self._local_delete(self._local_key(key, version))
+
+    def incr(self, key, delta=1, version=None):
+        value = self.shared.incr(key, delta, version=version)
+        self._local_delete(self._local_key(key, version))
+
+        return value
+
+    def has_key(self, key, version=None):
+        return self._get(key, version) is not _missing
+
+    def get_many(self, keys, version=None):
+        found = {}
+        remaining = []
+
+        for key in keys:
+            value = self._local_get(self._local_key(key, version))
+
+            if value is _missing:
+                remaining.append(key)
+            else:
+                found[key] = value
+
+        self._count('local_hits', len(found))
+
+        if remaining:
+            shared = self.shared.get_many(remaining, version=version)
+
+            self._count('shared_hits', len(shared))
+            self._count('misses', len(remaining) - len(shared))
+
+            for key, value in shared.items():
+                self._local_set(self._local_key(key, version), value)
+
+            found.update(shared)
+
+        return dict((key, value.value if isinstance(value, Refreshing)
+                     else value) for key, value in found.items())
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        self.shared.set_many(data, timeout, version=version)
+
+        for key, value in data.items():
+            self._local_set(self._local_key(key, version), value, timeout)
+
+    def delete_many(self, keys, version=None):
+        self.shared.delete_many(keys, version=version)
+
+        for key in keys:
+            self._local_delete(self._local_key(key, version))
+
+    def clear(self):
+        self.shared.clear()
+
+        with self._lock:
+            self._local.clear()
+
+    # Local tier only, for values whose source of truth is elsewhere
+
+    def get_local(self, key, default=None, version=None):
+        """Returns this process's copy of key, skipping the shared tier."""
+
+        value = self._local_get(self._local_key(key, version))
+
+        if value is _missing:
+            self._count('misses')
+            return default
+
+        self._count('local_hits')
+
+        return value
+
+    def set_local(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        """Stores a copy of key in this process only."""
+
+        self._local_set(self._local_key(key, version), value, timeout)
+
+    def delete_local(self, key, version=None):
+        """Drops this process's copy of key."""
+
+        self._local_delete(self._local_key(key, version))
+
+    def clear_local(self):
+        """Drops every local copy, leaving the shared cache alone."""
+
+        with self._lock:
+            self._local.clear()
+
+    # Stampede protection
+
+    def get_or_set(self, key, compute, timeout=DEFAULT_TIMEOUT,
+                   version=None):
+        """Returns cached value of key, computing it in one worker only.
+
+        Args:
+            key: cache key.
+            compute: function taking no arguments that returns the value.
+            timeout: seconds before the value is recomputed; stale values
+                are still served for GRACE_TIME seconds while one worker
+                recomputes them.
+            version: cache key version.
+
+        Returns:
+            Cached or freshly computed value.
+        """
+
+        stored = self._get(key, version)
+
+        if isinstance(stored, Refreshing):
+            if stored.refresh > time.time():
+                return stored.value
+
+            # Stale: only the lock holder recomputes, the rest serve it
+            if not self._acquire(key, version):
+                return stored.value
+
+            return self._compute(key, compute, timeout, version)
+
+        if stored is not _missing:
+            return stored
+
+        # Missing: wait for another worker's result rather than stampede
+        for each in range(LOCK_POLLS):
+            if self._acquire(key, version):
+                return self._compute(key, compute, timeout, version)
+
+            self._count('lock_waits')
+            time.sleep(LOCK_WAIT)
+
+            stored = self.shared.get(key, _missing, version=version)
+
+            if stored is not _missing:
+                return stored.value if isinstance(stored, Refreshing) \
+                    else stored
+
+        return self._compute(key, compute, timeout, version, locked=False)
+
+    def _lock_key(self, key):
+        return 'single-flight:%s' % key
+
+    def _acquire(self, key, version):
+        """Takes the recompute lock for key in the shared cache."""
+
+        return self.shared.add(self._lock_key(key), 1, self.grace_time,
+                               version=version)
+
+    def _compute(self, key, compute, timeout, version, locked=True):
+        """Computes and stores value, releasing the lock if held."""
+
+        try:
+            value = compute()
+            self._count('recomputes')
+
+            backend_timeout = self._backend_expiry(timeout)
+            refresh = float('inf') if backend_timeout is None \
+                else backend_timeout
+            stored_timeout = None if backend_timeout is None \
+                else max(backend_timeout - time.time(), 0) + self.grace_time
+
+            self.set(key, Refreshing(value, refresh), stored_timeout,
+                     version=version)
+        finally:
+            if locked:
+                self.shared.delete(self._lock_key(key), version=version)
+
+        return value
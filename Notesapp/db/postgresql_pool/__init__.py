@@ -0,0 +1 @@
+"""PostgreSQL backend with per-alias connection pools."""
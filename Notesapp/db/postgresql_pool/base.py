@@ -0,0 +1,400 @@
+"""PostgreSQL backend that reuses connections through per-alias pools.
+
+Django opens a connection per alias per request and closes it when the
+request finishes. With this backend, closing returns the connection to
+a pool kept per alias and database, and the next request checks it out
+again instead of connecting. Each pool holds at most SIZE connections
+per process; checkouts past that wait up to TIMEOUT seconds for one to
+be returned, then fail with OperationalError.
+
+Checked out connections are health checked: broken connections are
+discarded, and connections idle longer than CHECK_IDLE seconds must
+answer SELECT 1 first. Connections returned mid-transaction are rolled
+back; connections returned after database errors must answer SELECT 1
+to go back in the pool. A discarded connection's slot stays reserved
+for the checkout that replaces it.
+
+Pools are configured with a POOL dict in each DATABASES entry:
+    SIZE: connections per process; default 4.
+    TIMEOUT: seconds to wait for a free connection; default 5.
+    CHECK_IDLE: idle seconds before checkout pings; default 30.
+
+Pool usage is available from pools.snapshot() and is exported through
+Notesapp.metrics, labelled by alias:
+    notesapp_db_pool_<name>_total: checkouts, opened, reused, discarded,
+        waits and timeouts counters.
+    notesapp_db_pool_wait_seconds_total: time checkouts spent waiting.
+    notesapp_db_pool_connections: size, open, in_use and idle gauges,
+        labelled by state.
+    notesapp_db_pool_max_wait_seconds, notesapp_db_pool_peak and
+        notesapp_db_pool_utilization: largest over workers.
+"""
+
+from django.db.backends.postgresql_psycopg2.base import DatabaseWrapper as \
+    PostgresWrapper
+from django.db.backends.postgresql_psycopg2.creation import \
+    DatabaseCreation as PostgresCreation
+import logging
+import os
+import threading
+import time
+import psycopg2 as Database
+import psycopg2.extensions
+
+from Notesapp import metrics
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SIZE = 4
+DEFAULT_TIMEOUT = 5
+DEFAULT_CHECK_IDLE = 30
+POOL_COUNTERS = ('checkouts', 'opened', 'reused', 'discarded', 'waits',
+                 'timeouts')
+POOL_STATES = ('size', 'open', 'in_use', 'idle')
+
+
+class ConnectionPool(object):
+    """Bounded pool of psycopg2 connections to one database.
+
+    Attributes:
+        size: most connections open at once.
+        timeout: seconds checkout waits for a free connection.
+        check_idle: idle seconds after which checkout pings.
+    """
+
+    def __init__(self, size, timeout, check_idle):
+        self.size = size
+        self.timeout = timeout
+        self.check_idle = check_idle
+        self.condition = threading.Condition()
+        self.idle = [] # (connection, time returned), most recent last
+        self.open = 0
+        self.in_use = 0
+        self.stats = dict.fromkeys(('checkouts', 'opened', 'reused',
+                                    'discarded', 'waits', 'timeouts',
+                                    'wait_time', 'max_wait', 'peak'), 0)
+
+    def checkout(self, connect):
+        """Returns a healthy connection, opening one if needed.
+
+        Args:
+            connect: function opening a new connection.
+
+        Raises:
+            OperationalError: if none is free within timeout.
+        """
+
+        start = time.time()
+        waited = False
+
+        with self.condition:
+            while not self.idle and self.open >= self.size:
+                remaining = self.timeout - (time.time() - start)
+
+                if remaining <= 0:
+                    self.stats['timeouts'] += 1
+                    raise Database.OperationalError(
+                        'Connection pool exhausted after %ss.' % self.timeout)
+
+                waited = True
+                self.condition.wait(remaining)
+
+            wait_time = time.time() - start
+            self.stats['checkouts'] += 1
+            self.stats['wait_time'] += wait_time
+            self.stats['max_wait'] = max(self.stats['max_wait'], wait_time)
+
+            if waited:
+                self.stats['waits'] += 1
+
+            if self.idle:
+                connection, returned = self.idle.pop()
+            else:
+                connection, returned = None, None
+
+            # Reserves the slot before connecting outside the lock
+            if connection is None:
+                self.open += 1
+
+            self.in_use += 1
+            self.stats['peak'] = max(self.stats['peak'], self.in_use)
+
+        if connection is not None:
+            if self.healthy(connection, returned):
+                self._count('reused')
+                return connection
+
+            logger.info('Discarding broken pooled connection.')
+
+            # Its slot is reused by the connection opened below
+            self.discard(connection, keep_slot=True)
+
+        try:
+            connection = connect()
+        except Exception:
+            with self.condition:
+                self.open -= 1
+                self.in_use -= 1
+                self.condition.notify()
+
+            raise
+
+        self._count('opened')
+
+        return connection
+
+    def healthy(self, connection, returned):
+        """Returns true if connection is usable."""
+
+        if connection.closed or connection.get_transaction_status() == \
+                psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+            return False
+
+        return time.time() - returned < self.check_idle or \
+            self.ping(connection)
+
+    def ping(self, connection):
+        """Returns true if connection answers SELECT 1."""
+
+        try:
+            cursor = connection.cursor()
+            cursor.execute('SELECT 1')
+            cursor.close()
+
+            # Ends the transaction SELECT 1 opened outside autocommit
+            if connection.get_transaction_status() != \
+                    psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                connection.rollback()
+        except Database.Error:
+            return False
+
+        return True
+
+    def checkin(self, connection, errors_occurred=False):
+        """Returns connection to the pool, rolling back open work.
+
+        Args:
+            connection: connection checked out of this pool.
+            errors_occurred: true if database errors occurred on the
+                connection; it is pinged and discarded if unusable.
+        """
+
+        try:
+            if connection.closed:
+                raise Database.InterfaceError('Connection already closed.')
+
+            if connection.get_transaction_status() != \
+                    psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                connection.rollback()
+        except Database.Error:
+            self.discard(connection)
+            return
+
+        if errors_occurred and not self.ping(connection):
+            logger.info('Discarding pooled connection after errors.')
+            self.discard(connection)
+            return
+
+        with self.condition:
+            self.idle.append((connection, time.time()))
+            self.in_use -= 1
+            self.condition.notify()
+
+    def discard(self, connection, keep_slot=False):
+        """Closes checked out connection and frees its slot.
+
+        Args:
+            connection: connection to close.
+            keep_slot: true if the caller opens a replacement in the
+                slot, which then stays counted as open and in use.
+        """
+
+        try:
+            connection.close()
+        except Database.Error:
+            pass
+
+        with self.condition:
+            self.stats['discarded'] += 1
+
+            if not keep_slot:
+                self.open -= 1
+                self.in_use -= 1
+                self.condition.notify()
+
+    def close_idle(self):
+        """Closes every idle connection."""
+
+        with self.condition:
+            idle, self.idle = self.idle, []
+            self.open -= len(idle)
+            self.condition.notify_all()
+
+        for connection, returned in idle:
+            try:
+                connection.close()
+            except Database.Error:
+                pass
+
+    def _count(self, name):
+        with self.condition:
+            self.stats[name] += 1
+
+    def snapshot(self):
+        """Returns dict of pool size, usage and counters."""
+
+        with self.condition:
+            snapshot = dict(self.stats)
+            snapshot.update(size=self.size, open=self.open,
+                            in_use=self.in_use, idle=len(self.idle),
+                            utilization=self.in_use / float(self.size))
+
+        return snapshot
+
+
+class PoolRegistry(object):
+    """Pools of this process, one per alias and database."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pid = None
+        self.pools = dict()
+
+    def get(self, alias, settings_dict):
+        """Returns pool for alias and the database it points at."""
+
+        pool_settings = settings_dict.get('POOL', {})
+        key = (alias, settings_dict['NAME'], settings_dict['HOST'],
+               settings_dict['PORT'], settings_dict['USER'])
+
+        with self.lock:
+            # Connections are not shared with forked children
+            if self.pid != os.getpid():
+                self.pid = os.getpid()
+                self.pools = dict()
+
+            if key not in self.pools:
+                self.pools[key] = ConnectionPool(
+                    pool_settings.get('SIZE', DEFAULT_SIZE),
+                    pool_settings.get('TIMEOUT', DEFAULT_TIMEOUT),
+                    pool_settings.get('CHECK_IDLE', DEFAULT_CHECK_IDLE))
+
+            return self.pools[key]
+
+    def close_idle(self, name=None):
+        """Closes idle connections of every pool, or of database name."""
+
+        with self.lock:
+            pools = [pool for key, pool in self.pools.items()
+                     if name is None or key[1] == name]
+
+        for pool in pools:
+            pool.close_idle()
+
+    def snapshot(self):
+        """Returns dict of alias to pool snapshot, summed over databases."""
+
+        with self.lock:
+            pools = list(self.pools.items())
+
+        snapshot = dict()
+
+        for key, pool in pools:
+            pool_snapshot = pool.snapshot()
+            totals = snapshot.setdefault(key[0], dict.fromkeys(
+                pool_snapshot, 0))
+
+            for name, value in pool_snapshot.items():
+                if name == 'max_wait':
+                    totals[name] = max(totals[name], value)
+                else:
+                    totals[name] += value
+
+        for totals in snapshot.values():
+            totals['utilization'] = totals['in_use'] / float(
+                totals['size'] or 1)
+
+        return snapshot
+
+
+pools = PoolRegistry()
+
+
+def collect_metrics():
+    """Returns pool usage of this process as metric series."""
+
+    series = []
+
+    for alias, snapshot in pools.snapshot().items():
+        labels = (('alias', alias),)
+
+        for name in POOL_COUNTERS:
+            series.append(('counter', 'notesapp_db_pool_%s_total' % name,
+                           labels, snapshot[name]))
+
+        for state in POOL_STATES:
+            series.append(('gauge', 'notesapp_db_pool_connections',
+                           labels + (('state', state),), snapshot[state]))
+
+        series.extend([
+            ('counter', 'notesapp_db_pool_wait_seconds_total', labels,
+             snapshot['wait_time']),
+            ('gauge', 'notesapp_db_pool_max_wait_seconds', labels,
+             snapshot['max_wait']),
+            ('gauge', 'notesapp_db_pool_peak', labels, snapshot['peak']),
+            ('gauge', 'notesapp_db_pool_utilization', labels,
+             snapshot['utilization']),
+        ])
+
+    return series
+
+
+metrics.add_collector(collect_metrics, {
+    'notesapp_db_pool_checkouts_total': 'Pooled connections checked out.',
+    'notesapp_db_pool_opened_total': 'Pooled connections opened.',
+    'notesapp_db_pool_reused_total': 'Checkouts reusing an idle connection.',
+    'notesapp_db_pool_discarded_total': 'Pooled connections discarded.',
+    'notesapp_db_pool_waits_total': 'Checkouts that waited for a slot.',
+    'notesapp_db_pool_timeouts_total': 'Checkouts that timed out waiting.',
+    'notesapp_db_pool_wait_seconds_total': 'Time checkouts spent waiting.',
+    'notesapp_db_pool_connections': 'Pooled connections by state.',
+    'notesapp_db_pool_max_wait_seconds': 'Longest checkout wait.',
+    'notesapp_db_pool_peak': 'Most connections in use at once.',
+    'notesapp_db_pool_utilization': 'Share of pool slots in use.',
+}, ('notesapp_db_pool_max_wait_seconds', 'notesapp_db_pool_peak',
+    'notesapp_db_pool_utilization'))
+
+
+class DatabaseCreation(PostgresCreation):
+    """Closes pooled connections to the test database before dropping it."""
+
+    def _destroy_test_db(self, test_database_name, verbosity):
+        pools.close_idle(test_database_name)
+
+        return super(DatabaseCreation, self)._destroy_test_db(
+            test_database_name, verbosity)
+
+
+class DatabaseWrapper(PostgresWrapper):
+    """PostgreSQL wrapper that checks connections out of a pool."""
+
+    def __init__(self, *args, **kwargs):
+        super(DatabaseWrapper, self).__init__(*args, **kwargs)
+
+        self.creation = DatabaseCreation(self)
+        self._pool = None
+
+    def get_new_connection(self, conn_params):
+        self._pool = pools.get(self.alias, self.settings_dict)
+
+        return self._pool.checkout(
+            lambda: super(DatabaseWrapper, self).get_new_connection(
+                conn_params))
+
+    def _close(self):
+        if self.connection is not None:
+            if self._pool is None:
+                return super(DatabaseWrapper, self)._close()
+
+            with self.wrap_database_errors:
+                self._pool.checkin(self.connection, self.errors_occurred)
@@ -0,0 +1,479 @@
+"""Per-request performance metrics, exposed in Prometheus text format.
+
+MetricsMiddleware records the following for every request, labelled by
+view name (the class name for class-based views):
+    notesapp_request_seconds: wall time of the request.
+    notesapp_db_queries_total: queries run, per database alias.
+    notesapp_db_seconds: time spent in queries, per database alias.
+    notesapp_bcrypt_seconds: time spent waiting on bcrypt hashes.
+    notesapp_mail_seconds: time spent queueing or sending email.
+
+Code outside the middleware adds to the current request's timers with
+record() or timed(); see authentication.hashing and outbox. Modules
+keeping their own statistics register a collector with add_collector(),
+which is called for every snapshot; see Notesapp.db.postgresql_pool.
+Gauges from collectors are summed over processes, except those named in
+MAX_GAUGES, which take the largest value. Gauges of exited processes
+are dropped.
+
+Each process keeps its own histograms and writes them to a snapshot
+file in METRICS_DIR at most every METRICS_FLUSH_INTERVAL seconds.
+render_all() merges the snapshots of every process on the host, so any
+worker can serve the metrics of all of them. Snapshots of exited
+processes are folded into RETIRED_FILE and removed, so counters never
+go backwards and the directory does not grow with every restart.
+"""
+
+from contextlib import contextmanager
+from django.conf import settings
+from django.db import connections
+import errno
+import fcntl
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+METRICS_DIR = getattr(settings, 'METRICS_DIR', os.path.join(
+    tempfile.gettempdir(), 'notesapp-metrics'))
+METRICS_FLUSH_INTERVAL = getattr(settings, 'METRICS_FLUSH_INTERVAL', 10)
+RETIRED_FILE = 'retired.json' # Sum of snapshots of exited processes
+# Upper bounds of histogram buckets in seconds; +Inf is implied
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+HELP = {
+    'notesapp_request_seconds': 'Wall time of requests.',
+    'notesapp_db_queries_total': 'Database queries run by requests.',
+    'notesapp_db_seconds': 'Time requests spent in database queries.',
+    'notesapp_bcrypt_seconds': 'Time requests spent waiting on bcrypt.',
+    'notesapp_mail_seconds': 'Time requests spent queueing or sending mail.',
+}
+MAX_GAUGES = set()
+
+# Functions returning (kind, metric, labels, value) tuples; see
+# add_collector()
+_collectors = []
+
+# Timers of the request being handled by this thread
+_request = threading.local()
+
+
+def record(name, seconds):
+    """Adds seconds to timer name of this thread's request, if any."""
+
+    timers = getattr(_request, 'timers', None)
+
+    if timers is not None:
+        timers[name] = timers.get(name, 0) + seconds
+
+
+def _record_query(alias, seconds):
+    """Counts a query on alias for this thread's request, if any."""
+
+    queries = getattr(_request, 'queries', None)
+
+    if queries is not None:
+        totals = queries.setdefault(alias, [0, 0.0])
+        totals[0] += 1
+        totals[1] += seconds
+
+
+def add_collector(collector, help_texts=None, max_gauges=()):
+    """Registers a function reporting series at every snapshot.
+
+    Args:
+        collector: function taking no arguments and returning a list of
+            (kind, metric, labels, value) tuples, where kind is
+            'counter' for values only ever growing in this process or
+            'gauge' for current values, and labels is a tuple of pairs.
+        help_texts: optional dict of metric name to help text.
+        max_gauges: gauge names merged by taking the largest value.
+    """
+
+    _collectors.append(collector)
+    HELP.update(help_texts or {})
+    MAX_GAUGES.update(max_gauges)
+
+
+@contextmanager
+def timed(name):
+    """Context manager recording its duration with record()."""
+
+    start = time.time()
+
+    try:
+        yield
+    finally:
+        record(name, time.time() - start)
+
+
+class Registry(object):
+    """Histograms and counters of this process.
+
+    Series are keyed by metric name and a tuple of label pairs.
+    Histogram values are lists of per-bucket counts, then sum, then
+    count; bucket counts are not cumulative until rendered.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = dict()
+        self.counters = dict()
+        self.flushed = 0
+        self.path = os.path.join(METRICS_DIR, '%d-%d.json' % (
+            os.getpid(), time.time()))
+
+    def observe(self, metric, labels, value):
+        """Adds value to histogram series."""
+
+        with self.lock:
+            series = self.histograms.setdefault((metric, labels),
+                                                [0] * (len(BUCKETS) + 3))
+            index = len(BUCKETS)
+
+            for bucket, bound in enumerate(BUCKETS):
+                if value <= bound:
+                    index = bucket
+                    break
+
+            series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def increment(self, metric, labels, amount=1):
+        """Adds amount to counter series."""
+
+        with self.lock:
+            self.counters[(metric, labels)] = \
+                self.counters.get((metric, labels), 0) + amount
+
+    def snapshot(self):
+        """Returns JSON-serialisable copy of all series and collectors."""
+
+        with self.lock:
+            snapshot = {
+                'histograms': [[metric, labels, list(series)] for
+                               (metric, labels), series in
+                               self.histograms.items()],
+                'counters': [[metric, labels, value] for
+                             (metric, labels), value in
+                             self.counters.items()],
+                'gauges': [],
+            }
+
+        for collector in _collectors:
+            try:
+                series = collector()
+            except Exception:
+                logger.exception('Metrics collector %r failed.', collector)
+                continue
+
+            for kind, metric, labels, value in series:
+                snapshot['gauges' if kind == 'gauge' else 'counters'].append(
+                    [metric, labels, value])
+
+        return snapshot
+
+    def flush(self, force=False):
+        """Writes snapshot file if due, replacing the previous one."""
+
+        if not force and time.time() - self.flushed < METRICS_FLUSH_INTERVAL:
+            return
+
+        self.flushed = time.time()
+
+        # Forked children write their own file
+        if not self.path.startswith(os.path.join(METRICS_DIR,
+                                                 '%d-' % os.getpid())):
+            self.path = os.path.join(METRICS_DIR, '%d-%d.json' % (
+                os.getpid(), time.time()))
+
+        try:
+            if not os.path.isdir(METRICS_DIR):
+                os.makedirs(METRICS_DIR)
+
+            _write_snapshot(self.path, self.snapshot())
+        except OSError as error:
+            logger.warning('Metrics snapshot not written: %s', error)
+
+
+registry = Registry()
+
+
+def _pid_running(pid):
+    """Returns true if a process with pid exists."""
+
+    try:
+        os.kill(pid, 0)
+    except OSError as error:
+        return error.errno == errno.EPERM
+
+    return True
+
+
+def _read_snapshot(path):
+    """Returns snapshot stored at path, or None if unreadable."""
+
+    try:
+        with open(path) as source:
+            return json.load(source)
+    except (OSError, ValueError) as error:
+        logger.warning('Metrics snapshot %s not read: %s', path, error)
+
+
+def _write_snapshot(path, snapshot):
+    """Atomically replaces snapshot stored at path."""
+
+    temporary = path + '.tmp'
+
+    with open(temporary, 'w') as output:
+        json.dump(snapshot, output)
+
+    os.replace(temporary, path)
+
+
+def retire_exited():
+    """Folds snapshots of exited processes into RETIRED_FILE.
+
+    Runs under an exclusive lock on the directory, so a snapshot is
+    never counted twice by workers retiring at once.
+    """
+
+    try:
+        lock = os.open(METRICS_DIR, os.O_RDONLY)
+    except OSError:
+        return
+
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        exited = []
+
+        for name in os.listdir(METRICS_DIR):
+            pid = name.split('-', 1)[0]
+
+            if name.endswith('.json') and pid.isdigit() and \
+                    not _pid_running(int(pid)):
+                exited.append(os.path.join(METRICS_DIR, name))
+
+        if not exited:
+            return
+
+        retired_path = os.path.join(METRICS_DIR, RETIRED_FILE)
+        snapshots = [snapshot for snapshot in (_read_snapshot(path) for
+                     path in [retired_path] + exited if
+                     os.path.exists(path)) if snapshot is not None]
+        # Gauges of exited processes no longer describe anything
+        histograms, counters, gauges = merge(snapshots)
+
+        _write_snapshot(retired_path, {
+            'histograms': [[metric, labels, series] for
+                           (metric, labels), series in histograms.items()],
+            'counters': [[metric, labels, value] for
+                         (metric, labels), value in counters.items()],
+        })
+
+        for path in exited:
+            os.remove(path)
+    except OSError as error:
+        logger.warning('Exited metrics snapshots not retired: %s', error)
+    finally:
+        os.close(lock)
+
+
+def merge(snapshots):
+    """Merges snapshots into dicts of histogram, counter and gauge series."""
+
+    histograms = dict()
+    counters = dict()
+    gauges = dict()
+
+    for snapshot in snapshots:
+        for metric, labels, series in snapshot['histograms']:
+            key = (metric, tuple(tuple(pair) for pair in labels))
+            totals = histograms.setdefault(key, [0] * len(series))
+
+            for index, value in enumerate(series):
+                totals[index] += value
+
+        for metric, labels, value in snapshot['counters']:
+            key = (metric, tuple(tuple(pair) for pair in labels))
+            counters[key] = counters.get(key, 0) + value
+
+        for metric, labels, value in snapshot.get('gauges', ()):
+            key = (metric, tuple(tuple(pair) for pair in labels))
+
+            if key not in gauges:
+                gauges[key] = value
+            elif metric in MAX_GAUGES:
+                gauges[key] = max(gauges[key], value)
+            else:
+                gauges[key] += value
+
+    return histograms, counters, gauges
+
+
+def _labels(pairs):
+    """Formats label pairs as {name="value",...}."""
+
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace(
+        '\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in pairs)
+
+
+def _value(value):
+    """Formats sample value; integers without a fraction."""
+
+    if isinstance(value, int):
+        return '%d' % value
+
+    return '%f' % value
+
+
+def render(histograms, counters, gauges=None):
+    """Returns Prometheus text exposition of merged series."""
+
+    lines = []
+    typed = set()
+
+    def header(metric, kind):
+        if metric not in typed:
+            typed.add(metric)
+            lines.append('# HELP %s %s' % (metric, HELP.get(metric, metric)))
+            lines.append('# TYPE %s %s' % (metric, kind))
+
+    for (metric, labels), series in sorted(histograms.items()):
+        header(metric, 'histogram')
+        cumulative = 0
+
+        for bound, count in zip(BUCKETS + ('+Inf',), series):
+            cumulative += count
+            lines.append('%s_bucket%s %d' % (metric, _labels(
+                labels + (('le', bound),)), cumulative))
+
+        lines.append('%s_sum%s %f' % (metric, _labels(labels), series[-2]))
+        lines.append('%s_count%s %d' % (metric, _labels(labels),
+                                        series[-1]))
+
+    for (metric, labels), value in sorted(counters.items()):
+        header(metric, 'counter')
+        lines.append('%s%s %s' % (metric, _labels(labels), _value(value)))
+
+    for (metric, labels), value in sorted((gauges or {}).items()):
+        header(metric, 'gauge')
+        lines.append('%s%s %s' % (metric, _labels(labels), _value(value)))
+
+    return '\n'.join(lines) + '\n'
+
+
+def render_all():
+    """Returns metrics of every process on this host as text."""
+
+    registry.flush(force=True)
+    retire_exited()
+    snapshots = []
+
+    try:
+        names = os.listdir(METRICS_DIR)
+    except OSError:
+        names = []
+
+    for name in names:
+        if name.endswith('.json'):
+            snapshot = _read_snapshot(os.path.join(METRICS_DIR, name))
+
+            if snapshot is not None:
+                snapshots.append(snapshot)
+
+    return render(*merge(snapshots))
+
+
+class TimingCursor(object):
+    """Cursor proxy counting queries and their time for the request.
+
+    Unlike Django's debug cursor, keeps no SQL and formats nothing.
+    """
+
+    def __init__(self, cursor, alias):
+        self.cursor = cursor
+        self.alias = alias
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def execute(self, sql, params=None):
+        start = time.time()
+
+        try:
+            return self.cursor.execute(sql, params)
+        finally:
+            _record_query(self.alias, time.time() - start)
+
+    def executemany(self, sql, param_list):
+        start = time.time()
+
+        try:
+            return self.cursor.executemany(sql, param_list)
+        finally:
+            _record_query(self.alias, time.time() - start)
+
+
+def _instrument(connection):
+    """Makes connection hand out TimingCursors; idempotent."""
+
+    if getattr(connection, '_metrics_instrumented', False):
+        return
+
+    cursor = connection.cursor
+
+    # Instance attribute shadows DatabaseWrapper.cursor()
+    connection.cursor = lambda: TimingCursor(cursor(), connection.alias)
+    connection._metrics_instrumented = True
+
+
+class MetricsMiddleware(object):
+    """Records metrics of every request. Should be the first middleware.
+
+    Query counts and times come from a TimingCursor wrapped around the
+    cursors of every alias.
+    """
+
+    def process_request(self, request):
+        _request.timers = dict()
+        _request.queries = dict()
+        _request.view = 'unknown'
+        _request.start = time.time()
+
+        for alias in connections:
+            _instrument(connections[alias])
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        _request.view = getattr(view_func, '__name__', 'unknown')
+
+    def process_response(self, request, response):
+        if getattr(_request, 'timers', None) is None:
+            return response
+
+        view = (('view', _request.view),)
+
+        registry.observe('notesapp_request_seconds', view,
+                         time.time() - _request.start)
+
+        for alias, (count, seconds) in _request.queries.items():
+            labels = view + (('alias', alias),)
+            registry.increment('notesapp_db_queries_total', labels, count)
+            registry.observe('notesapp_db_seconds', labels, seconds)
+
+        for name, seconds in _request.timers.items():
+            registry.observe('notesapp_%s_seconds' % name, view, seconds)
+
+        _request.timers = None
+        _request.queries = None
+        registry.flush()
+
+        return response
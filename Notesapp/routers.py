@@ -1,8 +1,55 @@
 """Django database router definition.
 
 Maps specific actions to specific databases or users.
+
+Reads of apps with a read-only alias go to the replica, except:
+    - after a write to an app's database, reads of that app go to the
+      primary for READ_YOUR_WRITES_WINDOW seconds. Within a request the
+      pin is kept in thread-local state; ReadYourWritesMiddleware
+      carries it across the client's following requests in a cookie.
+      Model saves pin through a post_save receiver; writes through
+      querysets (update(), delete(), bulk_create()) that are not
+      followed by a save must call wrote() themselves.
+    - while a replica is unreachable or lags the primary by more than
+      REPLICA_MAX_LAG seconds. Lag is checked at most once every
+      REPLICA_CHECK_INTERVAL seconds per process.
+
+Routing decisions are counted per alias in counters, and the lag last
+measured for each replica is kept by monitor. Both are exported through
+Notesapp.metrics as notesapp_db_routing_total, labelled by alias and
+decision, and notesapp_replica_lag_seconds, labelled by alias.
+
+Sharding is enabled by listing aliases in SHARD_DATABASES. Models named
+in SHARDED_MODELS ('app_label.model_name', owning a user_id field) are
+then spread over those aliases by a stable hash of the user id, unless
+the meta.Shards directory says the user was moved elsewhere; see the
+moveusershard command. Saves are routed by their instance; queries must
+name their shard with .using(shard_for(user_id)); see
+authentication.models.MethodManager.
+
+Shard databases get their schema from the same South migrations as the
+primary: run manage.py migrate --database=<alias> for every alias in
+SHARD_DATABASES. Only the SHARDED_MODELS tables are used there. Sharded
+rows cannot reference users on another database, so migrations drop
+their foreign key constraints when, and only when, SHARD_DATABASES is
+set at migration time. To shard an existing deployment, migrate
+authentication back to 0016 before setting SHARD_DATABASES, then
+forward again.
 """
 
+from django.conf import settings
+from django.db import connections, DatabaseError
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+import hashlib
+import logging
+import threading
+import time
+
+from Notesapp import metrics
+
+logger = logging.getLogger(__name__)
+
 # Define database definitions to use for specific apps
 app_databases = {
     'authentication': {
@@ -12,20 +59,256 @@ app_databases = {
     }
 }
 
+READ_YOUR_WRITES_WINDOW = getattr(settings, 'READ_YOUR_WRITES_WINDOW', 5)
+READ_YOUR_WRITES_COOKIE = 'pin-primary'
+REPLICA_MAX_LAG = getattr(settings, 'REPLICA_MAX_LAG', 2)
+REPLICA_CHECK_INTERVAL = getattr(settings, 'REPLICA_CHECK_INTERVAL', 5)
+
+# Seconds a PostgreSQL replica is behind; 0 when caught up or a primary
+LAG_QUERY = """
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() OR pg_last_xlog_receive_location() =
+            pg_last_xlog_replay_location() THEN 0
+        ELSE COALESCE(EXTRACT(EPOCH FROM now() -
+            pg_last_xact_replay_timestamp()), 0)
+    END
+"""
+
+# Per-thread routing state; reset by ReadYourWritesMiddleware
+_state = threading.local()
+
+
+class RoutingCounters(object):
+    """Per-process counts of routing decisions.
+
+    Keys of snapshot() are aliases; values are dicts of:
+        reads: reads routed to the alias.
+        writes: writes routed to the alias.
+        pinned: reads sent to the alias, a primary, due to a recent write.
+        fallbacks: reads sent to the alias, a primary, because its
+            replica was unhealthy or lagging.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = dict()
+
+    def add(self, alias, name):
+        with self.lock:
+            alias_counts = self.counts.setdefault(alias, dict.fromkeys(
+                ('reads', 'writes', 'pinned', 'fallbacks'), 0))
+            alias_counts[name] += 1
+
+    def snapshot(self):
+        """Returns copy of counts per alias."""
+
+        with self.lock:
+            return dict((alias, dict(alias_counts)) for alias, alias_counts
+                        in self.counts.items())
+
+
+class ReplicaMonitor(object):
+    """Tracks replica health and lag, checking each alias periodically."""
+
+    def __init__(self, max_lag, check_interval):
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.lock = threading.Lock()
+        self.checked = dict() # Alias to (time checked, usable)
+        self.lags = dict() # Alias to seconds behind when last reachable
+
+    def usable(self, alias):
+        """Returns true if replica alias may serve reads."""
+
+        now = time.time()
+
+        with self.lock:
+            checked, usable = self.checked.get(alias, (0, True))
+
+            if now - checked < self.check_interval:
+                return usable
+
+            # Other threads use the previous result while this one checks
+            self.checked[alias] = (now, usable)
+
+        usable = self.check(alias)
+
+        with self.lock:
+            self.checked[alias] = (now, usable)
+
+        return usable
+
+    def check(self, alias):
+        """Queries replica alias for its lag. Returns true if usable."""
+
+        connection = connections[alias]
+
+        # Test mirrors and other databases have no replication to check
+        if connection.settings_dict.get('TEST_MIRROR') or \
+                connection.vendor != 'postgresql':
+            return True
+
+        try:
+            cursor = connection.cursor()
+            cursor.execute(LAG_QUERY)
+            lag = float(cursor.fetchone()[0])
+        except DatabaseError as error:
+            logger.warning('Replica %s unreachable: %s', alias, error)
+            return False
+
+        with self.lock:
+            self.lags[alias] = lag
+
+        if lag > self.max_lag:
+            logger.warning('Replica %s lagging by %.1fs.', alias, lag)
+            return False
+
+        return True
+
+
+counters = RoutingCounters()
+monitor = ReplicaMonitor(REPLICA_MAX_LAG, REPLICA_CHECK_INTERVAL)
+
+
+def collect_metrics():
+    """Returns routing counts and replica lag of this process as series."""
+
+    series = []
+
+    for alias, alias_counts in counters.snapshot().items():
+        for decision, count in alias_counts.items():
+            series.append(('counter', 'notesapp_db_routing_total',
+                           (('alias', alias), ('decision', decision)), count))
+
+    with monitor.lock:
+        lags = list(monitor.lags.items())
+
+    for alias, lag in lags:
+        series.append(('gauge', 'notesapp_replica_lag_seconds',
+                       (('alias', alias),), lag))
+
+    return series
+
+
+metrics.add_collector(collect_metrics, {
+    'notesapp_db_routing_total': 'Database routing decisions by alias.',
+    'notesapp_replica_lag_seconds': 'Replica lag last measured.',
+}, ('notesapp_replica_lag_seconds',))
+
+
+def pin(until=None):
+    """Pins reads of this thread to primaries until given time.
+
+    Args:
+        until: epoch seconds; defaults to READ_YOUR_WRITES_WINDOW from now.
+    """
+
+    if until is None:
+        until = time.time() + READ_YOUR_WRITES_WINDOW
+
+    _state.pinned_until = until
+
+
+def pinned():
+    """Returns true if reads of this thread are pinned to primaries."""
+
+    return getattr(_state, 'pinned_until', 0) > time.time()
+
+
+def wrote():
+    """Pins reads of this thread to primaries after a replicated write."""
+
+    pin()
+    _state.wrote = True
+
+
+def reset():
+    """Clears routing state of this thread."""
+
+    _state.pinned_until = 0
+    _state.wrote = False
+
+
+def sharded(model):
+    """Returns true if model is spread over shards."""
+
+    return bool(getattr(settings, 'SHARD_DATABASES', None)) and \
+        '%s.%s' % (model._meta.app_label, model._meta.model_name) in \
+        getattr(settings, 'SHARDED_MODELS', ())
+
+
+def hashed_shard(user_id):
+    """Returns shard alias user id hashes to.
+
+    Uses MD5 rather than hash() so every process agrees.
+    """
+
+    shards = settings.SHARD_DATABASES
+    digest = hashlib.md5(str(user_id).encode('ascii')).digest()
+
+    return shards[int.from_bytes(digest[:8], 'big') % len(shards)]
+
+
+def shard_for(user_id):
+    """Returns shard alias holding rows of user id."""
+
+    import meta.models
+
+    return meta.models.shard_directory.get(user_id) or \
+        hashed_shard(user_id)
+
+
+def shard_for_hints(model, hints):
+    """Returns shard alias for a sharded model's instance, or None."""
+
+    instance = hints.get('instance')
+    user_id = getattr(instance, 'user_id', None)
+
+    if user_id is None or not sharded(model):
+        return None
+
+    return shard_for(user_id)
+
+
 class AppRouter(object):
     """Routes specific apps to specific databases if app is defined."""
     def db_for_read(self, model, **hints):
-        if model._meta.app_label in app_databases:
-            return app_databases[model._meta.app_label]['ro']
+        shard = shard_for_hints(model, hints)
+
+        if shard is not None:
+            alias = shard
+        elif model._meta.app_label in app_databases:
+            databases = app_databases[model._meta.app_label]
+
+            if pinned():
+                counters.add(databases['rw'], 'pinned')
+                alias = databases['rw']
+            elif not monitor.usable(databases['ro']):
+                counters.add(databases['rw'], 'fallbacks')
+                alias = databases['rw']
+            else:
+                alias = databases['ro']
         else:
-            return 'default'
+            alias = 'default'
+
+        counters.add(alias, 'reads')
+
+        return alias
 
 
     def db_for_write(self, model, **hints):
-        if model._meta.app_label in app_databases:
-            return app_databases[model._meta.app_label]['rw']
+        shard = shard_for_hints(model, hints)
+
+        if shard is not None:
+            alias = shard
+        elif model._meta.app_label in app_databases:
+            alias = app_databases[model._meta.app_label]['rw']
         else:
-            return 'default'
+            alias = 'default'
+
+        counters.add(alias, 'writes')
+
+        return alias
 
     def allow_relation(self, obj1, obj2, **hints):
         if obj1._meta.app_label in app_databases or\
@@ -33,4 +316,52 @@ class AppRouter(object):
             return app_databases[obj1._meta.app_label]['relation'] or\
                 app_databases[obj2._meta.app_label]['relation']
         else:
-            return None
\ No newline at end of file
+            return None
+
+
+@receiver(post_save)
+def pin_after_save(sender, using, **kwargs):
+    """Pins reads after saves to a replicated app's primary.
+
+    db_for_write() does not pin, as callers also use it merely to pick
+    an alias. Replicas may not have this write yet.
+    """
+
+    if any(using == databases['rw'] for databases in app_databases.values()
+           if databases.get('ro')):
+        wrote()
+
+
+class ReadYourWritesMiddleware(object):
+    """Carries read pinning across requests of the same client.
+
+    Requests start unpinned unless the client's pin cookie is still in
+    its window. Responses to requests that wrote set the cookie, so the
+    client's next requests read from primaries until the window ends.
+    The cookie is signed and only accepted for one window after it was
+    set, so clients cannot pin themselves to primaries for longer.
+    """
+
+    def process_request(self, request):
+        reset()
+
+        try:
+            until = float(request.get_signed_cookie(
+                READ_YOUR_WRITES_COOKIE, 0, max_age=READ_YOUR_WRITES_WINDOW))
+        except ValueError:
+            return
+
+        if until > time.time():
+            # Never pins past one window from now
+            pin(min(until, time.time() + READ_YOUR_WRITES_WINDOW))
+
+    def process_response(self, request, response):
+        if getattr(_state, 'wrote', False):
+            response.set_signed_cookie(READ_YOUR_WRITES_COOKIE,
+                                str(_state.pinned_until),
+                                max_age=READ_YOUR_WRITES_WINDOW,
+                                httponly=True)
+
+        reset()
+
+        return response
@@ -0,0 +1,175 @@
+"""Session engine that avoids session table reads and writes.
+
+Sessions are stored in the database as with the db engine, but:
+    - reads are served from the local tier of the SESSION_CACHE_ALIAS
+      tiered cache and only fall through to the session table on a miss.
+    - saves are skipped when the encoded session is unchanged since it
+      was loaded or last saved.
+    - unknown or expired session keys are dropped rather than replaced
+      by a new empty row, so visitors without a live session cost no
+      session writes; a row is created only once data is stored.
+    - cycle_key() deletes the old row and inserts the new one with its
+      data in a single write, instead of inserting an empty row first.
+    - clear_expired() deletes in batches of CLEAR_BATCH_SIZE rows.
+
+The shared tier is never used: it would only put a second database
+table, the cache table, in front of the session table. Local copies are
+dropped by this process's saves, cycle_key() and logout, and trusted for
+at most the cache's LOCAL_TIMEOUT; another process may serve a deleted
+or changed session for that long.
+"""
+
+from django.conf import settings
+from django.contrib.sessions.backends.base import CreateError
+from django.contrib.sessions.backends.db import SessionStore as DBStore
+from django.contrib.sessions.models import Session
+from django.core.cache import get_cache
+from django.core.exceptions import SuspiciousOperation
+from django.db import IntegrityError, router, transaction
+from django.utils import timezone
+import hashlib
+
+KEY_PREFIX = 'notesapp.sessions.'
+CLEAR_BATCH_SIZE = 1000
+
+# Must name a Notesapp.cache.tiered.TieredCache
+cache = get_cache(getattr(settings, 'SESSION_CACHE_ALIAS', 'tiered'))
+
+
+def _digest(encoded):
+    """Returns digest of encoded session data for change detection."""
+
+    return hashlib.sha1(encoded.encode('ascii')).digest()
+
+
+class SessionStore(DBStore):
+    """Database-backed session store with a local cache in front."""
+
+    def __init__(self, session_key=None):
+        super(SessionStore, self).__init__(session_key)
+        self._saved_digest = None
+
+    def _cache_key(self, session_key=None):
+        return KEY_PREFIX + (session_key or self.session_key)
+
+    def load(self):
+        encoded = cache.get_local(self._cache_key())
+
+        if encoded is None:
+            try:
+                session_object = Session.objects.get(
+                    session_key=self.session_key,
+                    expire_date__gt=timezone.now())
+            except (Session.DoesNotExist, SuspiciousOperation):
+                # Dropped instead of created; save() makes a key if needed
+                self._session_key = None
+                return {}
+
+            encoded = session_object.session_data
+            cache.set_local(self._cache_key(), encoded, max(int((
+                session_object.expire_date - timezone.now()
+                ).total_seconds()), 0))
+
+        self._saved_digest = _digest(encoded)
+
+        return self.decode(encoded)
+
+    def exists(self, session_key):
+        if cache.get_local(self._cache_key(session_key)) is not None:
+            return True
+
+        return super(SessionStore, self).exists(session_key)
+
+    def create(self):
+        """Saves session under a new key, keeping any current data."""
+
+        while True:
+            self._session_key = self._get_new_session_key()
+
+            try:
+                self.save(must_create=True)
+            except CreateError:
+                continue
+
+            self.modified = True
+            return
+
+    def save(self, must_create=False):
+        """Saves session if its contents changed since loaded or saved.
+
+        Args:
+            must_create: raises CreateError if key already exists.
+        """
+
+        if self.session_key is None:
+            return self.create()
+
+        encoded = self.encode(self._get_session(no_load=must_create))
+        digest = _digest(encoded)
+
+        if not must_create and digest == self._saved_digest:
+            return
+
+        session_object = Session(session_key=self.session_key,
+                                 session_data=encoded,
+                                 expire_date=self.get_expiry_date())
+        using = router.db_for_write(Session, instance=session_object)
+
+        try:
+            with transaction.atomic(using=using):
+                session_object.save(force_insert=must_create, using=using)
+        except IntegrityError:
+            if must_create:
+                raise CreateError
+
+            raise
+
+        cache.set_local(self._cache_key(), encoded, self.get_expiry_age())
+        self._saved_digest = digest
+
+    def cycle_key(self):
+        """Moves session data to a new key, deleting the old session.
+
+        The new row is inserted when the session is next saved.
+        """
+
+        data = self._get_session()
+        old_key = self.session_key
+
+        self._session_key = None
+        self._session_cache = data
+        self._saved_digest = None
+        self.modified = True
+
+        if old_key:
+            self.delete(old_key)
+
+    def delete(self, session_key=None):
+        if session_key is None:
+            if self.session_key is None:
+                return
+
+            session_key = self.session_key
+
+        cache.delete_local(self._cache_key(session_key))
+        super(SessionStore, self).delete(session_key)
+
+    def flush(self):
+        self.clear()
+        self.delete()
+        self._session_key = None
+        self._saved_digest = None
+
+    @classmethod
+    def clear_expired(cls):
+        """Deletes expired sessions in batches of CLEAR_BATCH_SIZE."""
+
+        while True:
+            session_keys = list(Session.objects.filter(
+                expire_date__lt=timezone.now()).values_list(
+                'session_key', flat=True)[:CLEAR_BATCH_SIZE])
+
+            if not session_keys:
+                return
+
+            Session.objects.filter(session_key__in=session_keys).delete()
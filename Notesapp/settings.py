@@ -9,6 +9,7 @@ https://docs.djangoproject.com/en/1.6/ref/settings/
 """
 
 import os
+from Notesapp import environment
 from Notesapp.environment import SECRET_KEY, DATABASES, DEBUG,\
     TEMPLATE_DEBUG, LOGGING_FILENAME, EMAIL_HOST, EMAIL_PORT,\
     EMAIL_HOST_USER, EMAIL_HOST_PASSWORD, EMAIL_USE_TLS, SITE_PATH,\
@@ -45,10 +46,13 @@ INSTALLED_APPS = (
     'authentication',
     'errors',
     'meta',
+    'outbox',
 )
 
 MIDDLEWARE_CLASSES = (
+    'Notesapp.metrics.MetricsMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
+    'Notesapp.routers.ReadYourWritesMiddleware',
 	'django.middleware.locale.LocaleMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -66,6 +70,33 @@ WSGI_APPLICATION = 'Notesapp.wsgi.application'
 
 DATABASE_ROUTERS = ['Notesapp.routers.AppRouter']
 
+# Reads go to primaries for this many seconds after a write, and while a
+# replica lags more than REPLICA_MAX_LAG seconds; see Notesapp.routers
+READ_YOUR_WRITES_WINDOW = 5
+REPLICA_MAX_LAG = 2
+REPLICA_CHECK_INTERVAL = 5
+
+# PostgreSQL aliases reuse connections through per-process pools of
+# SIZE connections; see Notesapp.db.postgresql_pool
+DATABASE_POOL = {
+    'SIZE': 4,
+    'TIMEOUT': 5,
+    'CHECK_IDLE': 30,
+}
+
+for database in DATABASES.values():
+    if database.get('ENGINE') == 'django.db.backends.postgresql_psycopg2':
+        database['ENGINE'] = 'Notesapp.db.postgresql_pool'
+        database.setdefault('POOL', DATABASE_POOL)
+
+# Models ('app_label.model_name') spread over SHARD_DATABASES aliases by
+# user id; sharding is off unless the environment file lists aliases in
+# SHARD_DATABASES. Set SHARD_DATABASES before migrating, and migrate
+# each shard alias too (manage.py migrate --database=<alias>). See
+# Notesapp.routers
+SHARD_DATABASES = getattr(environment, 'SHARD_DATABASES', [])
+SHARDED_MODELS = ['authentication.methods'] if SHARD_DATABASES else []
+
 # Internationalization
 # https://docs.djangoproject.com/en/1.6/topics/i18n/
 
@@ -160,4 +191,89 @@ CACHES = {
         'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
         'LOCATION': 'default_cache',
     },
-}
\ No newline at end of file
+    # Rate-limit counters shared by workers on a host; see
+    # Notesapp.cache.shm
+    'ratelimit': {
+        'BACKEND': 'Notesapp.cache.shm.SharedMemoryCache',
+        'LOCATION': os.path.join('/dev/shm' if os.path.isdir('/dev/shm')
+                                 else '/tmp', 'notesapp-ratelimit'),
+        'OPTIONS': {
+            'SLOTS': 65536,
+        },
+    },
+    # Local LRU in front of the default cache; sessions use its local
+    # tier, so LOCAL_TIMEOUT bounds how long a logged out session may
+    # still be served by other workers. See Notesapp.cache.tiered
+    'tiered': {
+        'BACKEND': 'Notesapp.cache.tiered.TieredCache',
+        'LOCATION': 'default',
+        'OPTIONS': {
+            'LOCAL_ENTRIES': 1000,
+            'LOCAL_TIMEOUT': 2,
+            'GRACE_TIME': 30,
+        },
+    },
+}
+
+RATELIMIT_USE_CACHE = 'ratelimit'
+
+# Sessions
+# Database sessions read through the local tier of the tiered cache; see
+# Notesapp.sessions
+
+SESSION_ENGINE = 'Notesapp.sessions'
+SESSION_CACHE_ALIAS = 'tiered'
+
+# Password hashing
+# Bcrypt runs in a process pool; see authentication.hashing
+# Run manage.py calibratebcrypt on deployment hosts to choose rounds.
+# Stored hashes with a different cost are rehashed on next login.
+
+BCRYPT_ROUNDS = 13
+HASH_POOL_WORKERS = 2
+HASH_POOL_QUEUE_DEPTH = 8
+HASH_POOL_TIMEOUT = 10
+
+# Availability filters
+# Seconds between rebuilds of username/email Bloom filters, and between
+# checks of their version stamp; see authentication.availability
+
+AVAILABILITY_FILTER_REFRESH = 300
+AVAILABILITY_FILTER_CHECK_INTERVAL = 5
+
+# Email
+# Server settings are in environment file; see outbox.backends
+
+EMAIL_BACKEND = 'outbox.backends.PooledEmailBackend'
+EMAIL_POOL_SIZE = 4
+EMAIL_POOL_IDLE_TIME = 60
+
+# Days sent and failed outbox messages are kept; see outbox.models
+OUTBOX_RETENTION = 7
+
+# Access timestamps
+# Coalesces last_access/last_used writes in process memory when True;
+# see authentication.access
+
+COALESCE_ACCESS_WRITES = False
+ACCESS_WRITE_STALENESS = 60
+
+# Meta data
+# Seconds between checks of the meta data version stamp; see meta.models
+
+META_DATA_CHECK_INTERVAL = 1
+
+# Weak passwords
+# Path of Bloom filter built by the buildpasswordfilter command; None
+# disables the check. See errors.validators
+
+WEAK_PASSWORD_FILTER = None
+
+# Metrics
+# Per-process snapshots merged by backend/v1/metrics; see Notesapp.metrics.
+# Scrapers send METRICS_TOKEN, set in environment file, as a bearer token;
+# without one the metrics are not served
+
+METRICS_DIR = '/tmp/notesapp-metrics'
+METRICS_FLUSH_INTERVAL = 10
+METRICS_TOKEN = getattr(environment, 'METRICS_TOKEN', None)
\ No newline at end of file
@@ -0,0 +1,554 @@
+"""Django test module for project-wide caches and helpers."""
+
+import json
+import os
+import psycopg2.extensions
+import shutil
+import tempfile
+import time
+from unittest import mock
+from django.db import connections
+from django.http import Http404, HttpResponse
+from django.test import SimpleTestCase, TestCase
+from django.test.client import RequestFactory
+from django.test.utils import CaptureQueriesContext, override_settings
+
+from backend.v1.metrics import MetricsView
+from common import ratelimit
+from common.ratelimit import count_hit
+from Notesapp import metrics, routers, sessions
+from Notesapp.cache.shm import SharedMemoryCache, PROBE_LIMIT
+from Notesapp.cache.tiered import TieredCache
+from Notesapp.db.postgresql_pool import base as pool_base
+from Notesapp.db.postgresql_pool.base import ConnectionPool, Database
+
+
+class SharedMemoryCacheTest(SimpleTestCase):
+    """Tests for the shared-memory cache table."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def make_cache(self, slots=PROBE_LIMIT):
+        """Returns cache on a fresh table of given number of slots."""
+
+        # With PROBE_LIMIT slots, every key's probe window is the table
+        return SharedMemoryCache(os.path.join(self.directory, 'table'),
+                                 {'OPTIONS': {'SLOTS': slots}})
+
+    def test_probing(self):
+        """Keys sharing slots are found by probing past each other."""
+
+        cache = self.make_cache()
+
+        for number in range(PROBE_LIMIT):
+            cache.set('key-%d' % number, number)
+
+        for number in range(PROBE_LIMIT):
+            self.assertEqual(cache.get('key-%d' % number), number)
+
+        cache.delete('key-0')
+
+        self.assertIsNone(cache.get('key-0'))
+        self.assertEqual(cache.get('key-1'), 1)
+
+    def test_eviction(self):
+        """A full window evicts the entry closest to expiring."""
+
+        cache = self.make_cache()
+        cache.set('soonest', 'value', 60)
+
+        for number in range(PROBE_LIMIT - 1):
+            cache.set('key-%d' % number, number, 3600)
+
+        cache.set('new', 'value', 3600)
+
+        self.assertIsNone(cache.get('soonest'))
+        self.assertEqual(cache.get('new'), 'value')
+
+        for number in range(PROBE_LIMIT - 1):
+            self.assertEqual(cache.get('key-%d' % number), number)
+
+    def test_expiry(self):
+        """Entries vanish after their timeout; incr keeps the expiry."""
+
+        cache = self.make_cache()
+        cache.add('counter', 1, 0.2)
+        cache.set('forever', 'value', None)
+
+        self.assertEqual(cache.incr('counter'), 2)
+        self.assertFalse(cache.add('counter', 1, 0.2))
+
+        time.sleep(0.3)
+
+        self.assertIsNone(cache.get('counter'))
+        self.assertRaises(ValueError, cache.incr, 'counter')
+        self.assertTrue(cache.add('counter', 1, 0.2))
+        self.assertEqual(cache.get('forever'), 'value')
+
+    def test_fork(self):
+        """Parent and forked child share counters without lost updates."""
+
+        cache = self.make_cache()
+        cache.add('counter', 0)
+        increments = 500
+
+        pid = os.fork()
+
+        if pid == 0:
+            try:
+                for each in range(increments):
+                    cache.incr('counter')
+            finally:
+                os._exit(0)
+
+        for each in range(increments):
+            cache.incr('counter')
+
+        os.waitpid(pid, 0)
+
+        self.assertEqual(cache.get('counter'), 2 * increments)
+
+
+class CountHitTest(SimpleTestCase):
+    """Tests for rate-limit hit counting."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = SharedMemoryCache(os.path.join(self.directory, 'table'),
+                                       {'OPTIONS': {'SLOTS': 64}})
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_sliding_window(self):
+        """Hits of the previous window count by how much still overlaps."""
+
+        def hits_at(now, count=1):
+            with mock.patch.object(ratelimit.time, 'time',
+                                   return_value=now):
+                return [count_hit(self.cache, 'rl:ip:1', 10)
+                        for each in range(count)]
+
+        self.assertEqual(hits_at(1000, 3), [1, 2, 3])
+        # Halfway through the next window, half the previous one counts
+        self.assertEqual(hits_at(1015), [2.5])
+        # Windows before the previous one do not count
+        self.assertEqual(hits_at(1035), [1])
+
+
+class TieredCacheTest(SimpleTestCase):
+    """Tests for the local tier of the tiered cache."""
+
+    def test_local_only(self):
+        """Local copies skip the shared tier and expire on their own."""
+
+        cache = TieredCache('default', {'OPTIONS': {'LOCAL_TIMEOUT': 0.2}})
+
+        with mock.patch.object(TieredCache, 'shared') as shared:
+            cache.set_local('key', 'value')
+            self.assertEqual(cache.get_local('key'), 'value')
+
+            cache.delete_local('key')
+            self.assertIsNone(cache.get_local('key'))
+
+            cache.set_local('key', 'value')
+            time.sleep(0.3)
+            self.assertIsNone(cache.get_local('key'))
+
+        self.assertEqual(shared.mock_calls, [])
+        self.assertEqual(cache.stats()['local_hits'], 1)
+
+
+class SessionStoreTest(TestCase):
+    """Tests for the write-avoiding session engine."""
+
+    def setUp(self):
+        sessions.cache.clear_local()
+
+    def test_local_reads(self):
+        """Sessions saved in this process are read without queries."""
+
+        store = sessions.SessionStore()
+        store['user_id'] = 1
+        store.save()
+
+        with CaptureQueriesContext(connections['default']) as context:
+            self.assertEqual(sessions.SessionStore(store.session_key)[
+                'user_id'], 1)
+
+        self.assertEqual(context.captured_queries, [])
+
+    def test_cycle_key_deletes(self):
+        """Old keys are not served after cycle_key()."""
+
+        store = sessions.SessionStore()
+        store['user_id'] = 1
+        store.save()
+        old_key = store.session_key
+
+        store.cycle_key()
+        store.save()
+
+        self.assertNotIn('user_id', sessions.SessionStore(old_key))
+        self.assertEqual(sessions.SessionStore(store.session_key)[
+            'user_id'], 1)
+
+
+class ReadYourWritesTest(SimpleTestCase):
+    """Tests for carrying read pinning across requests."""
+
+    def setUp(self):
+        self.middleware = routers.ReadYourWritesMiddleware()
+        self.factory = RequestFactory()
+
+    def tearDown(self):
+        routers.reset()
+
+    def test_signed_cookie(self):
+        """Pin cookies set after writes pin the client's next request."""
+
+        request = self.factory.get('/')
+        self.middleware.process_request(request)
+        routers.wrote()
+        response = self.middleware.process_response(request, HttpResponse())
+
+        request = self.factory.get('/')
+        request.COOKIES[routers.READ_YOUR_WRITES_COOKIE] = response.cookies[
+            routers.READ_YOUR_WRITES_COOKIE].value
+        self.middleware.process_request(request)
+
+        self.assertTrue(routers.pinned())
+
+    def test_forged_cookie(self):
+        """Unsigned pin cookies are ignored."""
+
+        request = self.factory.get('/')
+        request.COOKIES[routers.READ_YOUR_WRITES_COOKIE] = str(
+            time.time() + 3600)
+        self.middleware.process_request(request)
+
+        self.assertFalse(routers.pinned())
+
+
+class RoutingMetricsTest(SimpleTestCase):
+    """Tests for exporting routing counters and replica lag."""
+
+    def test_collect(self):
+        """Counts per alias and decision and lag are served as metrics."""
+
+        counters = routers.RoutingCounters()
+        counters.add('authentication_ro', 'reads')
+        counters.add('authentication', 'fallbacks')
+        monitor = routers.ReplicaMonitor(2, 5)
+        monitor.lags['authentication_ro'] = 0.5
+
+        with mock.patch.object(routers, 'counters', counters), \
+                mock.patch.object(routers, 'monitor', monitor):
+            text = metrics.render(*metrics.merge(
+                [json.loads(json.dumps(metrics.Registry().snapshot()))]))
+
+        self.assertIn('notesapp_db_routing_total{alias="authentication_ro",'
+                      'decision="reads"} 1\n', text)
+        self.assertIn('notesapp_db_routing_total{alias="authentication",'
+                      'decision="fallbacks"} 1\n', text)
+        self.assertIn('# TYPE notesapp_replica_lag_seconds gauge\n', text)
+        self.assertIn('notesapp_replica_lag_seconds{alias="authentication_ro"}'
+                      ' 0.500000\n', text)
+
+
+class MetricsTest(SimpleTestCase):
+    """Tests for metric snapshots, their exposition and the middleware."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.patches = [mock.patch.object(metrics, 'METRICS_DIR',
+                                          self.directory)]
+        self.patches[0].start()
+        self.patches.append(mock.patch.object(metrics, 'registry',
+                                              metrics.Registry()))
+        self.patches[1].start()
+
+    def tearDown(self):
+        for patch in reversed(self.patches):
+            patch.stop()
+
+        shutil.rmtree(self.directory)
+
+    def write(self, name, registry):
+        """Writes snapshot of registry to file name in METRICS_DIR."""
+
+        with open(os.path.join(self.directory, name), 'w') as output:
+            json.dump(registry.snapshot(), output)
+
+    def exited_pid(self):
+        """Returns pid of a process that has exited."""
+
+        pid = os.fork()
+
+        if pid == 0:
+            os._exit(0)
+
+        os.waitpid(pid, 0)
+
+        return pid
+
+    def test_render(self):
+        """Snapshots are summed; buckets are cumulative; labels escaped."""
+
+        labels = (('view', 'say "hi"\n'),)
+        first = metrics.Registry()
+        first.observe('notesapp_request_seconds', labels, 0.001)
+        first.observe('notesapp_request_seconds', labels, 0.3)
+        first.increment('notesapp_db_queries_total', labels, 2)
+        second = metrics.Registry()
+        second.observe('notesapp_request_seconds', labels, 20)
+        second.increment('notesapp_db_queries_total', labels, 3)
+
+        text = metrics.render(*metrics.merge(
+            json.loads(json.dumps(registry.snapshot())) for registry in
+            (first, second)))
+        label = 'view="say \\"hi\\"\\n"'
+
+        self.assertIn('# TYPE notesapp_request_seconds histogram\n', text)
+        self.assertIn('notesapp_request_seconds_bucket{%s,le="0.005"} 1\n'
+                      % label, text)
+        self.assertIn('notesapp_request_seconds_bucket{%s,le="0.5"} 2\n'
+                      % label, text)
+        self.assertIn('notesapp_request_seconds_bucket{%s,le="10"} 2\n'
+                      % label, text)
+        self.assertIn('notesapp_request_seconds_bucket{%s,le="+Inf"} 3\n'
+                      % label, text)
+        self.assertIn('notesapp_request_seconds_sum{%s} 20.301000\n'
+                      % label, text)
+        self.assertIn('notesapp_request_seconds_count{%s} 3\n' % label, text)
+        self.assertIn('# TYPE notesapp_db_queries_total counter\n', text)
+        self.assertIn('notesapp_db_queries_total{%s} 5\n' % label, text)
+
+    def test_retire_exited(self):
+        """Snapshots of exited processes are folded into one file."""
+
+        labels = (('view', 'Login'),)
+        exited = metrics.Registry()
+        exited.increment('notesapp_db_queries_total', labels, 2)
+        retired = metrics.Registry()
+        retired.increment('notesapp_db_queries_total', labels, 3)
+        metrics.registry.increment('notesapp_db_queries_total', labels, 4)
+        self.write('%d-1.json' % self.exited_pid(), exited)
+        self.write(metrics.RETIRED_FILE, retired)
+
+        text = metrics.render_all()
+
+        self.assertIn('notesapp_db_queries_total{view="Login"} 9\n', text)
+        self.assertEqual(sorted(os.listdir(self.directory)), sorted([
+            metrics.RETIRED_FILE, os.path.basename(metrics.registry.path)]))
+        self.assertEqual(metrics.render_all(), text)
+
+    def test_middleware(self):
+        """Queries of a request are counted per view and alias."""
+
+        def view(request):
+            cursor = connections['default'].cursor()
+            cursor.execute('SELECT 1')
+            cursor.execute('SELECT 2')
+
+            return HttpResponse()
+
+        middleware = metrics.MetricsMiddleware()
+        request = RequestFactory().get('/')
+
+        middleware.process_request(request)
+        middleware.process_view(request, view, (), {})
+        middleware.process_response(request, view(request))
+
+        # Queries outside requests are not counted
+        connections['default'].cursor().execute('SELECT 3')
+
+        series = metrics.registry.snapshot()
+        labels = [['view', 'view'], ['alias', 'default']]
+
+        self.assertIn(['notesapp_db_queries_total', labels, 2],
+                      [[metric, [list(pair) for pair in pairs], value] for
+                       metric, pairs, value in series['counters']])
+        self.assertIn('notesapp_request_seconds',
+                      [metric for metric, pairs, values in
+                       series['histograms']])
+        self.assertFalse(connections['default'].use_debug_cursor)
+
+    @override_settings(METRICS_TOKEN='secret')
+    def test_view_token(self):
+        """Metrics are only served to requests bearing the token."""
+
+        factory = RequestFactory()
+        view = MetricsView.as_view()
+
+        for header in (None, 'Bearer wrong', 'Basic secret', 'secret'):
+            extra = {'HTTP_AUTHORIZATION': header} if header else {}
+
+            self.assertRaises(Http404, view, factory.get('/', **extra))
+
+        response = view(factory.get('/', HTTP_AUTHORIZATION='Bearer secret'))
+
+        self.assertEqual(response.status_code, 200)
+
+    @override_settings(METRICS_TOKEN=None)
+    def test_view_without_token(self):
+        """Nothing is served while no token is configured."""
+
+        self.assertRaises(Http404, MetricsView.as_view(), RequestFactory().get(
+            '/', HTTP_AUTHORIZATION='Bearer None'))
+
+
+class FakeConnection(object):
+    """Stands in for a psycopg2 connection in pool tests."""
+
+    def __init__(self):
+        self.closed = 0
+        self.status = psycopg2.extensions.TRANSACTION_STATUS_IDLE
+        self.broken = False
+        self.pings = 0
+
+    def get_transaction_status(self):
+        return self.status
+
+    def rollback(self):
+        self.status = psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+    def close(self):
+        self.closed = 1
+
+    def cursor(self):
+        return FakeCursor(self)
+
+
+class FakeCursor(object):
+    """Cursor of a FakeConnection; fails if the connection is broken."""
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def execute(self, sql):
+        self.connection.pings += 1
+
+        if self.connection.broken:
+            raise Database.OperationalError('server closed the connection')
+
+    def close(self):
+        pass
+
+
+class ConnectionPoolTest(SimpleTestCase):
+    """Tests for pooled PostgreSQL connections."""
+
+    def make_pool(self, size=2, check_idle=30):
+        """Returns pool and list of connections it opened."""
+
+        pool = ConnectionPool(size, 0.1, check_idle)
+        opened = []
+
+        def connect():
+            opened.append(FakeConnection())
+            return opened[-1]
+
+        return pool, opened, lambda: pool.checkout(connect)
+
+    def test_cap(self):
+        """Checkouts past the size wait, then fail; checkins are reused."""
+
+        pool, opened, checkout = self.make_pool()
+        first = checkout()
+        checkout()
+
+        self.assertRaises(Database.OperationalError, checkout)
+
+        pool.checkin(first)
+
+        self.assertIs(checkout(), first)
+        self.assertEqual(len(opened), 2)
+        self.assertEqual(pool.snapshot()['timeouts'], 1)
+
+    def test_checkin_rolls_back(self):
+        """Connections returned mid-transaction are rolled back."""
+
+        pool, opened, checkout = self.make_pool()
+        connection = checkout()
+        connection.status = psycopg2.extensions.TRANSACTION_STATUS_INTRANS
+
+        pool.checkin(connection)
+
+        self.assertEqual(connection.status,
+                         psycopg2.extensions.TRANSACTION_STATUS_IDLE)
+        self.assertIs(checkout(), connection)
+
+    def test_checkout_discards_broken(self):
+        """Broken idle connections are replaced in their own slot."""
+
+        pool, opened, checkout = self.make_pool(size=1)
+        connection = checkout()
+        pool.checkin(connection)
+        connection.closed = 1
+
+        replacement = checkout()
+        snapshot = pool.snapshot()
+
+        self.assertIsNot(replacement, connection)
+        self.assertEqual((snapshot['open'], snapshot['in_use']), (1, 1))
+        self.assertEqual(snapshot['discarded'], 1)
+        self.assertRaises(Database.OperationalError, checkout)
+
+    def test_checkout_pings_idle(self):
+        """Connections idle past CHECK_IDLE must answer a ping."""
+
+        pool, opened, checkout = self.make_pool(check_idle=0)
+        connection = checkout()
+        pool.checkin(connection)
+        connection.broken = True
+
+        self.assertIsNot(checkout(), connection)
+        self.assertEqual(connection.pings, 1)
+        self.assertTrue(connection.closed)
+
+    def test_checkin_after_errors(self):
+        """Connections with errors go back only if they answer a ping."""
+
+        pool, opened, checkout = self.make_pool()
+        usable, broken = checkout(), checkout()
+        broken.broken = True
+
+        pool.checkin(usable, errors_occurred=True)
+        pool.checkin(broken, errors_occurred=True)
+        snapshot = pool.snapshot()
+
+        self.assertEqual((usable.pings, broken.pings), (1, 1))
+        self.assertTrue(broken.closed)
+        self.assertEqual((snapshot['open'], snapshot['in_use'],
+                          snapshot['idle']), (1, 0, 1))
+        self.assertIs(checkout(), usable)
+
+    def test_metrics(self):
+        """Pool usage is served with the other metrics, per alias."""
+
+        pool, opened, checkout = self.make_pool()
+        registry = pool_base.PoolRegistry()
+        registry.pools[('default', 'notes', '', '', '')] = pool
+        checkout()
+        checkout()
+        self.assertRaises(Database.OperationalError, checkout)
+
+        with mock.patch.object(pool_base, 'pools', registry):
+            text = metrics.render(*metrics.merge(
+                [json.loads(json.dumps(metrics.Registry().snapshot()))]))
+
+        self.assertIn('# TYPE notesapp_db_pool_timeouts_total counter\n',
+                      text)
+        self.assertIn('notesapp_db_pool_timeouts_total{alias="default"} 1\n',
+                      text)
+        self.assertIn('notesapp_db_pool_connections{alias="default",'
+                      'state="in_use"} 2\n', text)
+        self.assertIn('notesapp_db_pool_utilization{alias="default"} '
+                      '1.000000\n', text)
+        self.assertIn('notesapp_db_pool_wait_seconds_total{alias="default"}',
+                      text)
@@ -0,0 +1,170 @@
+"""Coalesced writes of last-access and last-used timestamps.
+
+Writing Users.last_access and Methods.last_used on every login costs a
+row update each time. With COALESCE_ACCESS_WRITES enabled, the latest
+timestamp of each row is instead kept in this process's memory. Pending
+rows are written at most ACCESS_WRITE_STALENESS seconds after the first
+pending record, at the end of a request once that bound has passed, and
+when the process exits. Each flush sets a model's timestamps with one
+UPDATE ... CASE statement per ACCESS_UPDATE_CHUNK rows, in a single
+transaction. Updates touch only the timestamp column, so auto_now
+columns are left alone.
+
+Timestamps read from the database may therefore lag by up to the
+staleness bound, or be lost if the process is killed before a flush.
+"""
+
+import atexit
+import threading
+import time
+import logging
+from django.conf import settings
+from django.core.signals import request_finished
+from django.db import connections, router, transaction
+from django.dispatch import receiver
+
+logger = logging.getLogger(__name__)
+
+# Rows per UPDATE; three parameters each stay under SQLite's limit of 999
+ACCESS_UPDATE_CHUNK = 300
+
+
+def update_timestamps_sql(model, field, count, connection):
+    """Returns UPDATE setting a timestamp field of count rows.
+
+    Parameters are each row's primary key and timestamp, then the
+    primary keys again. Timestamps are bound untyped, so PostgreSQL would
+    type the CASE as text and refuse to assign it to the column; they are
+    cast to the column type. SQLite gives a datetime cast numeric
+    affinity, so there they are left as bound.
+
+    Args:
+        model: model class of the rows.
+        field: name of the timestamp field.
+        count: number of rows.
+        connection: connection the statement runs on.
+    """
+
+    quote_name = connection.ops.quote_name
+    field_object = model._meta.get_field(field)
+    pk_column = quote_name(model._meta.pk.column)
+    value = '%s'
+
+    if connection.vendor != 'sqlite':
+        value = 'CAST(%%s AS %s)' % field_object.db_type(connection)
+
+    return 'UPDATE %s SET %s = CASE %s %s END WHERE %s IN (%s)' % (
+        quote_name(model._meta.db_table), quote_name(field_object.column),
+        pk_column, ' '.join(['WHEN %s THEN ' + value] * count), pk_column,
+        ', '.join(['%s'] * count))
+
+
+def update_timestamps(model, field, timestamps, using):
+    """Sets a timestamp field of many rows with one UPDATE.
+
+    Args:
+        model: model class of the rows.
+        field: name of the timestamp field.
+        timestamps: list of (primary key, timestamp) tuples.
+        using: database alias to write to.
+    """
+
+    connection = connections[using]
+    field_object = model._meta.get_field(field)
+    params = []
+
+    for pk, when in timestamps:
+        params.extend((pk, field_object.get_db_prep_value(when, connection)))
+
+    params.extend(pk for pk, when in timestamps)
+
+    connection.cursor().execute(update_timestamps_sql(
+        model, field, len(timestamps), connection), params)
+
+
+class AccessBuffer(object):
+    """Holds the latest pending timestamp of each row in memory."""
+
+    def __init__(self, enabled, staleness):
+        self.enabled = enabled
+        self.staleness = staleness
+        self.pending = dict() # (model, field) to dict of pk to timestamp
+        self.oldest = None
+        self.lock = threading.Lock()
+
+    def record(self, model, pk, field, when):
+        """Records timestamp for a row, flushing if the bound passed.
+
+        Args:
+            model: model class of the row.
+            pk: primary key of the row.
+            field: name of the timestamp field.
+            when: timestamp to write.
+        """
+
+        with self.lock:
+            timestamps = self.pending.setdefault((model, field), dict())
+
+            if pk not in timestamps or timestamps[pk] < when:
+                timestamps[pk] = when
+
+            if self.oldest is None:
+                self.oldest = time.time()
+
+        self.flush_if_stale()
+
+    def flush_if_stale(self):
+        """Flushes if the oldest pending record passed the bound."""
+
+        oldest = self.oldest
+
+        if oldest is not None and time.time() - oldest >= self.staleness:
+            self.flush()
+
+    def flush(self):
+        """Writes all pending timestamps to the database."""
+
+        with self.lock:
+            pending = self.pending
+            self.pending = dict()
+            self.oldest = None
+
+        for (model, field), timestamps in pending.items():
+            using = router.db_for_write(model)
+            timestamps = sorted(timestamps.items())
+
+            with transaction.atomic(using=using):
+                for start in range(0, len(timestamps), ACCESS_UPDATE_CHUNK):
+                    update_timestamps(model, field, timestamps[
+                        start:start + ACCESS_UPDATE_CHUNK], using)
+
+            logger.debug('Flushed %d %s.%s timestamps', len(timestamps),
+                         model._meta.db_table, field)
+
+
+buffer = AccessBuffer(getattr(settings, 'COALESCE_ACCESS_WRITES', False),
+                      getattr(settings, 'ACCESS_WRITE_STALENESS', 60))
+
+
+def record(model, pk, field, when):
+    """Records timestamp through the default buffer. See AccessBuffer."""
+
+    buffer.record(model, pk, field, when)
+
+
+@receiver(request_finished)
+def flush_after_request(sender, **kwargs):
+    """Flushes idle workers once the staleness bound has passed."""
+
+    buffer.flush_if_stale()
+
+
+@atexit.register
+def flush_on_exit():
+    """Flushes pending timestamps when the process shuts down."""
+
+    if buffer.pending:
+        try:
+            buffer.flush()
+        except Exception:
+            logger.exception('Could not flush access timestamps on exit.')
@@ -0,0 +1,191 @@
+"""Fast username and email availability checks.
+
+Each process keeps Bloom filters of taken usernames and emails. A name
+missing from the filter is available and costs no query; a name found
+in the filter is checked against the database, so false positives and
+names freed by a rename are still reported available.
+
+Filters are built on first use, updated as users are created or
+renamed in this process and rebuilt every AVAILABILITY_FILTER_REFRESH
+seconds. Until then a name taken by a user created in another process
+may be reported available; creation still checks the database, so this
+only affects the advisory backend views. Renames, which are rare, also
+bump a version stamp in the cache; each process compares its filters
+against the stamp at most every AVAILABILITY_FILTER_CHECK_INTERVAL
+seconds and rebuilds them when it changed.
+"""
+
+import threading
+import time
+import uuid
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+
+from common.bloom import BloomFilter
+from authentication.models import Users
+
+VERSION_KEY = 'availability-version'
+
+MIN_CAPACITY = 10000 # Smallest filter built, in users
+CAPACITY_FACTOR = 2 # Headroom for users added between rebuilds
+ERROR_RATE = 0.01 # Share of free names that cost a query
+
+
+class AvailabilityFilter(object):
+    """Pair of Bloom filters for taken usernames and emails."""
+
+    def __init__(self, refresh, check_interval):
+        self.refresh = refresh
+        self.check_interval = check_interval
+        self.usernames = None
+        self.emails = None
+        self.version = None
+        self.built = 0
+        self.checked = 0
+        self.lock = threading.Lock()
+
+    def build(self, version):
+        """Builds filters from all users in the database.
+
+        Args:
+            version: version stamp read before building.
+        """
+
+        capacity = max(Users.users.count() * CAPACITY_FACTOR, MIN_CAPACITY)
+        usernames = BloomFilter(capacity, ERROR_RATE)
+        emails = BloomFilter(capacity, ERROR_RATE)
+
+        rows = Users.users.values_list('username_lower', 'email_lower')
+
+        for username_lower, email_lower in rows.iterator():
+            if username_lower:
+                usernames.add(username_lower)
+            if email_lower:
+                emails.add(email_lower)
+
+        self.usernames = usernames
+        self.emails = emails
+        self.version = version
+        self.built = time.time()
+
+    def stale(self):
+        """Returns true if filters must be rebuilt before use."""
+
+        return self.usernames is None or \
+            time.time() - self.built >= self.refresh or \
+            self.usernames.saturated()
+
+    def ensure_built(self):
+        """Builds filters if missing, stale, overfilled or outdated.
+
+        While one thread rebuilds, others keep using the old filters.
+        """
+
+        if self.usernames is not None and not self.stale() and \
+                time.time() - self.checked < self.check_interval:
+            return
+
+        if self.usernames is None:
+            self.lock.acquire()
+        elif not self.lock.acquire(False):
+            return
+
+        try:
+            # Another thread may have built while we waited
+            if self.usernames is not None and not self.stale() and \
+                    time.time() - self.checked < self.check_interval:
+                return
+
+            version = cache.get(VERSION_KEY)
+
+            if version is None:
+                version = bump_version()
+
+            if self.stale() or version != self.version:
+                self.build(version)
+
+            self.checked = time.time()
+        finally:
+            self.lock.release()
+
+    def add_users(self, user_objects):
+        """Adds users to this process's filters if they have been built.
+
+        Args:
+            user_objects: iterable of created or renamed users.
+        """
+
+        usernames, emails = self.usernames, self.emails
+
+        if usernames is None:
+            return
+
+        for user_object in user_objects:
+            usernames.add(user_object.username.lower())
+            emails.add(user_object.email.lower())
+
+    def username_available(self, username):
+        """Checks to see if username is available.
+
+        Args:
+            username: username to test, can be any case.
+
+        Returns:
+            Bool; true if available, false if taken.
+        """
+
+        self.ensure_built()
+
+        if username.lower() not in self.usernames:
+            return True
+
+        return not Users.users.user_exists(username)
+
+    def email_available(self, email):
+        """Checks to see if email is available.
+
+        Args:
+            email: email to test, can be any case.
+
+        Returns:
+            Bool; true if available, false if taken.
+        """
+
+        self.ensure_built()
+
+        if email.lower() not in self.emails:
+            return True
+
+        return not Users.users.email_exists(email)
+
+
+def bump_version():
+    """Sets a new version stamp so all processes rebuild filters."""
+
+    version = uuid.uuid4().hex
+    cache.set(VERSION_KEY, version, None)
+
+    return version
+
+
+filters = AvailabilityFilter(
+    getattr(settings, 'AVAILABILITY_FILTER_REFRESH', 300),
+    getattr(settings, 'AVAILABILITY_FILTER_CHECK_INTERVAL', 5))
+
+
+@receiver(post_save, sender=Users)
+def add_saved_user(sender, instance, created, update_fields, **kwargs):
+    """Keeps filters current with users created or renamed.
+
+    Only saves naming username or email in update_fields are renames;
+    see Users.modify_info.
+    """
+
+    if created:
+        filters.add_users([instance])
+    elif update_fields is not None and \
+            ('username' in update_fields or 'email' in update_fields):
+        filters.add_users([instance])
+        bump_version()
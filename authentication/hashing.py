@@ -0,0 +1,313 @@
+"""Bcrypt hashing pool for authentication purposes.
+
+Bcrypt is deliberately slow, so hashing inline pins the calling worker
+for the full cost of the hash. All hashing for the project should go
+through hashpw() in this module, which runs the hash in a bounded
+process pool. When the pool and its queue are full, hashpw() raises a
+UserError immediately rather than piling up more requests.
+
+Pool size, queue depth and timeout are defined in settings:
+    HASH_POOL_WORKERS: number of hashing processes; 0 hashes inline.
+    HASH_POOL_QUEUE_DEPTH: calls allowed to wait for a free process.
+    HASH_POOL_TIMEOUT: seconds to wait for a result before giving up.
+
+Timings for every call are kept in stats and logged at debug level so
+pool size may be matched against login traffic.
+"""
+
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+import threading
+import time
+import logging
+import bcrypt
+from django.conf import settings
+
+from errors.exceptions import UserError
+from Notesapp import metrics
+
+logger = logging.getLogger(__name__)
+
+# Pseudo-function to trick makemessages into making message files
+_ = lambda s: s
+
+HASHING_BUSY = _('hashing-busy')
+HASHING_TIMEOUT = _('hashing-timeout')
+
+
+def _timed_hashpw(password, salt):
+    """Hashes password and times it. Runs inside the pool processes.
+
+    Returns:
+        Tuple of hash and seconds spent hashing.
+    """
+
+    start = time.time()
+    hashed = bcrypt.hashpw(password, salt)
+
+    return hashed, time.time() - start
+
+
+class HashStats(object):
+    """Per-process timing statistics for hashing calls.
+
+    Attributes:
+        calls: number of completed calls.
+        rejected: number of calls refused because the pool was full.
+        hash_time: total seconds spent inside bcrypt.
+        wait_time: total seconds spent waiting for a free process.
+        max_time: longest single call, including waiting.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Resets all counters to zero."""
+
+        self.calls = 0
+        self.rejected = 0
+        self.hash_time = 0.0
+        self.wait_time = 0.0
+        self.max_time = 0.0
+
+    def record(self, hash_time, total_time):
+        """Records a completed call."""
+
+        with self.lock:
+            self.calls += 1
+            self.hash_time += hash_time
+            self.wait_time += max(total_time - hash_time, 0.0)
+            self.max_time = max(self.max_time, total_time)
+
+    def reject(self):
+        """Records a call refused by admission control."""
+
+        with self.lock:
+            self.rejected += 1
+
+    def snapshot(self):
+        """Returns dict of current counters."""
+
+        with self.lock:
+            return {
+                'calls': self.calls,
+                'rejected': self.rejected,
+                'hash_time': self.hash_time,
+                'wait_time': self.wait_time,
+                'max_time': self.max_time,
+            }
+
+
+class HashPool(object):
+    """Bounded process pool for bcrypt with admission control.
+
+    At most workers + queue_depth calls may be in flight at once; any
+    call past that is rejected with HASHING_BUSY instead of queueing.
+    Calls that time out stay in flight until their hash finishes. Batch
+    hashes count against the same limit, and at most batch_limit of them
+    are in flight at once.
+    """
+
+    def __init__(self, workers, queue_depth, timeout):
+        self.workers = workers
+        self.queue_depth = queue_depth
+        self.timeout = timeout
+        self.stats = HashStats()
+        self._executor = None
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(workers + queue_depth)
+        # Batches may use at most half the processes
+        self.batch_limit = max(workers // 2, 1)
+        self._batch_slots = threading.BoundedSemaphore(self.batch_limit)
+
+    def _get_executor(self):
+        """Lazily creates the process pool.
+
+        Created on first use so that forking WSGI servers do not share
+        pool processes between workers.
+        """
+
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(self.workers)
+
+            return self._executor
+
+    def hashpw(self, password, salt):
+        """Hashes password with salt in the pool.
+
+        Args:
+            password: bytes to hash.
+            salt: bcrypt salt or existing hash to compare against.
+
+        Returns:
+            Hashed password as bytes.
+
+        Raises:
+            UserError: if the pool is saturated or the call times out.
+        """
+
+        start = time.time()
+
+        if not self.workers:
+            hashed, hash_time = _timed_hashpw(password, salt)
+            self._record(hash_time, time.time() - start)
+            return hashed
+
+        if not self._slots.acquire(False):
+            self.stats.reject()
+            logger.warning('Hash pool saturated; rejecting call.')
+            raise UserError(HASHING_BUSY)
+
+        try:
+            future = self._get_executor().submit(_timed_hashpw, password,
+                                                 salt)
+        except Exception:
+            self._slots.release()
+            raise
+
+        # A timed out hash may still be running, so its slot is only
+        # freed once the future finishes
+        future.add_done_callback(lambda future: self._slots.release())
+
+        try:
+            hashed, hash_time = future.result(self.timeout)
+        except TimeoutError:
+            future.cancel()
+            logger.error('Hash pool call timed out.')
+            raise UserError(HASHING_TIMEOUT)
+
+        self._record(hash_time, time.time() - start)
+
+        return hashed
+
+    def hashpw_many(self, passwords, salts):
+        """Hashes several passwords in parallel across the pool.
+
+        Meant for administrative batch work. Each hash takes a slot like
+        a hashpw() call, waiting for one rather than being rejected, and
+        at most batch_limit hashes are in flight, so logins keep the
+        remaining processes and never queue behind a whole batch.
+
+        Args:
+            passwords: list of bytes to hash.
+            salts: list of salts, one per password.
+
+        Returns:
+            List of hashed passwords in the same order.
+
+        Raises:
+            TimeoutError: if a slot or a hash takes longer than the
+                pool timeout.
+        """
+
+        start = time.time()
+
+        if not self.workers:
+            results = [_timed_hashpw(password, salt)
+                       for password, salt in zip(passwords, salts)]
+        else:
+            results = self._hash_batch(passwords, salts)
+
+        total_time = time.time() - start
+
+        for hashed, hash_time in results:
+            self._record(hash_time, total_time / max(len(results), 1))
+
+        return [hashed for hashed, hash_time in results]
+
+    def _hash_batch(self, passwords, salts):
+        """Submits batch hashes as slots free up and collects them.
+
+        Returns:
+            List of (hash, seconds hashing) tuples in the same order.
+        """
+
+        futures = []
+
+        try:
+            for password, salt in zip(passwords, salts):
+                if not self._batch_slots.acquire(timeout=self.timeout):
+                    raise TimeoutError()
+
+                if not self._slots.acquire(timeout=self.timeout):
+                    self._batch_slots.release()
+                    raise TimeoutError()
+
+                try:
+                    future = self._get_executor().submit(_timed_hashpw,
+                                                         password, salt)
+                except Exception:
+                    self._slots.release()
+                    self._batch_slots.release()
+                    raise
+
+                future.add_done_callback(self._release_batch_slot)
+                futures.append(future)
+
+            return [future.result(self.timeout) for future in futures]
+        except TimeoutError:
+            for future in futures:
+                future.cancel()
+
+            logger.error('Hash pool batch of %d timed out.', len(passwords))
+            raise
+
+    def _release_batch_slot(self, future):
+        """Frees the slots held by a finished batch hash."""
+
+        self._slots.release()
+        self._batch_slots.release()
+
+    def _record(self, hash_time, total_time):
+        """Stores and logs timing for a completed call."""
+
+        self.stats.record(hash_time, total_time)
+        metrics.record('bcrypt', total_time)
+        logger.debug('bcrypt call: %.1fms hashing, %.1fms total',
+                     hash_time * 1000, total_time * 1000)
+
+    def shutdown(self):
+        """Shuts down pool processes, if any were started."""
+
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
+
+pool = HashPool(getattr(settings, 'HASH_POOL_WORKERS', 2),
+                getattr(settings, 'HASH_POOL_QUEUE_DEPTH', 8),
+                getattr(settings, 'HASH_POOL_TIMEOUT', 10))
+
+
+def hashpw(password, salt):
+    """Hashes password through the default pool. See HashPool.hashpw."""
+
+    return pool.hashpw(password, salt)
+
+
+def hashpw_many(passwords, salts):
+    """Hashes many passwords through the default pool.
+
+    See HashPool.hashpw_many.
+    """
+
+    return pool.hashpw_many(passwords, salts)
+
+
+def get_rounds(hashed):
+    """Returns the cost factor a bcrypt hash was created with.
+
+    Args:
+        hashed: bcrypt hash as bytes, i.e. b'$2a$13$...'.
+
+    Returns:
+        Integer cost, or None if the hash is not in bcrypt format.
+    """
+
+    try:
+        return int(hashed.split(b'$')[2])
+    except (IndexError, ValueError):
+        return None
@@ -1,7 +1,29 @@
 """Defines helper functions for authentication purposes."""
+import hashlib
+import os
 import random
 import string
 
 def random_string(size=10, chars=string.ascii_letters + string.digits):
     """Generates a random string of given size and character set"""
-    return ''.join(random.choice(chars) for i in range(size))
\ No newline at end of file
+    return ''.join(random.choice(chars) for i in range(size))
+
+def random_strings(count, size=10, chars=string.ascii_letters + string.digits):
+    """Generates count random strings from the OS CSPRNG.
+
+    Reads random bytes in bulk and keeps only bytes below the largest
+    multiple of len(chars), so every character is equally likely.
+    """
+    limit = 256 - 256 % len(chars)
+    needed = count * size
+    picked = []
+    while len(picked) < needed:
+        picked.extend(chars[byte % len(chars)] for byte in
+                      bytearray(os.urandom(needed - len(picked) + 16))
+                      if byte < limit)
+    picked = ''.join(picked[:needed])
+    return [picked[i:i + size] for i in range(0, needed, size)]
+
+def digest_token(token):
+    """Returns fixed-width SHA-256 hex digest of token for lookups"""
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
\ No newline at end of file
@@ -0,0 +1 @@
+"""Management commands for authentication."""
\ No newline at end of file
@@ -0,0 +1,75 @@
+"""Benchmarks one-at-a-time against batched token generation."""
+
+from optparse import make_option
+import time
+from django.core.management.base import BaseCommand
+from django.db import router, transaction
+
+from authentication.models import Tokens, TOKEN_NEW_USER
+
+
+class Rollback(Exception):
+    """Raised to roll back benchmark database writes."""
+
+
+class Command(BaseCommand):
+    """Measures tokens per second for TokenManager generation paths.
+
+    Reports for:
+        generate: one Tokens.objects.generate call per token.
+        generate_many: Tokens.objects.generate_many in --batch-size
+            batches.
+
+    Tokens created are rolled back after each scenario.
+    """
+
+    help = 'Benchmarks token generation one at a time and in batches.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--tokens', type='int', dest='tokens', default=2000,
+                    help='Tokens generated per scenario.'),
+        make_option('--batch-size', type='int', dest='batch_size',
+                    default=1000, help='Tokens per generate_many call.'),
+    )
+
+    def handle(self, *args, **options):
+        count = options['tokens']
+        batch_size = options['batch_size']
+
+        def one_at_a_time():
+            for each in range(count):
+                Tokens.objects.generate(TOKEN_NEW_USER)
+
+        def batched():
+            for offset in range(0, count, batch_size):
+                Tokens.objects.generate_many(TOKEN_NEW_USER,
+                                             min(batch_size, count - offset))
+
+        self.report('generate', count, self.run(one_at_a_time))
+        self.report('generate_many', count, self.run(batched))
+
+    def run(self, scenario):
+        """Runs scenario in a rolled back transaction.
+
+        Returns:
+            Seconds taken by the scenario.
+        """
+
+        elapsed = 0
+
+        try:
+            with transaction.atomic(using=router.db_for_write(Tokens)):
+                start = time.time()
+                scenario()
+                elapsed = time.time() - start
+                raise Rollback()
+        except Rollback:
+            pass
+
+        return elapsed
+
+    def report(self, name, count, elapsed):
+        """Writes rate for a scenario."""
+
+        self.stdout.write('%-16s %6d tokens %8.3fs %10.1f tokens/s' % (
+            name, count, elapsed, count / elapsed if elapsed else 0))
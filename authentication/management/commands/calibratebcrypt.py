@@ -0,0 +1,85 @@
+"""Measures bcrypt on this host and recommends a cost factor."""
+
+from optparse import make_option
+import time
+import bcrypt
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+
+MIN_ROUNDS = 4 # Lowest cost bcrypt accepts
+MAX_ROUNDS = 20
+
+
+class Command(BaseCommand):
+    """Times bcrypt.hashpw for increasing costs on the current host.
+
+    Picks the highest cost whose median hashing time fits within the
+    target latency and prints the BCRYPT_ROUNDS setting to use. Stored
+    hashes using another cost are rehashed as their users log in.
+    """
+
+    help = 'Picks the bcrypt cost that fits a target hashing latency.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--target', type='int', dest='target', default=250,
+                    help='Target hashing time in milliseconds.'),
+        make_option('--samples', type='int', dest='samples', default=5,
+                    help='Number of hashes timed per cost.'),
+        make_option('--min-rounds', type='int', dest='min_rounds',
+                    default=10, help='Lowest cost to consider.'),
+    )
+
+    def handle(self, *args, **options):
+        target = options['target'] / 1000.0
+        samples = options['samples']
+        rounds = options['min_rounds']
+
+        if samples < 1:
+            raise CommandError('At least one sample is required.')
+
+        if not MIN_ROUNDS <= rounds <= MAX_ROUNDS:
+            raise CommandError('Minimum rounds must be between %d and %d.' %
+                               (MIN_ROUNDS, MAX_ROUNDS))
+
+        chosen = None
+
+        while rounds <= MAX_ROUNDS:
+            median = self.measure(rounds, samples)
+
+            self.stdout.write('cost %2d: %8.1fms' % (rounds, median * 1000))
+
+            if median > target:
+                break
+
+            chosen = rounds
+
+            # Each additional round doubles cost; stop if next can't fit
+            if median * 2 > target:
+                break
+
+            rounds += 1
+
+        if chosen is None:
+            raise CommandError('No cost from %d fits within %dms.' %
+                               (options['min_rounds'], options['target']))
+
+        current = getattr(settings, 'BCRYPT_ROUNDS', None)
+
+        self.stdout.write('Current setting: BCRYPT_ROUNDS = %s' % current)
+        self.stdout.write('Recommended:     BCRYPT_ROUNDS = %d' % chosen)
+
+    def measure(self, rounds, samples):
+        """Returns median seconds taken to hash at given cost."""
+
+        password = b'calibration-password'
+        salt = bcrypt.gensalt(rounds)
+        timings = []
+
+        for i in range(samples):
+            start = time.time()
+            bcrypt.hashpw(password, salt)
+            timings.append(time.time() - start)
+
+        timings.sort()
+
+        return timings[len(timings) // 2]
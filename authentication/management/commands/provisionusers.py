@@ -0,0 +1,93 @@
+"""Creates users in bulk from a CSV or JSON roster."""
+
+from optparse import make_option
+import csv
+import json
+import logging
+import time
+from django.core.management.base import BaseCommand, CommandError
+
+from authentication.models import Users
+
+logger = logging.getLogger(__name__)
+
+# Roster columns passed on to UserManager.create_bulk
+ROSTER_FIELDS = ('username', 'first_name', 'last_name', 'email', 'password')
+
+
+class Command(BaseCommand):
+    """Provisions a roster of users, e.g. a whole classroom at once.
+
+    The roster is either a CSV file with a header row naming the
+    columns in ROSTER_FIELDS, or a JSON file holding a list of objects
+    with those keys. Empty values are dropped so optional columns may
+    be left blank. Rows are created --batch-size at a time; every row
+    gets a line in the report, with its errors if it was not created.
+    """
+
+    args = '<roster.csv|roster.json>'
+    help = 'Creates users in bulk from a CSV or JSON roster.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', dest='batch_size',
+                    default=500, help='Rows created per batch.'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Expected path of a single roster file.')
+
+        rows = self.read_roster(args[0])
+        batch_size = options['batch_size']
+        start = time.time()
+        created = 0
+
+        for offset in range(0, len(rows), batch_size):
+            reports = Users.users.create_bulk(
+                rows[offset:offset + batch_size])
+
+            for report in reports:
+                line = offset + report['row'] + 1
+
+                if report['created']:
+                    created += 1
+                    self.stdout.write('%d: created %s' % (
+                        line, report['username']))
+                else:
+                    self.stdout.write('%d: skipped %s (%s)' % (
+                        line, report['username'],
+                        ', '.join(report['errors'])))
+
+        logger.info('Provisioned %d of %d users in %.1fs.', created,
+                    len(rows), time.time() - start)
+        self.stdout.write('Created %d of %d users in %.1fs.' % (
+            created, len(rows), time.time() - start))
+
+    def read_roster(self, path):
+        """Reads roster file into list of user info dicts.
+
+        Args:
+            path: path of a .json file, or of a CSV file otherwise.
+
+        Returns:
+            List of dicts holding non-empty ROSTER_FIELDS values.
+
+        Raises:
+            CommandError: if the file can't be read or parsed.
+        """
+
+        try:
+            with open(path, newline='') as roster:
+                if path.lower().endswith('.json'):
+                    records = json.load(roster)
+                else:
+                    records = list(csv.DictReader(roster))
+        except (IOError, ValueError, csv.Error) as error:
+            raise CommandError('Could not read roster: %s' % error)
+
+        if not isinstance(records, list):
+            raise CommandError('Roster must hold a list of users.')
+
+        return [dict((field, record[field]) for field in ROSTER_FIELDS
+                     if record.get(field))
+                for record in records]
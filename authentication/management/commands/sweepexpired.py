@@ -0,0 +1,117 @@
+"""Deletes expired authentication rows, sessions and mail in batches."""
+
+from optparse import make_option
+import datetime
+import json
+import logging
+import time
+import pytz
+from django.conf import settings
+from django.contrib.sessions.models import Session
+from django.core.management.base import BaseCommand
+from django.db import router
+from django.db.models import Q
+
+import meta.models
+from Notesapp import routers
+from outbox.models import Messages, STATUS_SENT, STATUS_FAILED
+from authentication.models import Methods, Tokens, DIGESTED_METHODS,\
+    METHOD_INACTIVE
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    """Sweeps dead rows that slow down index scans as they pile up.
+
+    Removes the following in batches of --batch-size rows, sleeping
+    --sleep seconds between batches so the primary is not saturated:
+        methods: validation and recovery tokens that are inactive or
+            past expiration, on every shard if methods are sharded.
+        tokens: system tokens that are exhausted or past expiration.
+        sessions: sessions past their expiry date.
+        outbox: sent and permanently failed messages last attempted
+            more than OUTBOX_RETENTION days ago.
+
+    Rows removed per run are logged, written to stdout and stored in
+    the 'last-sweep' meta data row. Meant to be scheduled with cron.
+    """
+
+    help = 'Deletes expired tokens, methods, sessions and mail in batches.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', dest='batch_size',
+                    default=1000, help='Rows deleted per batch.'),
+        make_option('--sleep', type='float', dest='sleep', default=0.5,
+                    help='Seconds to wait between batches.'),
+    )
+
+    def handle(self, *args, **options):
+        now = datetime.datetime.now(pytz.utc)
+        start = time.time()
+
+        methods = Methods.objects.filter(
+            Q(status=METHOD_INACTIVE) | Q(expiration__lt=now),
+            method__in=DIGESTED_METHODS)
+
+        # Sharded methods are swept on every shard
+        if routers.sharded(Methods):
+            methods = [methods.using(alias)
+                       for alias in settings.SHARD_DATABASES]
+        else:
+            methods = [methods]
+
+        targets = (
+            ('methods', methods),
+            ('tokens', [Tokens.objects.filter(
+                Q(exhausted=True) | Q(expiration__lt=now))]),
+            ('sessions', [Session.objects.filter(expire_date__lt=now)]),
+            ('outbox', [Messages.objects.filter(
+                status__in=(STATUS_SENT, STATUS_FAILED),
+                next_attempt__lt=now - datetime.timedelta(
+                    days=getattr(settings, 'OUTBOX_RETENTION', 7)))]),
+        )
+
+        removed = dict()
+
+        for name, querysets in targets:
+            removed[name] = sum(self.sweep(queryset, options['batch_size'],
+                                           options['sleep'])
+                                for queryset in querysets)
+            self.stdout.write('%s: %d removed' % (name, removed[name]))
+
+        removed['seconds'] = round(time.time() - start, 3)
+
+        logger.info('Sweep removed %s', removed)
+
+        meta.models.Data.objects.set('last-sweep',
+            sum(removed[name] for name, querysets in targets),
+            json.dumps(removed, sort_keys=True))
+
+    def sweep(self, queryset, batch_size, sleep):
+        """Deletes rows matching queryset one batch at a time.
+
+        Returns:
+            Number of rows deleted.
+        """
+
+        total = 0
+        # Shard querysets name their alias; others use the primary, as
+        # batches read from a lagging replica would repeat deleted rows
+        using = queryset._db or router.db_for_write(queryset.model)
+
+        while True:
+            batch = list(queryset.using(using).values_list(
+                'pk', flat=True)[:batch_size])
+
+            if not batch:
+                return total
+
+            queryset.model._default_manager.using(using).filter(
+                pk__in=batch).delete()
+            total += len(batch)
+
+            if len(batch) < batch_size:
+                return total
+
+            time.sleep(sleep)
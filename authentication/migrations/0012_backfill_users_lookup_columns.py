@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+from south.utils import datetime_utils as datetime
+from south.db import db
+from south.v2 import DataMigration
+from django.db import models
+
+# Rows updated per transaction; keeps row locks short on large tables
+CHUNK_SIZE = 10000
+
+
+class Migration(DataMigration):
+
+    def forwards(self, orm):
+        "Backfills lowercased lookup columns in chunks of CHUNK_SIZE ids."
+        max_id = db.execute('SELECT MAX(id) FROM authentication_users')[0][0]
+
+        if max_id is None:
+            return
+
+        start = 0
+
+        while start < max_id:
+            db.execute('UPDATE authentication_users '
+                       'SET username_lower = LOWER(username), '
+                       'email_lower = LOWER(email) '
+                       'WHERE id > %s AND id <= %s',
+                       [start, start + CHUNK_SIZE])
+
+            # Commits each chunk so locks are released as we go
+            db.commit_transaction()
+            db.start_transaction()
+
+            start += CHUNK_SIZE
+
+    def backwards(self, orm):
+        "Columns are dropped by the previous migration; nothing to undo."
+
+    models = {
+        'authentication.methods': {
+            'Meta': {'object_name': 'Methods'},
+            'created': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            'expiration': ('django.db.models.fields.DateTimeField', [], {'null': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last_used': ('django.db.models.fields.DateTimeField', [], {'null': 'True'}),
+            'method': ('django.db.models.fields.IntegerField', [], {}),
+            'password': ('django.db.models.fields.CharField', [], {'max_length': '60', 'blank': 'True'}),
+            'status': ('django.db.models.fields.IntegerField', [], {'default': '1'}),
+            'step': ('django.db.models.fields.IntegerField', [], {}),
+            'token': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'updated': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'auto_now_add': 'True', 'blank': 'True'}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['authentication.Users']"})
+        },
+        'authentication.tokens': {
+            'Meta': {'object_name': 'Tokens'},
+            'created': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            'exhausted': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'expiration': ('django.db.models.fields.DateTimeField', [], {'null': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'purpose': ('django.db.models.fields.CharField', [], {'max_length': '30'}),
+            'token': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '50'})
+        },
+        'authentication.users': {
+            'Meta': {'object_name': 'Users'},
+            'active': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'created': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            'email': ('django.db.models.fields.EmailField', [], {'max_length': '75'}),
+            'email_lower': ('django.db.models.fields.CharField', [], {'max_length': '75', 'null': 'True'}),
+            'first_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last_access': ('django.db.models.fields.DateTimeField', [], {'null': 'True'}),
+            'last_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'modified': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'auto_now_add': 'True', 'blank': 'True'}),
+            'user_type': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'username': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '50'}),
+            'username_lower': ('django.db.models.fields.CharField', [], {'max_length': '50', 'null': 'True'}),
+            'validated': ('django.db.models.fields.BooleanField', [], {'default': 'False'})
+        }
+    }
+
+    complete_apps = ['authentication']
+    symmetrical = True
\ No newline at end of file
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+from south.utils import datetime_utils as datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+
+class Migration(SchemaMigration):
+
+    def create_unique_concurrently(self, table, column):
+        "Builds unique index without blocking writes where supported."
+        if db.backend_name != 'postgres':
+            db.create_unique(table, [column])
+            return
+
+        name = '%s_%s_uniq' % (table, column)
+
+        # CREATE INDEX CONCURRENTLY cannot run inside a transaction
+        db.commit_transaction()
+        db.execute('CREATE UNIQUE INDEX CONCURRENTLY %s ON %s (%s)' %
+                   (name, table, column))
+        db.execute('ALTER TABLE %s ADD CONSTRAINT %s UNIQUE USING INDEX %s' %
+                   (table, name, name))
+        db.start_transaction()
+
+    def find_duplicates(self, table, column):
+        "Returns (column, value, ids) for values held by several rows."
+        rows = db.execute(
+            'SELECT %(column)s, id FROM %(table)s WHERE %(column)s IN '
+            '(SELECT %(column)s FROM %(table)s GROUP BY %(column)s '
+            'HAVING COUNT(*) > 1) ORDER BY %(column)s, id' %
+            {'table': table, 'column': column})
+        duplicates = []
+
+        for value, row_id in rows:
+            if not duplicates or duplicates[-1][1] != value:
+                duplicates.append((column, value, []))
+
+            duplicates[-1][2].append(row_id)
+
+        return duplicates
+
+    def forwards(self, orm):
+        # Case variants of a name would fail the index build halfway, so
+        # they are reported up front, before any index is built
+        duplicates = []
+
+        for column in ('username_lower', 'email_lower'):
+            duplicates += self.find_duplicates('authentication_users', column)
+
+        if duplicates:
+            raise RuntimeError(
+                'Users differing only in case must be renamed or merged '
+                'before lowercased names can be unique:\n' + '\n'.join(
+                    '%s %r: user ids %s' % (column, value, ', '.join(
+                        str(row_id) for row_id in ids))
+                    for column, value, ids in duplicates))
+
+        # Adding unique constraint on 'Users', fields ['username_lower']
+        self.create_unique_concurrently('authentication_users',
+                                        'username_lower')
+
+        # Adding unique constraint on 'Users', fields ['email_lower']
+        self.create_unique_concurrently('authentication_users', 'email_lower')
+
+
+    def backwards(self, orm):
+        # Removing unique constraint on 'Users', fields ['email_lower']
+        db.delete_unique('authentication_users', ['email_lower'])
+
+        # Removing unique constraint on 'Users', fields ['username_lower']
+        db.delete_unique('authentication_users', ['username_lower'])
+
+
+    models = {
+        'authentication.methods': {
+            'Meta': {'object_name': 'Methods'},
+            'created': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            'expiration': ('django.db.models.fields.DateTimeField', [], {'null': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last_used': ('django.db.models.fields.DateTimeField', [], {'null': 'True'}),
+            'method': ('django.db.models.fields.IntegerField', [], {}),
+            'password': ('django.db.models.fields.CharField', [], {'max_length': '60', 'blank': 'True'}),
+            'status': ('django.db.models.fields.IntegerField', [], {'default': '1'}),
+            'step': ('django.db.models.fields.IntegerField', [], {}),
+            'token': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'updated': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'auto_now_add': 'True', 'blank': 'True'}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['authentication.Users']"})
+        },
+        'authentication.tokens': {
+            'Meta': {'object_name': 'Tokens'},
+            'created': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            'exhausted': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'expiration': ('django.db.models.fields.DateTimeField', [], {'null': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'purpose': ('django.db.models.fields.CharField', [], {'max_length': '30'}),
+            'token': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '50'})
+        },
+        'authentication.users': {
+            'Meta': {'object_name': 'Users'},
+            'active': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'created': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            'email': ('django.db.models.fields.EmailField', [], {'max_length': '75'}),
+            'email_lower': ('django.db.models.fields.CharField', [], {'max_length': '75', 'unique': 'True', 'null': 'True'}),
+            'first_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last_access': ('django.db.models.fields.DateTimeField', [], {'null': 'True'}),
+            'last_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'modified': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'auto_now_add': 'True', 'blank': 'True'}),
+            'user_type': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'username': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '50'}),
+            'username_lower': ('django.db.models.fields.CharField', [], {'max_length': '50', 'unique': 'True', 'null': 'True'}),
+            'validated': ('django.db.models.fields.BooleanField', [], {'default': 'False'})
+        }
+    }
+
+    complete_apps = ['authentication']
\ No newline at end of file
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+from south.utils import datetime_utils as datetime
+from south.db import db
+from south.v2 import DataMigration
+from django.db import connections, models
+import hashlib
+
+# Rows scanned per transaction; keeps row locks short on large tables
+CHUNK_SIZE = 10000
+
+# Validation and recovery tokens; see authentication.models
+DIGESTED_METHODS = (1, 2)
+
+
+class Migration(DataMigration):
+
+    def forwards(self, orm):
+        "Backfills token digests in chunks of CHUNK_SIZE ids."
+        methods = orm['authentication.Methods'].objects.using(db.db_alias)
+        cursor = connections[db.db_alias].cursor()
+        max_id = db.execute('SELECT MAX(id) FROM authentication_methods')[0][0]
+
+        if max_id is None:
+            return
+
+        start = 0
+
+        while start < max_id:
+            rows = methods.filter(id__gt=start, id__lte=start + CHUNK_SIZE,
+                                  method__in=DIGESTED_METHODS).exclude(
+                                  token='').values_list('id', 'token')
+
+            # One batched statement per chunk rather than one per row
+            cursor.executemany(
+                'UPDATE authentication_methods SET token_digest = %s '
+                'WHERE id = %s',
+                [(hashlib.sha256(token.encode('utf-8')).hexdigest(), pk)
+                 for pk, token in rows])
+
+            # Commits each chunk so locks are released as we go
+            db.commit_transaction()
+            db.start_transaction()
+
+            start += CHUNK_SIZE
+
+    def backwards(self, orm):
+        "Column is dropped by the previous migration; nothing to undo."
+
+    models = {
+        'authentication.methods': {
+            'Meta': {'object_name': 'Methods'},
+            'created': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            'expiration': ('django.db.models.fields.DateTimeField', [], {'null': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last_used': ('django.db.models.fields.DateTimeField', [], {'null': 'True'}),
+            'method': ('django.db.models.fields.IntegerField', [], {}),
+            'password': ('django.db.models.fields.CharField', [], {'max_length': '60', 'blank': 'True'}),
+            'status': ('django.db.models.fields.IntegerField', [], {'default': '1'}),
+            'step': ('django.db.models.fields.IntegerField', [], {}),
+            'token': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'token_digest': ('django.db.models.fields.CharField', [], {'max_length': '64', 'null': 'True'}),
+            'updated': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'auto_now_add': 'True', 'blank': 'True'}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['authentication.Users']"})
+        },
+        'authentication.tokens': {
+            'Meta': {'object_name': 'Tokens'},
+            'created': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            'exhausted': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'expiration': ('django.db.models.fields.DateTimeField', [], {'null': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'purpose': ('django.db.models.fields.CharField', [], {'max_length': '30'}),
+            'token': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '50'})
+        },
+        'authentication.users': {
+            'Meta': {'object_name': 'Users'},
+            'active': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'created': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            'email': ('django.db.models.fields.EmailField', [], {'max_length': '75'}),
+            'email_lower': ('django.db.models.fields.CharField', [], {'max_length': '75', 'unique': 'True', 'null': 'True'}),
+            'first_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last_access': ('django.db.models.fields.DateTimeField', [], {'null': 'True'}),
+            'last_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'modified': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'auto_now_add': 'True', 'blank': 'True'}),
+            'user_type': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'username': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '50'}),
+            'username_lower': ('django.db.models.fields.CharField', [], {'max_length': '50', 'unique': 'True', 'null': 'True'}),
+            'validated': ('django.db.models.fields.BooleanField', [], {'default': 'False'})
+        }
+    }
+
+    complete_apps = ['authentication']
+    symmetrical = True
\ No newline at end of file
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+from south.utils import datetime_utils as datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+
+class Migration(SchemaMigration):
+
+    def run_concurrently(self, *statements):
+        "Runs index builds outside a transaction so writes are not blocked."
+        # CREATE INDEX CONCURRENTLY cannot run inside a transaction
+        db.commit_transaction()
+
+        for statement in statements:
+            db.execute(statement)
+
+        db.start_transaction()
+
+    def forwards(self, orm):
+        columns = ['user_id', 'method', 'step', 'status']
+
+        if db.backend_name != 'postgres':
+            # Adding unique constraint on 'Methods', fields ['token_digest']
+            db.create_unique('authentication_methods', ['token_digest'])
+
+            # Adding index on 'Methods', fields ['user', 'method', 'step', 'status']
+            db.create_index('authentication_methods', columns)
+            return
+
+        unique_name = 'authentication_methods_token_digest_uniq'
+        index_name = db.create_index_name('authentication_methods', columns)
+
+        self.run_concurrently(
+            'CREATE UNIQUE INDEX CONCURRENTLY %s ON authentication_methods '
+            '(token_digest)' % unique_name,
+            'ALTER TABLE authentication_methods ADD CONSTRAINT %s UNIQUE '
+            'USING INDEX %s' % (unique_name, unique_name),
+            'CREATE INDEX CONCURRENTLY %s ON authentication_methods (%s)' %
+            (index_name, ', '.join(columns)))
+
+
+    def backwards(self, orm):
+        # Removing index on 'Methods', fields ['user', 'method', 'step', 'status']
+        db.delete_index('authentication_methods', ['user_id', 'method', 'step', 'status'])
+
+        # Removing unique constraint on 'Methods', fields ['token_digest']
+        db.delete_unique('authentication_methods', ['token_digest'])
+
+
+    models = {
+        'authentication.methods': {
+            'Meta': {'object_name': 'Methods', 'index_together': "[['user', 'method', 'step', 'status']]"},
+            'created': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            'expiration': ('django.db.models.fields.DateTimeField', [], {'null': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last_used': ('django.db.models.fields.DateTimeField', [], {'null': 'True'}),
+            'method': ('django.db.models.fields.IntegerField', [], {}),
+            'password': ('django.db.models.fields.CharField', [], {'max_length': '60', 'blank': 'True'}),
+            'status': ('django.db.models.fields.IntegerField', [], {'default': '1'}),
+            'step': ('django.db.models.fields.IntegerField', [], {}),
+            'token': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'token_digest': ('django.db.models.fields.CharField', [], {'max_length': '64', 'unique': 'True', 'null': 'True'}),
+            'updated': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'auto_now_add': 'True', 'blank': 'True'}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['authentication.Users']"})
+        },
+        'authentication.tokens': {
+            'Meta': {'object_name': 'Tokens'},
+            'created': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            'exhausted': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'expiration': ('django.db.models.fields.DateTimeField', [], {'null': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'purpose': ('django.db.models.fields.CharField', [], {'max_length': '30'}),
+            'token': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '50'})
+        },
+        'authentication.users': {
+            'Meta': {'object_name': 'Users'},
+            'active': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'created': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            'email': ('django.db.models.fields.EmailField', [], {'max_length': '75'}),
+            'email_lower': ('django.db.models.fields.CharField', [], {'max_length': '75', 'unique': 'True', 'null': 'True'}),
+            'first_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last_access': ('django.db.models.fields.DateTimeField', [], {'null': 'True'}),
+            'last_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'modified': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'auto_now_add': 'True', 'blank': 'True'}),
+            'user_type': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'username': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '50'}),
+            'username_lower': ('django.db.models.fields.CharField', [], {'max_length': '50', 'unique': 'True', 'null': 'True'}),
+            'validated': ('django.db.models.fields.BooleanField', [], {'default': 'False'})
+        }
+    }
+
+    complete_apps = ['authentication']
\ No newline at end of file
@@ -12,22 +12,26 @@ file should also be used wherever possible.
 """
 
 import base64
-from django.db import models
+from concurrent.futures import TimeoutError
+from django.db import models, router, transaction, IntegrityError
 import onetimepass as otp
 import pytz
-import smtplib
-from voluptuous import Schema, All, Required, Match, MultipleInvalid
 import bcrypt
-from django.core.mail import send_mail
+from django.core.cache import cache
+from django.core import signing
 from django.conf import settings
 import hashlib
 import datetime
 import logging
 
 import meta.models
+import outbox.models
+from Notesapp import routers
 from errors import validators
 from errors.exceptions import UserError
-from authentication.helpers import random_string
+from authentication.helpers import random_string, random_strings,\
+    digest_token
+from authentication import access, hashing
 
 logger = logging.getLogger(__name__)
 
@@ -43,17 +47,95 @@ METHOD_RECOVERY_TOKEN = 2
 METHOD_OATH_KEY = 3
 METHOD_ACTIVE = 1
 METHOD_INACTIVE = 0
+# Methods whose tokens are looked up by value, through token_digest
+DIGESTED_METHODS = (METHOD_VALIDATION_TOKEN, METHOD_RECOVERY_TOKEN)
 TOKEN_NEW_USER = 'new-user'
 
 # Constants for use in authentication related script
-SALT_ROUNDS = 13 # Number of Bcrypt salt rounds for encryption
+# Number of Bcrypt salt rounds for encryption; see calibratebcrypt command
+SALT_ROUNDS = getattr(settings, 'BCRYPT_ROUNDS', 13)
 INVALID_LOGIN = _('invalid-login') # Defined to provide ambiguous response
 INVALID_RECOVERY = _('invalid-recovery')
 TOKEN_SALT_SIZE = 64 # Token generator length
 TOKEN_SIZE = 20
 TOKEN_TIME = datetime.timedelta(days=30)
+TOKEN_RETRIES = 5 # Attempts at minting a batch of tokens before giving up
+BULK_CREATE_RETRIES = 3 # Attempts at inserting a roster before giving up
+TOKEN_LOOKUP_CHUNK = 500 # Tokens per query checking for existing ones
 VALIDATION_TIME = datetime.timedelta(hours=5)
 OATH_STRING_SIZE = 10 # Must be > 10, and multiples of 5 for no =s
+FIRST_FACTOR_TIME = datetime.timedelta(minutes=2) # Password step lifetime
+FIRST_FACTOR_SALT = 'authentication.first-factor' # Signing namespace
+FIRST_FACTOR_NONCE_SIZE = 20
+VALIDATION_SUBJECT = 'Account Validation'
+VALIDATION_TEXT = 'Your validation token is:\n%s'
+
+
+# Compiled request schemas; see errors.validators.CompiledSchema
+USER_FIELDS = {
+    'username': validators.Field(_('invalid-username'),
+        validators.VALID_USERNAME_REGEX),
+    'first_name': validators.Field(_('invalid-first-name'),
+        validators.VALID_NAME_REGEX),
+    'last_name': validators.Field(_('invalid-last-name'),
+        validators.VALID_NAME_REGEX),
+    'email': validators.Field(_('invalid-email'),
+        validators.VALID_EMAIL_REGEX),
+}
+CREATION_FIELDS = dict(USER_FIELDS,
+    username=validators.Field(_('invalid-username'),
+        validators.VALID_USERNAME_REGEX, required=_('username-required')),
+    email=validators.Field(_('invalid-email'),
+        validators.VALID_EMAIL_REGEX, required=_('email-required')),
+    password=validators.Field(_('invalid-password'),
+        validators.valid_password, required=_('password-required')))
+CREATION_SCHEMA = validators.CompiledSchema(CREATION_FIELDS)
+CREATION_TOKEN_SCHEMA = validators.CompiledSchema(dict(CREATION_FIELDS,
+    token=validators.Field(_('invalid-token'), validators.VALID_TOKEN_REGEX,
+        required=_('token-required'))))
+LOGIN_SCHEMA = validators.CompiledSchema({
+    'username': validators.Field(_('invalid-username'),
+        required=_('username-required')),
+    'password': validators.Field(_('invalid-password'),
+        required=_('password-required')),
+})
+RECOVERY_SCHEMA = validators.CompiledSchema({
+    'username': validators.Field(_('invalid-username'),
+        required=_('username-required')),
+    'token': validators.Field(_('invalid-token'),
+        validators.VALID_TOKEN_REGEX, required=_('token-required')),
+})
+MODIFY_SCHEMA = validators.CompiledSchema(USER_FIELDS)
+PASSWORD_SCHEMA = validators.CompiledSchema({
+    'password': validators.Field(_('invalid-new-password'),
+        validators.valid_password),
+})
+TOKEN_SCHEMA = validators.CompiledSchema({
+    'token': validators.Field(_('invalid-token'),
+        validators.VALID_TOKEN_REGEX),
+})
+
+
+def creation_schema(token_required=False):
+    """Returns compiled schema for validating new user info.
+
+    Args:
+        token_required: returns schema that also requires token key.
+    """
+
+    if token_required:
+        return CREATION_TOKEN_SCHEMA
+
+    return CREATION_SCHEMA
+
+
+def validation_token(email):
+    """Generates token to be emailed for validating email address."""
+
+    random_salt = random_string(size=TOKEN_SALT_SIZE)
+
+    return hashlib.sha1((email + random_salt).encode('utf-8')).hexdigest()
+
 
 class UserManager(models.Manager):
     """Manager for the Users model.
@@ -80,7 +162,7 @@ class UserManager(models.Manager):
         """
 
         try:
-            self.get_queryset().get(username__iexact=username)
+            self.get_queryset().get(username_lower=username.lower())
         except Users.DoesNotExist:
             return False
 
@@ -97,7 +179,7 @@ class UserManager(models.Manager):
         """
 
         try:
-            self.get_queryset().get(email__iexact=email)
+            self.get_queryset().get(email_lower=email.lower())
         except Users.DoesNotExist:
             return False
 
@@ -138,7 +220,7 @@ class UserManager(models.Manager):
         validated = dict()
 
         # Check to see if user creation is enabled
-        new_users = meta.models.Data.objects.get(tag='new-users')
+        new_users = meta.models.Data.objects.get_cached('new-users')
 
         if new_users.setting == 0:
             if new_users.data == 'token':
@@ -147,47 +229,19 @@ class UserManager(models.Manager):
                 user_errors.append(_('creation-disabled'))
                 raise UserError(*user_errors)
 
-        # Voluptuous schema for validation; tested with try statement
-        schema_dict = {
-            Required('username', _('username-required')): All(str,
-                Match(validators.VALID_USERNAME_REGEX),
-                msg=_('invalid-username')),
-            'first_name': All(str, Match(validators.VALID_NAME_REGEX),
-                msg=_('invalid-first-name')),
-            'last_name': All(str, Match(validators.VALID_NAME_REGEX),
-                msg=_('invalid-last-name')),
-            Required('email', _('email-required')): All(str,
-                Match(validators.VALID_EMAIL_REGEX),
-                msg=_('invalid-email')),
-            Required('password', _('password-required')): All(str,
-                validators.Password, msg=_('invalid-password')),
-        }
-
-        # Adds required key to schema if token is required
-        if token_required:
-            schema_dict[Required('token', _('token-required'))] = All(str,
-                Match(validators.VALID_TOKEN_REGEX), msg=_('invalid-token'))
-
-        schema = Schema(schema_dict)
-
-        try:
-            validated = schema(user_info)
+        validated = creation_schema(token_required)(user_info)
 
-            # Deletes user_info to get rid of sensitive data
-            del user_info
-        except MultipleInvalid as error:
-            user_errors = validators.list_errors(error)
-
-            raise UserError(*user_errors)
+        # Deletes user_info to get rid of sensitive data
+        del user_info
 
         current_user = self.get_queryset().filter(
-            username__iexact=validated['username'])
+            username_lower=validated['username'].lower())
 
         if current_user:
             user_errors.append(_('user-exists'))
 
-        current_email = self.get_queryset().filter(email__iexact=validated[
-            'email'])
+        current_email = self.get_queryset().filter(
+            email_lower=validated['email'].lower())
 
         if current_email:
             user_errors.append(_('email-exists'))
@@ -219,7 +273,7 @@ class UserManager(models.Manager):
             del validated['token']
 
         # Hashes password using bcrypt
-        encrypted_password = bcrypt.hashpw(
+        encrypted_password = hashing.hashpw(
             validated['password'].encode('utf-8'), bcrypt.gensalt(
             SALT_ROUNDS))
 
@@ -233,9 +287,8 @@ class UserManager(models.Manager):
         password_method.step = 1
 
         # Creates validation token
-        random_salt = random_string(size=TOKEN_SALT_SIZE)
         email = validated['email']
-        token = hashlib.sha1((email + random_salt).encode('utf-8')).hexdigest()
+        token = validation_token(email)
 
         validation_token_method = Methods()
         validation_token_method.method = METHOD_VALIDATION_TOKEN
@@ -253,19 +306,220 @@ class UserManager(models.Manager):
         validation_token_method.user = user_object
         validation_token_method.save()
 
-        # Emails user; may use template for email in future
-        subject = 'Account Validation'
-        text = 'Your validation token is:\n%s' % token
+        # Queues email to user; may use template for email in future
+        outbox.models.Messages.objects.queue(VALIDATION_SUBJECT,
+            VALIDATION_TEXT % token, settings.EMAIL_HOST_USER, [email])
+
+        return user_object
+
+    def create_bulk(self, rows):
+        """Creates many users at once, e.g. from a classroom roster.
+
+        Each row holds the same info variables as create, except that
+        tokens are neither required nor accepted; bulk creation is an
+        administrative action and ignores the new-users setting. All
+        rows are validated before anything is written. Conflicts with
+        existing users and within the rows are found with set-based
+        queries, passwords are hashed in parallel, and users, methods
+        and validation emails are each inserted in one batch.
+
+        If hashing times out, no row is created. If users created
+        concurrently make the insert fail, their rows are reported as
+        taken and the rest inserted again, up to BULK_CREATE_RETRIES
+        times.
+
+        Args:
+            rows: iterable of user info dicts.
+
+        Returns:
+            List of report dicts, one per row, in row order:
+                row: index of the row.
+                username: username given in the row, if any.
+                created: true if the user was created.
+                errors: tuple of error codes for the row.
+        """
+
+        schema = creation_schema()
+        reports = []
+        candidates = []
+
+        for index, user_info in enumerate(rows):
+            report = {'row': index, 'username': user_info.get('username'),
+                      'created': False, 'errors': ()}
+            reports.append(report)
+
+            validated, report['errors'] = schema.check(user_info)
+
+            if not report['errors']:
+                candidates.append((report, validated))
+
+        taken_usernames, taken_emails = self.taken_in_bulk(
+            [validated for report, validated in candidates])
+        accepted = []
+
+        for report, validated in candidates:
+            user_errors = []
+            username_lower = validated['username'].lower()
+            email_lower = validated['email'].lower()
+
+            if username_lower in taken_usernames:
+                user_errors.append(_('user-exists'))
+
+            if email_lower in taken_emails:
+                user_errors.append(_('email-exists'))
+
+            # Later rows conflict with earlier rows of the same roster
+            taken_usernames.add(username_lower)
+            taken_emails.add(email_lower)
+
+            if user_errors:
+                report['errors'] = tuple(user_errors)
+            else:
+                accepted.append((report, validated))
+
+        if not accepted:
+            return reports
 
         try:
-            send_mail(subject, text, settings.EMAIL_HOST_USER, [email])
-        except smtplib.SMTPException as error:
-            logger.exception(error)
+            encrypted_passwords = hashing.hashpw_many(
+                [validated.pop('password').encode('utf-8')
+                 for report, validated in accepted],
+                [bcrypt.gensalt(SALT_ROUNDS) for each in accepted])
+        except TimeoutError:
+            logger.error('Hashing %d roster passwords timed out.',
+                         len(accepted))
 
-            user_errors.append(_('validation-email-failure'))
-            raise UserError(*user_errors)
+            for report, validated in accepted:
+                report['errors'] = (hashing.HASHING_TIMEOUT,)
 
-        return user_object
+            return reports
+
+        pending = list(zip(accepted, encrypted_passwords))
+
+        for attempt in range(BULK_CREATE_RETRIES):
+            try:
+                user_objects, messages = self.insert_bulk(
+                    [(validated, encrypted_password) for (report, validated),
+                     encrypted_password in pending])
+            except IntegrityError:
+                logger.warning('Roster conflicted with new users on attempt '
+                               '%d; retrying.', attempt + 1)
+                taken_usernames, taken_emails = self.taken_in_bulk(
+                    [validated for (report, validated), encrypted_password
+                     in pending])
+                remaining = []
+
+                for (report, validated), encrypted_password in pending:
+                    user_errors = []
+
+                    if validated['username'].lower() in taken_usernames:
+                        user_errors.append(_('user-exists'))
+
+                    if validated['email'].lower() in taken_emails:
+                        user_errors.append(_('email-exists'))
+
+                    if user_errors:
+                        report['errors'] = tuple(user_errors)
+                    else:
+                        remaining.append(((report, validated),
+                                          encrypted_password))
+
+                pending = remaining
+                continue
+
+            break
+        else:
+            for (report, validated), encrypted_password in pending:
+                report['errors'] = (_('creation-conflict'),)
+
+            return reports
+
+        routers.wrote()
+        outbox.models.Messages.objects.queue_many(messages)
+
+        # bulk_create sends no post_save, so filters are updated here
+        from authentication.availability import filters
+
+        filters.add_users(user_objects)
+
+        for (report, validated), encrypted_password in pending:
+            report['created'] = True
+
+        return reports
+
+    def taken_in_bulk(self, validated_rows):
+        """Finds which usernames and emails of rows are already taken.
+
+        Reads from the write database so replica lag can't hide users.
+
+        Args:
+            validated_rows: list of validated user info dicts.
+
+        Returns:
+            Tuple of sets of taken lowercase usernames and emails.
+        """
+
+        users = self.get_queryset().using(router.db_for_write(Users))
+        taken_usernames = set(users.filter(username_lower__in=[
+            validated['username'].lower() for validated in validated_rows
+        ]).values_list('username_lower', flat=True))
+        taken_emails = set(users.filter(email_lower__in=[
+            validated['email'].lower() for validated in validated_rows
+        ]).values_list('email_lower', flat=True))
+
+        return taken_usernames, taken_emails
+
+    def insert_bulk(self, rows):
+        """Inserts users and their methods in one transaction.
+
+        Args:
+            rows: list of (validated user info, password hash) tuples.
+
+        Returns:
+            Tuple of the list of user objects created and the list of
+            validation messages to queue for them.
+
+        Raises:
+            IntegrityError: if a username or email was taken
+                concurrently; nothing is inserted.
+        """
+
+        using = router.db_for_write(Users)
+
+        # bulk_create skips save(), so lookup columns are set here
+        user_objects = [Users(username_lower=validated['username'].lower(),
+                              email_lower=validated['email'].lower(),
+                              **validated)
+                        for validated, encrypted_password in rows]
+        method_objects = []
+        messages = []
+
+        with transaction.atomic(using=using):
+            self.bulk_create(user_objects)
+
+            user_ids = dict(self.get_queryset().using(using).filter(
+                username_lower__in=[user_object.username_lower for
+                                    user_object in user_objects]
+            ).values_list('username_lower', 'id'))
+
+            for user_object, (validated, encrypted_password) in zip(
+                    user_objects, rows):
+                user_id = user_ids[user_object.username_lower]
+                token = validation_token(user_object.email)
+
+                method_objects.append(Methods(user_id=user_id,
+                    method=METHOD_PASSWORD, password=encrypted_password,
+                    step=1))
+                method_objects.append(Methods(user_id=user_id,
+                    method=METHOD_VALIDATION_TOKEN, token=token,
+                    token_digest=digest_token(token), step=0))
+                messages.append((VALIDATION_SUBJECT, VALIDATION_TEXT % token,
+                                 settings.EMAIL_HOST_USER,
+                                 [user_object.email]))
+
+            Methods.objects.bulk_create_for_users(method_objects)
+
+        return user_objects, messages
 
     def login_password(self, update_access=True, **user_info):
         """Handler to login via password authentication.
@@ -288,76 +542,240 @@ class UserManager(models.Manager):
         user_errors = []
 
         # Check to see if user login is enabled
-        user_login = meta.models.Data.objects.get(tag='user-login')
+        user_login = meta.models.Data.objects.get_cached('user-login')
 
         if user_login.setting == 0:
             user_errors.append(_('login-disabled'))
             raise UserError(*user_errors)
 
-        # Voluptuous schema for validation; tested with try statement
-        schema = Schema({
-            Required('username', _('username-required')): All(str,
-                msg=_('invalid-username')),
-            Required('password', _('password-required')): All(str,
-                msg=_('invalid-password')),
-        })
+        validated = LOGIN_SCHEMA(user_info)
+
+        # Deletes user_info to get rid of sensitive data
+        del user_info
 
         try:
-            validated = schema(user_info)
+            method_object = self.password_method(
+                validated['username'].lower())
+        except Methods.DoesNotExist:
+            # Deactivated users have no methods; only checked on failure
+            if self.get_queryset().filter(
+                    username_lower=validated['username'].lower(),
+                    active=False).exists():
+                user_errors.append(_('user-inactive'))
+            else:
+                user_errors.append(INVALID_LOGIN)
 
-            # Deletes user_info to get rid of sensitive data
-            del user_info
-        except MultipleInvalid as error:
-            user_errors = validators.list_errors(error)
             raise UserError(*user_errors)
 
-        try:
-            user_object = self.get_queryset().get(
-                username__iexact=validated['username'])
-        except Users.DoesNotExist:
-            user_errors.append(INVALID_LOGIN)
-            raise UserError(*user_errors)
+        user_object = method_object.user
 
         if not user_object.active:
             user_errors.append(_('user-inactive'))
             raise UserError(*user_errors)
 
-        try:
-            method_object = Methods.objects.get(user=user_object,
-                method=METHOD_PASSWORD, step=1, status=METHOD_ACTIVE)
-        except Methods.DoesNotExist:
+        user_password = method_object.password.encode('utf-8')
+        test_password = hashing.hashpw(validated['password'].encode('utf-8'),
+                                       user_password)
+
+        if test_password != user_password:
+            del validated['password']
+
             user_errors.append(INVALID_LOGIN)
             raise UserError(*user_errors)
 
-        user_password = method_object.password.encode('utf-8')
-        test_password = bcrypt.hashpw(validated['password'].encode('utf-8'),
-                                      user_password)
+        method_fields = ['last_used']
+
+        # Rehashes password if configured cost has changed since hashing
+        if hashing.get_rounds(user_password) != SALT_ROUNDS:
+            try:
+                method_object.password = hashing.hashpw(
+                    validated['password'].encode('utf-8'),
+                    bcrypt.gensalt(SALT_ROUNDS))
+                method_fields.append('password')
+            except UserError:
+                # Rehashing is opportunistic; retried on next login
+                logger.warning('Could not rehash password for user %s.',
+                               user_object.pk)
 
         # Deletes original password to prevent later misuse
         del validated['password']
 
-        if test_password != user_password:
+        self.record_access(user_object, method_object,
+                           update_access=update_access,
+                           method_fields=method_fields)
+
+        return user_object
+
+    def password_method(self, username_lower):
+        """Returns active password method of a user, with user attached.
+
+        Fetched in one joined query, or with one query each for the user
+        and the method if methods are sharded.
+
+        Args:
+            username_lower: lowercased username of user.
+
+        Raises:
+            Methods.DoesNotExist: if user or method does not exist.
+        """
+
+        method_filter = dict(method=METHOD_PASSWORD, step=1,
+                             status=METHOD_ACTIVE)
+
+        if not routers.sharded(Methods):
+            return Methods.objects.select_related('user').get(
+                user__in=self.get_queryset().filter(
+                    username_lower=username_lower), **method_filter)
+
+        # Methods on shards cannot be joined to users
+        try:
+            user_object = self.get_queryset().get(
+                username_lower=username_lower)
+        except Users.DoesNotExist:
+            raise Methods.DoesNotExist
+
+        method_object = Methods.objects.for_user(user_object.pk).get(
+            user_id=user_object.pk, **method_filter)
+        method_object.user = user_object
+
+        return method_object
+
+    def record_access(self, user_object, method_object, update_access=True,
+                      method_fields=('last_used',)):
+        """Records successful use of a method in a single transaction.
+
+        Only writes the changed columns, so auto_now columns and other
+        fields of the rows are left untouched. If access writes are
+        coalesced, timestamps are handed to authentication.access and
+        only other method fields are written immediately.
+
+        Args:
+            user_object: user that logged in.
+            method_object: method that was used.
+            update_access: boolean, updates user access time.
+            method_fields: method fields to write; must include
+                last_used.
+        """
+
+        now = datetime.datetime.now(pytz.utc)
+        method_object.last_used = now
+
+        if update_access:
+            user_object.last_access = now
+
+        # Defers timestamps to a coalesced bulk write if enabled; the
+        # buffer writes by primary key, so methods on shards are skipped
+        if access.buffer.enabled and not routers.sharded(Methods):
+            access.record(Methods, method_object.pk, 'last_used', now)
+
+            if update_access:
+                access.record(Users, user_object.pk, 'last_access', now)
+
+            method_fields = [field for field in method_fields
+                             if field != 'last_used']
+
+            if method_fields:
+                method_object.save(update_fields=method_fields)
+
+            return
+
+        with transaction.atomic(using=router.db_for_write(Methods)):
+            method_object.save(update_fields=list(method_fields))
+
+            if update_access:
+                user_object.save(update_fields=['last_access'])
+
+    def login_first_factor(self, **user_info):
+        """Checks password as the first of two authentication steps.
+
+        Passes credentials to login_password without updating access
+        time. If successful, returns a signed continuation token that
+        may be given to login_oath in place of the password, so that
+        the password is not hashed a second time for the second step.
+        The token is bound to the user, expires after FIRST_FACTOR_TIME
+        and may only be redeemed once.
+
+        Args:
+            user_info: passes to login_password.
+
+        Returns:
+            Tuple of user object and continuation token if successful.
+
+        Raises:
+            UserError: contains description.
+        """
+
+        user_object = self.login_password(update_access=False, **user_info)
+
+        nonce = random_string(size=FIRST_FACTOR_NONCE_SIZE)
+        cache.set('first-factor:%s' % nonce, user_object.pk,
+                  int(FIRST_FACTOR_TIME.total_seconds()))
+
+        signer = signing.TimestampSigner(salt=FIRST_FACTOR_SALT)
+        first_factor = signer.sign('%d:%s' % (user_object.pk, nonce))
+
+        return user_object, first_factor
+
+    def redeem_first_factor(self, first_factor):
+        """Redeems continuation token given by login_first_factor.
+
+        Token is deleted on redemption regardless of what happens in
+        following steps.
+
+        Args:
+            first_factor: continuation token.
+
+        Returns:
+            User object if token is valid.
+
+        Raises:
+            UserError: contains description.
+        """
+
+        user_errors = []
+        signer = signing.TimestampSigner(salt=FIRST_FACTOR_SALT)
+
+        try:
+            value = signer.unsign(first_factor,
+                max_age=int(FIRST_FACTOR_TIME.total_seconds()))
+            user_id, nonce = value.split(':', 1)
+            user_id = int(user_id)
+        except (signing.BadSignature, ValueError):
             user_errors.append(INVALID_LOGIN)
             raise UserError(*user_errors)
 
-        method_object.last_used = datetime.datetime.now(pytz.utc)
-        method_object.save()
+        cache_key = 'first-factor:%s' % nonce
 
-        if update_access:
-            user_object.last_access = datetime.datetime.now(pytz.utc)
-            user_object.save()
+        # Only the first redemption adds the marker; get then delete
+        # would let concurrent redemptions both pass
+        if cache.get(cache_key) != user_id or not cache.add(
+                'first-factor-used:%s' % nonce, True,
+                int(FIRST_FACTOR_TIME.total_seconds())):
+            user_errors.append(INVALID_LOGIN)
+            raise UserError(*user_errors)
+
+        cache.delete(cache_key)
+
+        try:
+            user_object = self.get_queryset().get(pk=user_id, active=True)
+        except Users.DoesNotExist:
+            user_errors.append(INVALID_LOGIN)
+            raise UserError(*user_errors)
 
         return user_object
 
-    def login_oath(self, token, **user_info):
+    def login_oath(self, token, first_factor=None, **user_info):
         """Adds second step to password authentication by using OATH.
 
-        Takes standard password credentials and passes them directly to
-        login_password function. If successful, proceeds to test second
-        authentication methods through use of a TOTP token.
+        If first_factor is given, redeems it in place of checking the
+        password again. Otherwise takes standard password credentials
+        and passes them directly to login_password function. If
+        successful, proceeds to test second authentication methods
+        through use of a TOTP token.
 
         Args:
             token: token to authenticate against.
+            first_factor: continuation token from login_first_factor.
             user_info: passes to login_password.
 
         Returns:
@@ -369,11 +787,16 @@ class UserManager(models.Manager):
 
         user_errors = []
 
-        # Attempts to login user through password
-        user_object = self.login_password(update_access=False, **user_info)
+        # Attempts to login user through continuation token or password
+        if first_factor:
+            user_object = self.redeem_first_factor(first_factor)
+        else:
+            user_object = self.login_password(update_access=False,
+                                              **user_info)
 
         try:
-            method_object = Methods.objects.get(user=user_object,
+            method_object = Methods.objects.for_user(user_object.pk).get(
+                user=user_object,
                 method=METHOD_OATH_KEY, step=2, status=METHOD_ACTIVE)
         except Methods.DoesNotExist:
             user_errors.append(INVALID_LOGIN)
@@ -385,11 +808,7 @@ class UserManager(models.Manager):
             user_errors.append(INVALID_LOGIN)
             raise UserError(*user_errors)
 
-        method_object.last_used = datetime.datetime.now(pytz.utc)
-        method_object.save()
-
-        user_object.last_access = datetime.datetime.now(pytz.utc)
-        user_object.save()
+        self.record_access(user_object, method_object)
 
         return user_object
 
@@ -411,33 +830,23 @@ class UserManager(models.Manager):
 
         user_errors = []
 
-        schema = Schema({
-            Required('username', _('username-required')): All(str,
-                msg=_('invalid-username')),
-            Required('token', _('token-required')): All(str,
-                Match(validators.VALID_TOKEN_REGEX), msg=_('invalid-token'))
-        })
+        validated = RECOVERY_SCHEMA(user_info)
 
-        try:
-            validated = schema(user_info)
-
-            del user_info
-        except MultipleInvalid as error:
-            user_errors = validators.list_errors(error)
-            raise UserError(*user_errors)
+        del user_info
 
         try:
             user_object = self.get_queryset().get(
-                username__iexact=validated['username'], active=True)
+                username_lower=validated['username'].lower(), active=True)
         except Users.DoesNotExist:
             user_errors.append(INVALID_RECOVERY)
             raise UserError(*user_errors)
 
         try:
-            method_object = Methods.objects.get(user=user_object,
+            method_object = Methods.objects.for_user(user_object.pk).get(
+                user=user_object,
                 method=METHOD_RECOVERY_TOKEN,
                 status=METHOD_ACTIVE,
-                token=validated['token'])
+                token_digest=digest_token(validated['token']))
         except Methods.DoesNotExist:
             user_errors.append(INVALID_RECOVERY)
             raise UserError(*user_errors)
@@ -450,11 +859,7 @@ class UserManager(models.Manager):
             user_errors.append(INVALID_RECOVERY)
             raise UserError(*user_errors)
 
-        method_object.last_used = datetime.datetime.now(pytz.utc)
-        method_object.save()
-
-        user_object.last_access = datetime.datetime.now(pytz.utc)
-        user_object.save()
+        self.record_access(user_object, method_object)
 
         return user_object
 
@@ -499,6 +904,70 @@ class TokenManager(models.Manager):
 
         return token_object
 
+    def existing(self, tokens, using):
+        """Returns set of given tokens stored in database using.
+
+        Looks tokens up in chunks of TOKEN_LOOKUP_CHUNK, keeping each
+        query under SQLite's limit of 999 parameters.
+        """
+
+        tokens = list(tokens)
+        found = set()
+
+        for start in range(0, len(tokens), TOKEN_LOOKUP_CHUNK):
+            found.update(self.get_queryset().using(using).filter(
+                token__in=tokens[start:start + TOKEN_LOOKUP_CHUNK]
+            ).values_list('token', flat=True))
+
+        return found
+
+    def generate_many(self, purpose, count, expiration_delta=TOKEN_TIME):
+        """Generates many tokens for given purpose in one batch.
+
+        Tokens are drawn from the OS CSPRNG and inserted with a single
+        bulk insert. Tokens already in the database are drawn again
+        beforehand; if a concurrent insert still causes a collision,
+        the tokens it took are redrawn and the rest kept.
+
+        Args:
+            purpose: use constant purpose flag.
+            count: number of tokens to generate.
+            expiration_delta: datetime.timedelta
+
+        Returns:
+            List of token strings generated.
+
+        Raises:
+            IntegrityError: if collisions persist after TOKEN_RETRIES.
+        """
+
+        expiration = datetime.datetime.now(pytz.utc) + expiration_delta
+        using = router.db_for_write(Tokens)
+        tokens = set()
+
+        for attempt in range(TOKEN_RETRIES):
+            # Draws tokens until count are unique and not yet stored
+            while len(tokens) < count:
+                drawn = set(random_strings(count - len(tokens),
+                                           size=TOKEN_SIZE)) - tokens
+                tokens |= drawn - self.existing(drawn, using)
+
+            try:
+                with transaction.atomic(using=using):
+                    self.bulk_create([Tokens(purpose=purpose, token=token,
+                        expiration=expiration) for token in tokens])
+            except IntegrityError:
+                logger.warning('Token collision on attempt %d; retrying.',
+                               attempt + 1)
+                tokens -= self.existing(tokens, using)
+                continue
+
+            routers.wrote()
+
+            return list(tokens)
+
+        raise IntegrityError('Could not mint %d unique tokens.' % count)
+
 
 class Users(models.Model):
     """Database model for user storage.
@@ -508,6 +977,9 @@ class Users(models.Model):
         user_type: integer describing the type of user. Includes the following:
             0: standard user
             1: admin user
+        username_lower/email_lower: lowercased copies of username and
+            email, kept in sync by save(). Case-insensitive lookups
+            should use these with exact matches so indexes are used.
     """
 
     users = UserManager()
@@ -523,6 +995,33 @@ class Users(models.Model):
     created = models.DateTimeField(auto_now_add=True)
     modified = models.DateTimeField(auto_now=True, auto_now_add=True)
     validated = models.BooleanField(default=False)
+    username_lower = models.CharField(max_length=50, unique=True, null=True)
+    email_lower = models.CharField(max_length=75, unique=True, null=True)
+
+    def save(self, *args, **kwargs):
+        """Syncs lowercased lookup columns, then saves.
+
+        Args:
+            All passed to superclass save().
+        """
+
+        self.username_lower = self.username.lower()
+        self.email_lower = self.email.lower()
+
+        update_fields = kwargs.get('update_fields')
+
+        if update_fields is not None:
+            update_fields = list(update_fields)
+
+            if 'username' in update_fields:
+                update_fields.append('username_lower')
+
+            if 'email' in update_fields:
+                update_fields.append('email_lower')
+
+            kwargs['update_fields'] = update_fields
+
+        super(Users, self).save(*args, **kwargs)
 
     def delete(self, *args, **kwargs):
         """Deletes users in user_obs.
@@ -544,6 +1043,10 @@ class Users(models.Model):
 
         user_errors = []
 
+        # Cascades only reach methods on the user's own database
+        if routers.sharded(Methods):
+            Methods.objects.for_user(self.pk).filter(user=self).delete()
+
         try:
             super(Users, self).delete(*args, **kwargs)
         except Users.ProtectedError:
@@ -573,7 +1076,7 @@ class Users(models.Model):
         self.active = False
         self.save()
 
-        method_list = Methods.objects.filter(user=self)
+        method_list = Methods.objects.for_user(self.pk).filter(user=self)
         method_list.delete()
 
     def activate(self):
@@ -602,35 +1105,65 @@ class Users(models.Model):
             user_info: passed to validator and then saved.
 
         Raises:
+            UserError: if info is invalid or username or email is taken.
             RuntimeError: if user is not defined before modification.
         """
 
         if not self.id:
             raise RuntimeError('User must be defined to modify.')
 
-        user_errors = []
-
-        schema = Schema({
-            'username': All(str, Match(validators.VALID_USERNAME_REGEX),
-                msg=_('invalid-username')),
-            'first_name': All(str, Match(validators.VALID_NAME_REGEX),
-                msg=_('invalid-first-name')),
-            'last_name': All(str, Match(validators.VALID_NAME_REGEX),
-                msg=_('invalid-last-name')),
-            'email': All(str, Match(validators.VALID_EMAIL_REGEX),
-                msg=_('invalid-email')),
-        })
+        validated = MODIFY_SCHEMA(user_info)
+        user_errors = self.taken_errors(validated)
 
-        try:
-            validated = schema(user_info)
-        except MultipleInvalid as error:
-            user_errors = validators.list_errors(error)
+        if user_errors:
             raise UserError(*user_errors)
 
         # Sets instance variables to those of the validated schema and saves
+        changed = [key for key, value in validated.items()
+                   if getattr(self, key) != value]
+
         for key, value in list(validated.items()):
             setattr(self, key, value)
-        self.save()
+
+        try:
+            with transaction.atomic(using=router.db_for_write(Users)):
+                # Naming changed fields tells availability filters of renames
+                self.save(update_fields=changed + ['modified'])
+        except IntegrityError:
+            # Taken by a concurrent change since the check above
+            user_errors = self.taken_errors(validated, primary=True)
+
+            if not user_errors:
+                raise
+
+            raise UserError(*user_errors)
+
+    def taken_errors(self, user_info, primary=False):
+        """Checks whether other users have the username or email.
+
+        Args:
+            user_info: dict that may hold username and email.
+            primary: boolean, checks the primary rather than a replica.
+
+        Returns:
+            List of user-exists and email-exists error codes.
+        """
+
+        user_errors = []
+        others = Users.users.get_queryset().exclude(pk=self.pk)
+
+        if primary:
+            others = others.using(router.db_for_write(Users))
+
+        if 'username' in user_info and others.filter(
+                username_lower=user_info['username'].lower()).exists():
+            user_errors.append(_('user-exists'))
+
+        if 'email' in user_info and others.filter(
+                email_lower=user_info['email'].lower()).exists():
+            user_errors.append(_('email-exists'))
+
+        return user_errors
 
     def modify_password(self, new=None, check=True, old=None):
         """Optionally checks and sets password for user.
@@ -652,17 +1185,9 @@ class Users(models.Model):
         if not new:
             user_errors.append(_('new-password-required'))
 
-        schema = Schema({
-            'password': All(str, validators.Password,
-                msg=_('invalid-new-password')),
-        })
+        user_errors += list(PASSWORD_SCHEMA.check({'password': new})[1])
 
-        try:
-            schema({'password': new})
-        except MultipleInvalid as error:
-            user_errors += list(validators.list_errors(error))
-
-        password_method = Methods.objects.get(user=self,
+        password_method = Methods.objects.for_user(self.pk).get(user=self,
             method=METHOD_PASSWORD)
 
         if check:
@@ -670,8 +1195,8 @@ class Users(models.Model):
                 user_errors.append(_('old-password-required'))
             else:
                 user_password = password_method.password.encode('utf-8')
-                test_password = bcrypt.hashpw(old.encode('utf-8').strip(),
-                                            user_password)
+                test_password = hashing.hashpw(old.encode('utf-8').strip(),
+                                               user_password)
 
                 del old
 
@@ -681,28 +1206,26 @@ class Users(models.Model):
         if user_errors:
             raise UserError(*user_errors)
 
-        new_password = bcrypt.hashpw(new.encode('utf-8'),
+        new_password = hashing.hashpw(new.encode('utf-8'),
             bcrypt.gensalt(SALT_ROUNDS))
 
         password_method.password = new_password
         password_method.save()
 
     def recover(self):
-        """Creates recovery email token and sends it to user.
+        """Creates recovery email token and queues it for the user.
 
         Raises:
             RuntimeError: if user is not defined before recovery.
-            UserError: if email fails.
         """
 
         if not self.id:
             raise RuntimeError('User must be defined to recover account.')
 
-        user_errors = []
-
         # Deactivates all old recovery tokens
-        Methods.objects.filter(user=self, method=METHOD_RECOVERY_TOKEN,
-            status=METHOD_ACTIVE).update(status=METHOD_INACTIVE)
+        Methods.objects.for_user(self.pk).filter(user=self,
+            method=METHOD_RECOVERY_TOKEN, status=METHOD_ACTIVE).update(
+            status=METHOD_INACTIVE)
 
         email = self.email
         random_salt = random_string(size=TOKEN_SALT_SIZE)
@@ -719,11 +1242,8 @@ class Users(models.Model):
         subject = 'Recovery Token'
         text = 'Your account recovery token is: %s' % token
 
-        try:
-            send_mail(subject, text, settings.EMAIL_HOST_USER, [email])
-        except:
-            user_errors.append(_('recovery-email-failure'))
-            raise UserError(*user_errors)
+        outbox.models.Messages.objects.queue(subject, text,
+            settings.EMAIL_HOST_USER, [email])
 
     def generate_oath(self):
         """Generates a TOTP oath key for 2nd step authentication.
@@ -742,7 +1262,8 @@ class Users(models.Model):
         if not self.id:
             raise RuntimeError('User must be defined for OATH generation.')
 
-        Methods.objects.filter(user=self, method=METHOD_OATH_KEY).delete()
+        Methods.objects.for_user(self.pk).filter(user=self,
+            method=METHOD_OATH_KEY).delete()
 
         random = random_string(size=OATH_STRING_SIZE)
         key = base64.b32encode(random.encode('utf-8'))
@@ -774,24 +1295,15 @@ class Users(models.Model):
             user_errors.append(_('token-required'))
             raise UserError(*user_errors)
 
-        schema = Schema({
-            'token': All(str, Match(validators.VALID_TOKEN_REGEX),
-                msg=_('invalid-token'))
-        })
+        validated = TOKEN_SCHEMA({'token': token})
 
-        try:
-            validated = schema({'token': token})
-
-            del token
-        except MultipleInvalid as error:
-            user_errors += list(validators.list_errors(error))
-            raise UserError(*user_errors)
+        del token
 
         try:
-            method_object = Methods.objects.get(user=self,
+            method_object = Methods.objects.for_user(self.pk).get(user=self,
                 method=METHOD_VALIDATION_TOKEN,
                 status=METHOD_ACTIVE,
-                token=validated['token'])
+                token_digest=digest_token(validated['token']))
         except Methods.DoesNotExist:
             user_errors.append(_('invalid-token'))
             raise UserError(*user_errors)
@@ -837,6 +1349,39 @@ class Users(models.Model):
         return self.username
 
 
+class MethodManager(models.Manager):
+    """Manager class for methods. Sends queries to users' shards."""
+
+    def for_user(self, user_id):
+        """Returns queryset on the database holding methods of user id.
+
+        Queries on methods of a user must go through this so they reach
+        the user's shard when methods are sharded. See Notesapp.routers.
+        """
+
+        queryset = self.get_queryset()
+
+        if routers.sharded(self.model):
+            queryset = queryset.using(routers.shard_for(user_id))
+
+        return queryset
+
+    def bulk_create_for_users(self, method_objects):
+        """Bulk creates methods, on their users' shards if sharded."""
+
+        if not routers.sharded(self.model):
+            return self.bulk_create(method_objects)
+
+        shards = dict()
+
+        for method_object in method_objects:
+            shards.setdefault(routers.shard_for(method_object.user_id),
+                              []).append(method_object)
+
+        for alias, shard_objects in shards.items():
+            self.using(alias).bulk_create(shard_objects)
+
+
 class Methods(models.Model):
     """Database model for authentication methods.
 
@@ -853,9 +1398,14 @@ class Methods(models.Model):
         status: current availability status of the method for the user.
             1: active
             0: inactive
+        token_digest: SHA-256 digest of token for validation and
+            recovery tokens, kept in sync by save(). Token lookups
+            should use this so they hit a unique index.
     """
 
-    user = models.ForeignKey(Users, on_delete=models.CASCADE)
+    # Unconstrained so methods can live on another database than users
+    user = models.ForeignKey(Users, on_delete=models.CASCADE,
+                             db_constraint=False)
     method = models.IntegerField()
     password = models.CharField(max_length=60, blank=True)
     token = models.TextField(blank=True)
@@ -865,6 +1415,32 @@ class Methods(models.Model):
     updated = models.DateTimeField(auto_now=True, auto_now_add=True)
     last_used = models.DateTimeField(null=True)
     expiration = models.DateTimeField(null=True)
+    token_digest = models.CharField(max_length=64, unique=True, null=True)
+
+    objects = MethodManager()
+
+    class Meta:
+        # Matches filters used by logins and password changes
+        index_together = [['user', 'method', 'step', 'status']]
+
+    def save(self, *args, **kwargs):
+        """Syncs token digest for lookup tokens, then saves.
+
+        Args:
+            All passed to superclass save().
+        """
+
+        if self.token and self.method in DIGESTED_METHODS:
+            self.token_digest = digest_token(self.token)
+        else:
+            self.token_digest = None
+
+        update_fields = kwargs.get('update_fields')
+
+        if update_fields is not None and 'token' in update_fields:
+            kwargs['update_fields'] = list(update_fields) + ['token_digest']
+
+        super(Methods, self).save(*args, **kwargs)
 
     def expired(self):
         """Checks to see if method has been expired yet.
@@ -1,5 +1,770 @@
-"""Django test module for testing authentication models."""
+"""Django test module for testing authentication models.
 
-from django.test import TestCase
+Reads of authentication models are routed to authentication_ro, so the
+test environment must mirror it to authentication (TEST_MIRROR).
 
-# TODO Create tests
\ No newline at end of file
+Sharding tests add two in-memory SQLite aliases as shards.
+"""
+
+from contextlib import contextmanager
+from unittest import mock
+import datetime
+import io
+import tempfile
+import time
+import bcrypt
+import pytz
+from django.conf import settings
+from django.core import signing
+from django.core.management import call_command
+from django.core.management.color import no_style
+from django.db import connections, transaction
+from django.test import SimpleTestCase, TestCase
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.utils import baseconv
+
+import meta.models
+from meta.management.commands import moveusershard
+from errors.exceptions import UserError
+from authentication import access, availability, hashing, helpers, models
+from Notesapp import routers
+
+
+@contextmanager
+def capture_all_queries():
+    """Captures queries on every configured database alias.
+
+    Yields:
+        List that is filled with captured SQL strings on exit.
+    """
+
+    captured = []
+    contexts = [CaptureQueriesContext(connections[alias])
+                for alias in settings.DATABASES]
+
+    for context in contexts:
+        context.__enter__()
+
+    try:
+        yield captured
+    finally:
+        for context in contexts:
+            context.__exit__(None, None, None)
+            captured.extend(query['sql'] for query in
+                            context.captured_queries)
+
+
+def count_statements(queries, statement):
+    """Counts captured queries starting with given SQL statement."""
+
+    return sum(1 for sql in queries if sql.lstrip().upper().startswith(
+        statement))
+
+
+class LoginPasswordTest(TestCase):
+    """Tests for UserManager.login_password."""
+
+    multi_db = True
+
+    username = 'logintest'
+    password = 'LoginTest123'
+
+    def setUp(self):
+        meta.models.Data.objects.populate()
+
+        self.user = models.Users.users.create(username=self.username,
+            email='logintest@example.com', password=self.password)
+
+        # Keeps cached meta data from rechecking its version mid-test
+        self.check_interval = meta.models.data_cache.check_interval
+        meta.models.data_cache.check_interval = 3600
+
+    def tearDown(self):
+        meta.models.data_cache.check_interval = self.check_interval
+
+    def test_login_query_count(self):
+        """Login costs one joined read and two writes once warm."""
+
+        meta.models.Data.objects.get_cached('user-login')
+
+        with capture_all_queries() as queries:
+            user_object = models.Users.users.login_password(
+                username=self.username, password=self.password)
+
+        self.assertEqual(user_object.pk, self.user.pk)
+        self.assertEqual(count_statements(queries, 'SELECT'), 1)
+        self.assertEqual(count_statements(queries, 'UPDATE'), 2)
+        self.assertEqual(count_statements(queries, 'INSERT'), 0)
+
+    def test_login_updates_timestamps(self):
+        """Login sets last_used and last_access."""
+
+        models.Users.users.login_password(username=self.username.upper(),
+                                          password=self.password)
+
+        user_object = models.Users.users.get(pk=self.user.pk)
+        method_object = models.Methods.objects.get(user=user_object,
+            method=models.METHOD_PASSWORD)
+
+        self.assertIsNotNone(user_object.last_access)
+        self.assertIsNotNone(method_object.last_used)
+
+    def test_login_rehashes(self):
+        """Passwords hashed at another cost are rehashed on login."""
+
+        rounds = 5 if models.SALT_ROUNDS != 5 else 4
+
+        with mock.patch.object(models, 'SALT_ROUNDS', rounds):
+            models.Users.users.login_password(username=self.username,
+                                              password=self.password)
+
+            method_object = models.Methods.objects.get(user=self.user,
+                method=models.METHOD_PASSWORD)
+
+            self.assertEqual(hashing.get_rounds(
+                method_object.password.encode('utf-8')), rounds)
+            self.assertEqual(models.Users.users.login_password(
+                username=self.username, password=self.password).pk,
+                self.user.pk)
+
+    def test_login_inactive_user(self):
+        """Deactivated users are told so rather than given invalid-login."""
+
+        self.user.deactivate()
+
+        with self.assertRaises(UserError) as context:
+            models.Users.users.login_password(username=self.username,
+                                              password=self.password)
+
+        self.assertEqual(context.exception.codes, ('user-inactive',))
+
+    def test_login_wrong_password(self):
+        """Wrong passwords give the ambiguous invalid-login."""
+
+        with self.assertRaises(UserError) as context:
+            models.Users.users.login_password(username=self.username,
+                                              password='WrongPassword1')
+
+        self.assertEqual(context.exception.codes, (models.INVALID_LOGIN,))
+
+
+class AccessBufferTest(TestCase):
+    """Tests for coalesced access timestamps."""
+
+    multi_db = True
+
+    def setUp(self):
+        meta.models.Data.objects.populate()
+
+        self.users = [models.Users.users.create(username='access%d' % number,
+            email='access%d@example.com' % number, password='AccessTest123')
+            for number in range(3)]
+        self.buffer = access.AccessBuffer(True, 3600)
+
+    def test_flush(self):
+        """Latest timestamps are written with one UPDATE per chunk."""
+
+        now = datetime.datetime.now(pytz.utc)
+
+        for number, user_object in enumerate(self.users):
+            when = now - datetime.timedelta(minutes=number)
+            self.buffer.record(models.Users, user_object.pk, 'last_access',
+                               when)
+            self.buffer.record(models.Users, user_object.pk, 'last_access',
+                               when - datetime.timedelta(hours=1))
+
+        self.assertIsNone(models.Users.users.get(
+            pk=self.users[0].pk).last_access)
+
+        with mock.patch.object(access, 'update_timestamps',
+                               wraps=access.update_timestamps) as update, \
+                mock.patch.object(access, 'ACCESS_UPDATE_CHUNK', 2):
+            self.buffer.flush()
+
+        self.assertEqual(update.call_count, 2)
+        self.assertEqual(self.buffer.pending, {})
+
+        for number, user_object in enumerate(self.users):
+            self.assertEqual(models.Users.users.get(
+                pk=user_object.pk).last_access,
+                now - datetime.timedelta(minutes=number))
+
+
+    def test_timestamps_cast(self):
+        """Timestamps are cast to the column type outside SQLite."""
+
+        connection = connections['authentication']
+        db_type = models.Users._meta.get_field('last_access').db_type(
+            connection)
+
+        with mock.patch.object(connection, 'vendor', 'postgresql'):
+            sql = access.update_timestamps_sql(models.Users, 'last_access',
+                                               2, connection)
+
+        self.assertEqual(sql.count('THEN CAST(%%s AS %s)' % db_type), 2)
+
+
+class HashPoolTest(SimpleTestCase):
+    """Tests for admission control and timeouts of the hash pool."""
+
+    def setUp(self):
+        self.pool = hashing.HashPool(1, 0, 10)
+
+    def tearDown(self):
+        self.pool.shutdown()
+
+    def test_saturated(self):
+        """Calls past the pool's capacity are rejected at once."""
+
+        self.pool._slots.acquire()
+
+        try:
+            with self.assertRaises(UserError) as context:
+                self.pool.hashpw(b'password', bcrypt.gensalt(4))
+        finally:
+            self.pool._slots.release()
+
+        self.assertEqual(context.exception.codes, (hashing.HASHING_BUSY,))
+        self.assertEqual(self.pool.stats.snapshot()['rejected'], 1)
+
+    def test_timeout_keeps_slot(self):
+        """Timed out calls hold their slot until the hash finishes."""
+
+        # Started first so process startup is not part of the timeout
+        self.pool.hashpw(b'password', bcrypt.gensalt(4))
+        self.pool.timeout = 0.01
+
+        with self.assertRaises(UserError) as context:
+            self.pool.hashpw(b'password', bcrypt.gensalt(14))
+
+        self.assertEqual(context.exception.codes, (hashing.HASHING_TIMEOUT,))
+
+        with self.assertRaises(UserError) as context:
+            self.pool.hashpw(b'password', bcrypt.gensalt(4))
+
+        self.assertEqual(context.exception.codes, (hashing.HASHING_BUSY,))
+
+        # Freed by the running hash once it completes
+        self.assertTrue(self.pool._slots.acquire(timeout=60))
+        self.pool._slots.release()
+
+
+    def test_batch_waits_for_slots(self):
+        """Batch hashes wait for slots held by other calls."""
+
+        self.pool.timeout = 0.01
+        self.pool._slots.acquire()
+
+        try:
+            with self.assertRaises(hashing.TimeoutError):
+                self.pool.hashpw_many([b'password'], [bcrypt.gensalt(4)])
+        finally:
+            self.pool._slots.release()
+
+    def test_batch_limit(self):
+        """Batches leave processes free and release every slot."""
+
+        pool = hashing.HashPool(2, 0, 10)
+        salts = [bcrypt.gensalt(4) for number in range(3)]
+
+        try:
+            self.assertEqual(pool.batch_limit, 1)
+            self.assertEqual(pool.hashpw_many([b'password'] * 3, salts),
+                             [bcrypt.hashpw(b'password', salt)
+                              for salt in salts])
+
+            # Freed by done callbacks, which may run just after results
+            for number in range(2):
+                self.assertTrue(pool._slots.acquire(timeout=5))
+        finally:
+            pool.shutdown()
+
+
+class FirstFactorTest(TestCase):
+    """Tests for first factor continuation tokens."""
+
+    multi_db = True
+
+    username = 'factortest'
+    password = 'FactorTest123'
+
+    def setUp(self):
+        meta.models.Data.objects.populate()
+
+        self.user = models.Users.users.create(username=self.username,
+            email='factortest@example.com', password=self.password)
+
+    def first_factor(self):
+        """Logs in with the password; returns the continuation token."""
+
+        return models.Users.users.login_first_factor(
+            username=self.username, password=self.password)[1]
+
+    def test_single_use(self):
+        """Tokens are redeemed once; later redemptions are refused."""
+
+        first_factor = self.first_factor()
+
+        self.assertEqual(models.Users.users.redeem_first_factor(
+            first_factor).pk, self.user.pk)
+
+        with self.assertRaises(UserError) as context:
+            models.Users.users.redeem_first_factor(first_factor)
+
+        self.assertEqual(context.exception.codes, (models.INVALID_LOGIN,))
+
+    def test_expired(self):
+        """Tokens older than FIRST_FACTOR_TIME are refused."""
+
+        issued = time.time() - \
+            models.FIRST_FACTOR_TIME.total_seconds() - 1
+
+        with mock.patch.object(signing.TimestampSigner, 'timestamp',
+                               return_value=baseconv.base62.encode(
+                                   int(issued))):
+            first_factor = self.first_factor()
+
+        with self.assertRaises(UserError) as context:
+            models.Users.users.redeem_first_factor(first_factor)
+
+        self.assertEqual(context.exception.codes, (models.INVALID_LOGIN,))
+
+
+class ModifyInfoTest(TestCase):
+    """Tests for Users.modify_info."""
+
+    multi_db = True
+
+    def setUp(self):
+        meta.models.Data.objects.populate()
+
+        self.first = models.Users.users.create(username='modifyfirst',
+            email='modifyfirst@example.com', password='ModifyTest123')
+        self.second = models.Users.users.create(username='modifysecond',
+            email='modifysecond@example.com', password='ModifyTest123')
+
+    def test_taken_in_other_case(self):
+        """Names of other users are rejected regardless of case."""
+
+        with self.assertRaises(UserError) as context:
+            self.second.modify_info(username='ModifyFirst',
+                                    email='MODIFYFIRST@example.com')
+
+        self.assertEqual(context.exception.codes,
+                         ('user-exists', 'email-exists'))
+
+    def test_own_name_in_other_case(self):
+        """Users may change the case of their own names."""
+
+        self.second.modify_info(username='ModifySecond')
+
+        self.assertEqual(models.Users.users.get(pk=self.second.pk).username,
+                         'ModifySecond')
+
+
+class AvailabilityTest(TestCase):
+    """Tests for the availability filters."""
+
+    multi_db = True
+
+    def test_miss_skips_query(self):
+        """Names missing from the filter are available without a query."""
+
+        filters = availability.AvailabilityFilter(300, 300)
+        filters.ensure_built()
+
+        with capture_all_queries() as queries:
+            self.assertTrue(filters.username_available('nowhere'))
+            self.assertTrue(filters.email_available('nowhere@example.com'))
+
+        self.assertEqual(queries, [])
+
+    def test_hit_confirmed(self):
+        """Names in the filter but free in the database are available."""
+
+        filters = availability.AvailabilityFilter(300, 300)
+        filters.ensure_built()
+        filters.usernames.add('renamedaway')
+
+        self.assertTrue(filters.username_available('RenamedAway'))
+
+    def test_version_bump_rebuilds(self):
+        """Names taken in other processes are seen after the stamp check."""
+
+        filters = availability.AvailabilityFilter(300, 0)
+        filters.ensure_built()
+
+        # Sends no post_save, as if created by another process
+        models.Users.users.bulk_create([models.Users(username='elsewhere',
+            username_lower='elsewhere', email='elsewhere@example.com',
+            email_lower='elsewhere@example.com')])
+        availability.bump_version()
+
+        self.assertFalse(filters.username_available('Elsewhere'))
+        self.assertFalse(filters.email_available('ELSEWHERE@example.com'))
+
+    def test_bump_only_on_rename(self):
+        """Only renames bump the version stamp; creations and saves don't."""
+
+        meta.models.Data.objects.populate()
+
+        with mock.patch.object(availability, 'bump_version') as bump:
+            user_object = models.Users.users.create(username='bumptest',
+                email='bumptest@example.com', password='BumpTest123')
+            user_object.save()
+
+            self.assertEqual(bump.call_count, 0)
+
+            user_object.modify_info(username='bumprenamed')
+
+            self.assertEqual(bump.call_count, 1)
+
+    def test_bulk_created_added(self):
+        """Bulk created users are added to this process's filters."""
+
+        availability.filters.ensure_built()
+
+        models.Users.users.create_bulk([{'username': 'bulkfilter',
+            'email': 'bulkfilter@example.com', 'password': 'BulkTest123'}])
+
+        self.assertIn('bulkfilter', availability.filters.usernames)
+        self.assertIn('bulkfilter@example.com', availability.filters.emails)
+
+
+class CreateBulkTest(TestCase):
+    """Tests for UserManager.create_bulk and the provisionusers command."""
+
+    multi_db = True
+
+    def setUp(self):
+        meta.models.Data.objects.populate()
+
+        models.Users.users.create(username='bulkexisting',
+            email='bulkexisting@example.com', password='BulkTest123')
+
+    def row(self, username, password='BulkTest123'):
+        """Returns roster row of given username."""
+
+        return {'username': username, 'email': '%s@example.com' % username,
+                'password': password}
+
+    def test_reports(self):
+        """Rows are reported created, invalid or taken, in row order."""
+
+        reports = models.Users.users.create_bulk([self.row('bulkfirst'),
+            {'username': 'bulkbad', 'email': 'bulkbad@example.com'},
+            self.row('BulkExisting'),
+            self.row('bulkfirst'), self.row('bulksecond')])
+
+        self.assertEqual([report['created'] for report in reports],
+                         [True, False, False, False, True])
+        self.assertEqual(reports[1]['errors'], ('password-required',))
+        self.assertEqual(reports[2]['errors'],
+                         ('user-exists', 'email-exists'))
+        self.assertEqual(reports[3]['errors'],
+                         ('user-exists', 'email-exists'))
+        self.assertTrue(models.Users.users.login_password(
+            username='bulksecond', password='BulkTest123'))
+
+    def test_hash_timeout(self):
+        """Rows are reported failed, and none created, if hashing times out."""
+
+        with mock.patch.object(hashing, 'hashpw_many',
+                               side_effect=models.TimeoutError):
+            reports = models.Users.users.create_bulk([self.row('bulkfirst'),
+                self.row('bulksecond')])
+
+        self.assertEqual([report['errors'] for report in reports],
+                         [(hashing.HASHING_TIMEOUT,)] * 2)
+        self.assertFalse(models.Users.users.filter(
+            username_lower__in=['bulkfirst', 'bulksecond']).exists())
+
+    def test_concurrent_conflict(self):
+        """Rows taken while hashing are reported; the rest are created."""
+
+        taken_in_bulk = models.Users.users.taken_in_bulk
+        checks = []
+
+        def racing_taken_in_bulk(validated_rows):
+            # The first check misses a user created concurrently
+            checks.append(validated_rows)
+
+            if len(checks) == 1:
+                return set(), set()
+
+            return taken_in_bulk(validated_rows)
+
+        with mock.patch.object(models.Users.users, 'taken_in_bulk',
+                               side_effect=racing_taken_in_bulk):
+            reports = models.Users.users.create_bulk([self.row('bulkfirst'),
+                self.row('bulkexisting')])
+
+        self.assertTrue(reports[0]['created'])
+        self.assertEqual(reports[1]['errors'],
+                         ('user-exists', 'email-exists'))
+        self.assertEqual(models.Users.users.filter(
+            username_lower='bulkexisting').count(), 1)
+        user_id = models.Users.users.get(username_lower='bulkfirst').pk
+
+        self.assertEqual(models.Methods.objects.for_user(user_id).filter(
+            user_id=user_id).count(), 2)
+
+    def test_provisionusers(self):
+        """The command reports every row of a CSV roster."""
+
+        with tempfile.NamedTemporaryFile('w', suffix='.csv') as roster:
+            roster.write('username,email,password\n'
+                         'bulkfirst,bulkfirst@example.com,BulkTest123\n'
+                         'bulkexisting,bulkexisting@example.com,BulkTest123\n')
+            roster.flush()
+            output = io.StringIO()
+
+            call_command('provisionusers', roster.name, stdout=output)
+
+        lines = output.getvalue().splitlines()
+
+        self.assertEqual(lines[0], '1: created bulkfirst')
+        self.assertEqual(lines[1],
+                         '2: skipped bulkexisting (user-exists, email-exists)')
+        self.assertTrue(lines[2].startswith('Created 1 of 2 users'))
+
+
+class RandomStringsTest(SimpleTestCase):
+    """Tests for helpers.random_strings."""
+
+    def test_alphabet_and_size(self):
+        """Strings have the requested count, size and characters."""
+
+        strings = helpers.random_strings(200, size=7, chars='abc')
+
+        self.assertEqual(len(strings), 200)
+        self.assertEqual(set(len(string) for string in strings), set([7]))
+        self.assertEqual(set(''.join(strings)), set('abc'))
+
+    def test_default_alphabet(self):
+        """Default strings are alphanumeric and of size 10."""
+
+        for string in helpers.random_strings(50):
+            self.assertEqual(len(string), 10)
+            self.assertTrue(string.isalnum())
+
+    def test_empty(self):
+        """No strings are drawn for a count of zero."""
+
+        self.assertEqual(helpers.random_strings(0), [])
+
+
+class GenerateManyTest(TestCase):
+    """Tests for TokenManager.generate_many."""
+
+    multi_db = True
+
+    def test_generates_unique(self):
+        """Batches larger than a lookup chunk are stored and unique."""
+
+        count = models.TOKEN_LOOKUP_CHUNK * 2 + 1
+        tokens = models.Tokens.objects.generate_many(models.TOKEN_NEW_USER,
+                                                     count)
+
+        self.assertEqual(len(set(tokens)), count)
+        self.assertEqual(models.Tokens.objects.filter(
+            purpose=models.TOKEN_NEW_USER).count(), count)
+
+    def test_existing_redrawn(self):
+        """Drawn tokens already stored are replaced before inserting."""
+
+        stored = models.Tokens.objects.generate_many(models.TOKEN_NEW_USER,
+                                                     1)[0]
+        draws = [[stored, 'b' * models.TOKEN_SIZE], ['c' * models.TOKEN_SIZE]]
+
+        with mock.patch.object(models, 'random_strings',
+                               side_effect=draws) as draw:
+            tokens = models.Tokens.objects.generate_many(
+                models.TOKEN_NEW_USER, 2)
+
+        self.assertEqual(sorted(tokens), ['b' * models.TOKEN_SIZE,
+                                          'c' * models.TOKEN_SIZE])
+        self.assertEqual(draw.call_args_list[1][0][0], 1)
+
+    def test_collision_redraws_colliding(self):
+        """A collision on insert redraws only the colliding tokens."""
+
+        stored = models.Tokens.objects.generate_many(models.TOKEN_NEW_USER,
+                                                     1)[0]
+        draws = [[stored, 'b' * models.TOKEN_SIZE], ['c' * models.TOKEN_SIZE]]
+        existing = models.Tokens.objects.existing
+        lookups = []
+
+        def racing_existing(tokens, using):
+            # The first lookup misses a token inserted concurrently
+            lookups.append(set(tokens))
+
+            return set() if len(lookups) == 1 else existing(tokens, using)
+
+        with mock.patch.object(models, 'random_strings',
+                               side_effect=draws) as draw, \
+                mock.patch.object(models.Tokens.objects, 'existing',
+                                  side_effect=racing_existing):
+            tokens = models.Tokens.objects.generate_many(
+                models.TOKEN_NEW_USER, 2)
+
+        self.assertEqual(sorted(tokens), ['b' * models.TOKEN_SIZE,
+                                          'c' * models.TOKEN_SIZE])
+        self.assertEqual(draw.call_count, 2)
+        self.assertEqual(draw.call_args_list[1][0][0], 1)
+
+
+SHARDS = ['shard_test_a', 'shard_test_b']
+
+
+@override_settings(SHARD_DATABASES=SHARDS,
+                   SHARDED_MODELS=['authentication.methods'])
+class ShardingTest(TestCase):
+    """Tests for shard routing and the moveusershard command."""
+
+    multi_db = True
+
+    user_id = 4242
+
+    @classmethod
+    def setUpClass(cls):
+        # Added before the test case opens transactions on every alias
+        for alias in SHARDS:
+            connections.databases[alias] = {
+                'ENGINE': 'django.db.backends.sqlite3',
+                'NAME': ':memory:',
+            }
+            connections.ensure_defaults(alias)
+
+            connection = connections[alias]
+            statements, references = connection.creation.sql_create_model(
+                models.Methods, no_style())
+            cursor = connection.cursor()
+
+            for statement in statements:
+                cursor.execute(statement)
+
+        super(ShardingTest, cls).setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super(ShardingTest, cls).tearDownClass()
+
+        for alias in SHARDS:
+            # SQLite ignores close() of in-memory databases
+            connections[alias].connection.close()
+            delattr(connections._connections, alias)
+            del connections.databases[alias]
+
+    def tearDown(self):
+        # Rolled back directory rows send no signal to reset the cache
+        meta.models.shard_directory.aliases = None
+
+    def create_method(self):
+        """Saves a password method for user_id; returns its shard."""
+
+        models.Methods(user_id=self.user_id, method=models.METHOD_PASSWORD,
+                       password='unused', step=1).save()
+
+        return routers.shard_for(self.user_id)
+
+    def test_hashed_shard_stable(self):
+        """Ids always hash to the same shard, and all shards are used."""
+
+        shards = set(routers.hashed_shard(user_id)
+                     for user_id in range(1000))
+
+        self.assertEqual(routers.hashed_shard(self.user_id),
+                         routers.hashed_shard(self.user_id))
+        self.assertEqual(shards, set(settings.SHARD_DATABASES))
+
+    def test_rows_saved_to_shard(self):
+        """Saved rows land on the user's shard only."""
+
+        shard = self.create_method()
+
+        for alias in settings.SHARD_DATABASES:
+            self.assertEqual(models.Methods.objects.using(alias).filter(
+                user_id=self.user_id).count(), int(alias == shard))
+
+    def test_move_user(self):
+        """Moved rows leave the source and the directory follows them."""
+
+        source = self.create_method()
+        target = [alias for alias in settings.SHARD_DATABASES
+                  if alias != source][0]
+
+        call_command('moveusershard', str(self.user_id), target, wait=0)
+
+        self.assertEqual(routers.shard_for(self.user_id), target)
+        self.assertFalse(models.Methods.objects.using(source).filter(
+            user_id=self.user_id).exists())
+        self.assertTrue(models.Methods.objects.using(target).filter(
+            user_id=self.user_id).exists())
+
+    def test_move_user_to_populated_shard(self):
+        """Moved rows take new ids rather than clash with the target's."""
+
+        source = self.create_method()
+        target = [alias for alias in settings.SHARD_DATABASES
+                  if alias != source][0]
+        source_ids = list(models.Methods.objects.using(source).filter(
+            user_id=self.user_id).values_list('pk', flat=True))
+
+        # Occupies the moved row's id on the target
+        for pk in range(1, max(source_ids) + 1):
+            models.Methods(pk=pk, user_id=self.user_id + pk,
+                           method=models.METHOD_PASSWORD, password='unused',
+                           step=1).save(using=target, force_insert=True)
+
+        call_command('moveusershard', str(self.user_id), target, wait=0,
+                     stdout=io.StringIO())
+
+        moved = models.Methods.objects.using(target).get(user_id=self.user_id)
+
+        self.assertNotIn(moved.pk, source_ids)
+        self.assertEqual(moved.password, 'unused')
+        self.assertEqual(models.Methods.objects.using(target).count(),
+                         max(source_ids) + 1)
+
+    def test_move_user_carries_late_updates(self):
+        """Rows changed on the source after the copy reach the target."""
+
+        source = self.create_method()
+        target = [alias for alias in settings.SHARD_DATABASES
+                  if alias != source][0]
+        command = moveusershard.Command()
+
+        with transaction.atomic(using=source):
+            with transaction.atomic(using=target):
+                copied = command.copy([models.Methods], self.user_id,
+                                      source, target)
+
+        models.Methods.objects.using(source).filter(
+            user_id=self.user_id).update(status=models.METHOD_INACTIVE)
+        models.Methods(user_id=self.user_id, method=models.METHOD_OATH_KEY,
+                       token='late', step=2).save(using=source)
+
+        late = command.reconcile([models.Methods], self.user_id, source,
+                                 target, copied)
+
+        self.assertEqual(late, 2)
+        self.assertEqual(sorted(models.Methods.objects.using(target).filter(
+            user_id=self.user_id).values_list('method', 'status')), [
+            (models.METHOD_PASSWORD, models.METHOD_INACTIVE),
+            (models.METHOD_OATH_KEY, models.METHOD_ACTIVE)])
+
+    def test_login_with_sharded_methods(self):
+        """Users on the primary log in with methods on their shard."""
+
+        meta.models.Data.objects.populate()
+
+        user_object = models.Users.users.create(username='shardtest',
+            email='shardtest@example.com', password='ShardTest123')
+        shard = routers.shard_for(user_object.pk)
+
+        self.assertTrue(models.Methods.objects.using(shard).filter(
+            user_id=user_object.pk, method=models.METHOD_PASSWORD).exists())
+        self.assertEqual(models.Users.users.login_password(
+            username='shardtest', password='ShardTest123').pk,
+            user_object.pk)
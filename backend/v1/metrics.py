@@ -0,0 +1,28 @@
+"""Metrics backend, exposes performance metrics to Prometheus."""
+
+from django.conf import settings
+from django.http import HttpResponse, Http404
+from django.views.generic import View
+import hmac
+
+from Notesapp import metrics
+
+class MetricsView(View):
+    """Backend view that returns metrics of all workers on this host.
+
+    Only answers requests with an 'Authorization: Bearer <token>' header
+    carrying METRICS_TOKEN; nothing is served while it is unset.
+    """
+
+    def get(self, request, *args, **kwargs):
+        token = getattr(settings, 'METRICS_TOKEN', None)
+        header = request.META.get('HTTP_AUTHORIZATION', '')
+        scheme, _, given = header.partition(' ')
+
+        if not token or scheme.lower() != 'bearer' or \
+                not hmac.compare_digest(given.strip().encode('utf-8'),
+                                        token.encode('utf-8')):
+            raise Http404
+
+        return HttpResponse(metrics.render_all(),
+                            content_type='text/plain; version=0.0.4')
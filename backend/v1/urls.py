@@ -1,7 +1,7 @@
 """URL router for backend version 1."""
 
 from django.conf.urls import patterns, include, url
-from backend.v1 import validator
+from backend.v1 import metrics, validator
 
 validator_list = patterns('',
     url(r'password', validator.PasswordValidatorView.as_view()),
@@ -10,5 +10,6 @@ validator_list = patterns('',
 )
 
 urlpatterns = patterns('',
-    url(r'validator/', include(validator_list))
+    url(r'validator/', include(validator_list)),
+    url(r'metrics', metrics.MetricsView.as_view())
 )
\ No newline at end of file
@@ -1,11 +1,11 @@
 """Validator backend, handles client-side validation."""
 
 from django.views.generic import View
-import authentication.models
+from authentication.availability import filters
 
 from backend.v1.generic import BackendApiMixin
 from errors import validators
-from ratelimit.mixins import RateLimitMixin
+from common.ratelimit import RateLimitMixin
 
 class PasswordValidatorView(BackendApiMixin, View):
     """Backend view that validates POST 'password' against validator."""
@@ -34,7 +34,7 @@ class UsernameAvailabilityView(RateLimitMixin, BackendApiMixin, View):
     """Backend view that checks to see if username is available."""
 
     ratelimit_block = True
-    ratelimit_rate = '1/s'
+    ratelimit_rate = '10/s'
 
     def post(self, request, *args, **kwargs):
 
@@ -45,8 +45,7 @@ class UsernameAvailabilityView(RateLimitMixin, BackendApiMixin, View):
             self.status = 404
             return self.json_response(request, *args, **kwargs)
 
-        if authentication.models.Users.users.user_exists(
-                username=test_username):
+        if not filters.username_available(test_username):
             self.message = 'Username taken.'
             self.status = 404
             return self.json_response(request, *args, **kwargs)
@@ -59,7 +58,7 @@ class EmailAvailabilityView(RateLimitMixin, BackendApiMixin, View):
     """Backend view that checks to see if username is available."""
 
     ratelimit_block = True
-    ratelimit_rate = '1/s'
+    ratelimit_rate = '10/s'
 
     def post(self, request, *args, **kwargs):
 
@@ -70,7 +69,7 @@ class EmailAvailabilityView(RateLimitMixin, BackendApiMixin, View):
             self.status = 404
             return self.json_response(request, *args, **kwargs)
 
-        if authentication.models.Users.users.email_exists(email=test_email):
+        if not filters.email_available(test_email):
             self.message = 'Email taken.'
             self.status = 404
             return self.json_response(request, *args, **kwargs)
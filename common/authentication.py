@@ -2,7 +2,7 @@
 
 from django.views.generic import View
 from django.views.generic.base import TemplateResponseMixin, ContextMixin
-from ratelimit.mixins import RateLimitMixin
+from common.ratelimit import RateLimitMixin
 from authentication import models
 from common.generic import CleanRequestMixin
 from errors.exceptions import UserError
@@ -0,0 +1,132 @@
+"""Compact probabilistic set membership.
+
+A Bloom filter answers "definitely not present" or "possibly present"
+for an item while using a few bits per item. False positives occur at
+roughly the error rate given on creation; false negatives never occur.
+Items must be strings.
+
+Filters may be saved to disk and loaded back memory-mapped and read
+only, so one large filter is shared by every process on a machine
+through the page cache rather than copied into each.
+"""
+
+import hashlib
+import math
+import mmap
+import os
+import struct
+
+# On-disk layout: magic, size, hashes, capacity, count, then the bits
+FILE_MAGIC = b'BLOOM\x00\x00\x01'
+FILE_HEADER = struct.Struct('>8sQIQQ')
+
+
+class BloomFilter(object):
+    """Bloom filter over strings, backed by a bytearray.
+
+    Attributes:
+        size: number of bits in the filter.
+        hashes: number of bit positions set per item.
+        count: number of items added since creation.
+    """
+
+    def __init__(self, capacity, error_rate=0.01):
+        """Sizes filter for capacity items at the given error rate.
+
+        Args:
+            capacity: expected number of items.
+            error_rate: acceptable false positive rate, 0 < rate < 1.
+        """
+
+        capacity = max(capacity, 1)
+
+        self.size = int(math.ceil(-capacity * math.log(error_rate) /
+                                  (math.log(2) ** 2)))
+        self.hashes = max(int(round(self.size / capacity * math.log(2))), 1)
+        self.capacity = capacity
+        self.count = 0
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, item):
+        """Yields bit positions for item using double hashing."""
+
+        digest = hashlib.sha1(item.encode('utf-8')).digest()
+        first = int.from_bytes(digest[:8], 'big')
+        second = int.from_bytes(digest[8:16], 'big') | 1
+
+        for i in range(self.hashes):
+            yield (first + i * second) % self.size
+
+    def add(self, item):
+        """Adds item to the filter."""
+
+        for position in self._positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+        self.count += 1
+
+    def __contains__(self, item):
+        """Returns false if item is definitely not in the filter."""
+
+        return all(self.bits[position >> 3] & (1 << (position & 7))
+                   for position in self._positions(item))
+
+    def saturated(self):
+        """Returns true if more items were added than it was sized for."""
+
+        return self.count > self.capacity
+
+    def save(self, path):
+        """Writes filter to path, replacing any file atomically.
+
+        Args:
+            path: file to write.
+        """
+
+        temporary = path + '.tmp'
+
+        with open(temporary, 'wb') as output:
+            output.write(FILE_HEADER.pack(FILE_MAGIC, self.size, self.hashes,
+                                          self.capacity, self.count))
+            output.write(self.bits)
+
+        os.replace(temporary, path)
+
+    @classmethod
+    def load(cls, path):
+        """Loads filter saved with save(), memory-mapped read only.
+
+        The loaded filter can't be added to.
+
+        Args:
+            path: file to load.
+
+        Returns:
+            BloomFilter whose bits are backed by the mapped file.
+
+        Raises:
+            IOError: if the file can't be opened.
+            ValueError: if the file is not a saved filter.
+        """
+
+        with open(path, 'rb') as source:
+            mapped = mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if len(mapped) < FILE_HEADER.size:
+            raise ValueError('%s is not a Bloom filter file.' % path)
+
+        magic, size, hashes, capacity, count = \
+            FILE_HEADER.unpack_from(mapped)
+
+        if magic != FILE_MAGIC or \
+                len(mapped) != FILE_HEADER.size + (size + 7) // 8:
+            raise ValueError('%s is not a Bloom filter file.' % path)
+
+        bloom = cls.__new__(cls)
+        bloom.size = size
+        bloom.hashes = hashes
+        bloom.capacity = capacity
+        bloom.count = count
+        bloom.bits = memoryview(mapped)[FILE_HEADER.size:]
+
+        return bloom
@@ -14,7 +14,7 @@ class HomeView(TemplateView):
         context = super(HomeView, self).get_context_data(**kwargs)
 
         token_required = False
-        token_object = meta.models.Data.objects.get(tag='new-users')
+        token_object = meta.models.Data.objects.get_cached('new-users')
 
         if token_object.setting == 0 and token_object.data == 'token':
             token_required = True
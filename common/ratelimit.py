@@ -0,0 +1,94 @@
+"""Rate limiting with atomic counters.
+
+django-ratelimit counts hits with get_many() then set_many(), so two
+requests counted at once can both read the same count and one hit is
+lost. set_many() also pushes back the expiry on every hit, so a client
+that keeps requesting is counted in one ever-growing window.
+
+RateLimitMixin here is configured like django-ratelimit's, but counts
+each key with add() and then incr(). Both are atomic in the
+shared-memory cache used for RATELIMIT_USE_CACHE, and incr() keeps the
+expiry set by add().
+
+Hits are counted in fixed windows of the rate's period, but a key is
+judged by a sliding window: the current window's count plus the
+previous window's, weighted by how much of the previous window the
+sliding window still covers. A client bursting across a window
+boundary is therefore held to about the rate, not twice it.
+"""
+
+import time
+from django.conf import settings
+from django.core.cache import get_cache
+from ratelimit import helpers, mixins
+from ratelimit.exceptions import Ratelimited
+
+
+def count_hit(cache, key, period):
+    """Counts a hit on key in a sliding window of period seconds.
+
+    Returns:
+        Estimated hits in the last period seconds, including this one.
+    """
+
+    now = time.time()
+    window = int(now // period)
+    current_key = '%s:%d' % (key, window)
+    # Kept through the next window, where it is the previous one
+    timeout = 2 * period
+
+    if cache.add(current_key, 1, timeout):
+        current = 1
+    else:
+        try:
+            current = cache.incr(current_key)
+        except ValueError:
+            # Expired between add() and incr()
+            cache.add(current_key, 1, timeout)
+            current = 1
+
+    previous = cache.get('%s:%d' % (key, window - 1)) or 0
+    overlap = 1 - (now - window * period) / period
+
+    return previous * overlap + current
+
+
+def is_ratelimited(request, ip=True, method=['POST'], field=None,
+                   rate='5/m', keys=None):
+    """Counts request against its keys; see ratelimit.helpers.
+
+    Returns:
+        Bool; true if any key is over the rate.
+    """
+
+    request.limited = getattr(request, 'limited', False)
+
+    if request.limited or not helpers.RATELIMIT_ENABLE or \
+            not helpers._method_match(request, method):
+        return request.limited
+
+    limit, period = helpers._split_rate(rate)
+    cache = get_cache(getattr(settings, 'RATELIMIT_USE_CACHE', 'default'))
+
+    for key in helpers._get_keys(request, ip, field, keys):
+        if count_hit(cache, key, period) > limit:
+            request.limited = True
+
+    return request.limited
+
+
+class RateLimitMixin(mixins.RateLimitMixin):
+    """django-ratelimit's RateLimitMixin, counting with add and incr."""
+
+    def dispatch(self, request, *args, **kwargs):
+        config = self.get_ratelimit_config()
+        block = config.pop('block', False)
+        skip_if = config.pop('skip_if', None)
+
+        if skip_if is None or not skip_if(request):
+            if is_ratelimited(request, **config) and block:
+                raise Ratelimited()
+
+        # Skips django-ratelimit's own counting in its dispatch()
+        return super(mixins.RateLimitMixin, self).dispatch(request, *args,
+                                                           **kwargs)
@@ -0,0 +1,94 @@
+"""Benchmarks compiled schemas against per-call Voluptuous schemas."""
+
+from optparse import make_option
+import timeit
+from django.core.management.base import BaseCommand
+from voluptuous import Schema, All, Required, Match, MultipleInvalid
+
+from authentication import models
+from errors import validators
+
+# Requests covering the valid path and each kind of error
+SAMPLES = (
+    {'username': 'student_1', 'first_name': 'Ada', 'last_name': 'Byron',
+     'email': 'ada@example.com', 'password': 'Analytical-Engine1'},
+    {'username': 'student 1', 'email': 'ada@example', 'password': 'short'},
+    {'username': 'student_1', 'password': 'Analytical-Engine1'},
+    {'username': 'student_1', 'email': 'ada@example.com',
+     'password': 'Analytical-Engine1', 'admin': '1'},
+    {'username': 1, 'email': 'ada@example.com', 'password': None},
+    {},
+)
+
+
+def voluptuous_creation_schema():
+    """Builds the Voluptuous schema create() used to build per call."""
+
+    _ = lambda s: s
+
+    return Schema({
+        Required('username', _('username-required')): All(str,
+            Match(validators.VALID_USERNAME_REGEX),
+            msg=_('invalid-username')),
+        'first_name': All(str, Match(validators.VALID_NAME_REGEX),
+            msg=_('invalid-first-name')),
+        'last_name': All(str, Match(validators.VALID_NAME_REGEX),
+            msg=_('invalid-last-name')),
+        Required('email', _('email-required')): All(str,
+            Match(validators.VALID_EMAIL_REGEX),
+            msg=_('invalid-email')),
+        Required('password', _('password-required')): All(str,
+            validators.Password, msg=_('invalid-password')),
+    })
+
+
+def voluptuous_check(data):
+    """Validates data as create() did, returning error codes."""
+
+    try:
+        voluptuous_creation_schema()(data)
+    except MultipleInvalid as error:
+        return validators.list_errors(error)
+
+    return ()
+
+
+def compiled_check(data):
+    """Validates data with the compiled creation schema."""
+
+    return models.CREATION_SCHEMA.check(data)[1]
+
+
+class Command(BaseCommand):
+    """Measures per-call cost of validating user creation requests.
+
+    Checks first that both engines give the same error codes for every
+    sample request, then reports microseconds per call for each.
+    """
+
+    help = 'Benchmarks compiled schemas against Voluptuous schemas.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--calls', type='int', dest='calls', default=10000,
+                    help='Validations timed per engine and sample.'),
+    )
+
+    def handle(self, *args, **options):
+        calls = options['calls']
+
+        for data in SAMPLES:
+            expected = voluptuous_check(data)
+            actual = compiled_check(data)
+
+            # Voluptuous orders missing required keys arbitrarily
+            if sorted(expected) != sorted(actual):
+                self.stdout.write('MISMATCH %r: %r != %r' % (
+                    data, expected, actual))
+
+        for name, check in (('voluptuous', voluptuous_check),
+                            ('compiled', compiled_check)):
+            elapsed = sum(timeit.timeit(lambda: check(data), number=calls)
+                          for data in SAMPLES)
+
+            self.stdout.write('%-12s %8.2fus/call' % (
+                name, elapsed / (calls * len(SAMPLES)) * 1e6))
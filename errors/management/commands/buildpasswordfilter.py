@@ -0,0 +1,61 @@
+"""Builds the on-disk Bloom filter of weak passwords."""
+
+from optparse import make_option
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from common.bloom import BloomFilter
+from errors import validators
+
+
+class Command(BaseCommand):
+    """Builds a weak password filter from a word list, one per line.
+
+    Words are stripped and lowercased. Words shorter than the policy
+    minimum are skipped, since they are rejected anyway; this keeps the
+    filter small. The filter is written to --output, or to the
+    WEAK_PASSWORD_FILTER setting if not given.
+    Running workers map the new file when they next start.
+    """
+
+    args = '<wordlist>'
+    help = 'Builds the weak password Bloom filter from a word list.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--output', dest='output', default=None,
+                    help='Filter file to write.'),
+        make_option('--error-rate', type='float', dest='error_rate',
+                    default=0.001, help='False positive rate of filter.'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Expected path of a single word list.')
+
+        output = options['output'] or getattr(settings,
+                                              'WEAK_PASSWORD_FILTER', None)
+
+        if not output:
+            raise CommandError('Give --output or set WEAK_PASSWORD_FILTER.')
+
+        words = set()
+
+        try:
+            with open(args[0], encoding='utf-8', errors='ignore') as source:
+                for line in source:
+                    word = line.strip().lower()
+
+                    if len(word) >= validators.PASSWORD_MIN_SIZE:
+                        words.add(word)
+        except IOError as error:
+            raise CommandError('Could not read word list: %s' % error)
+
+        bloom = BloomFilter(len(words), options['error_rate'])
+
+        for word in words:
+            bloom.add(word)
+
+        bloom.save(output)
+
+        self.stdout.write('Stored %d words in %d bytes at %s.' % (
+            len(words), len(bloom.bits), output))
@@ -1,5 +1,68 @@
 """Django test module for testing error package."""
 
+import os
+import random
+import string
+import tempfile
 from django.test import TestCase
+from django.test.utils import override_settings
 
-# TODO Create Tests
\ No newline at end of file
+from common.bloom import BloomFilter
+from errors import validators
+
+
+def regex_password(password):
+    """Checks password with VALID_PASSWORD_REGEX, the reference policy."""
+
+    match = validators.VALID_PASSWORD_REGEX.match(password.strip())
+
+    if not match:
+        return False
+
+    captures = match.groupdict()
+
+    if captures['phrase']:
+        return True
+
+    return sum(1 for key in ('lower', 'upper', 'number', 'special')
+               if captures[key]) >= validators.PASSWORD_CONDITIONS
+
+
+class PasswordPolicyTest(TestCase):
+    """Tests for validators.meets_policy and valid_password."""
+
+    def tearDown(self):
+        validators._weak_passwords = None
+
+    def test_matches_regex(self):
+        """Scanner accepts and rejects exactly what the regex does."""
+
+        generator = random.Random(0)
+        pools = (string.printable + '\xe9', 'aA1!', 'abc', 'ABC1', '!@ ')
+
+        for each in range(20000):
+            pool = generator.choice(pools)
+            password = ''.join(generator.choice(pool)
+                               for size in range(generator.randint(0, 60)))
+
+            self.assertEqual(validators.meets_policy(password),
+                             regex_password(password), repr(password))
+
+    def test_weak_password_filter(self):
+        """Passwords in the weak password filter are rejected."""
+
+        bloom = BloomFilter(10)
+        bloom.add('password123')
+        handle, path = tempfile.mkstemp()
+        os.close(handle)
+
+        try:
+            bloom.save(path)
+
+            with override_settings(WEAK_PASSWORD_FILTER=path):
+                validators._weak_passwords = None
+
+                self.assertFalse(validators.valid_password('Password123'))
+                self.assertTrue(validators.valid_password('Unlisted-123'))
+        finally:
+            os.remove(path)
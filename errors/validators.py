@@ -7,9 +7,17 @@ https://github.com/alecthomas/voluptuous
 
 All custom validators should be implemented here and then used in
 modules that require them. This module also defines helper functions
-to use Voluptuous or other third-party validation engines. If the
-project sprouts its own validation engine, it will be defined in this
-module.
+to use Voluptuous or other third-party validation engines.
+
+The project's own validation engine is also defined here. Request
+schemas are compiled once at import time into CompiledSchema objects
+made of Field validators, which check a whole request dict in one pass
+and produce the same error codes as list_errors does for the
+equivalent Voluptuous schema:
+
+LOGIN_SCHEMA = CompiledSchema({
+    'username': Field('invalid-username', required='username-required'),
+})
 
 Wrap custom validators with message('<<<false message>>>') and truth
 decorators:
@@ -25,7 +33,15 @@ compatibility, CamelCase should be used for validators here.
 """
 
 from voluptuous import message, truth
+from django.conf import settings
+import logging
 import re
+import string
+
+from common.bloom import BloomFilter
+from errors.exceptions import UserError
+
+logger = logging.getLogger(__name__)
 
 # Authentication
 
@@ -70,6 +86,24 @@ VALID_PASSWORD_REGEX = re.compile(r"""
 """, re.VERBOSE)
 VALID_TOKEN_REGEX = re.compile(r'^[A-Za-z0-9]{1,50}$')
 
+# Password policy constants; VALID_PASSWORD_REGEX documents the policy,
+# meets_policy implements it without backtracking
+PASSWORD_PHRASE_SIZE = 16 # Passwords this long need no other conditions
+PASSWORD_MIN_SIZE = 8
+PASSWORD_CONDITIONS = 2 # Number of character classes required
+PASSWORD_LOWER = 1
+PASSWORD_UPPER = 2
+PASSWORD_NUMBER = 4
+PASSWORD_SPECIAL = 8
+# Maps every allowed character to its class bit
+PASSWORD_CLASSES = dict(
+    [(char, PASSWORD_LOWER) for char in string.ascii_lowercase] +
+    [(char, PASSWORD_UPPER) for char in string.ascii_uppercase] +
+    [(char, PASSWORD_NUMBER) for char in string.digits] +
+    [(char, PASSWORD_SPECIAL) for char in string.punctuation + ' '])
+
+_weak_passwords = None # Loaded by weak_password_filter
+
 def list_errors(multiple_invalid_exception):
     """Helper function that extracts errors from MultipleInvalid.
 
@@ -91,27 +125,204 @@ def list_errors(multiple_invalid_exception):
     return tuple(error_list)
 
 
-@truth
-def Password(password):
-    """Validator that checks to make sure a password is valid."""
+def meets_policy(password):
+    """Checks password against the password policy in a single pass.
+
+    Accepts exactly what VALID_PASSWORD_REGEX accepts, after stripping
+    surrounding whitespace: passwords whose first 16 characters are
+    allowed characters (the phrase branch of the regex is not anchored
+    at the end), or passwords of 8 to 15 allowed characters meeting at
+    least PASSWORD_CONDITIONS of lower, upper, number and special.
+
+    Returns:
+        Bool; true if password meets the policy.
+    """
+
+    password = password.strip()
+    length = len(password)
+
+    if length >= PASSWORD_PHRASE_SIZE:
+        for char in password[:PASSWORD_PHRASE_SIZE]:
+            if char not in PASSWORD_CLASSES:
+                return False
+
+        return True
+
+    if length < PASSWORD_MIN_SIZE:
+        return False
+
+    found = 0
+
+    for char in password:
+        kind = PASSWORD_CLASSES.get(char)
 
-    match = VALID_PASSWORD_REGEX.match(password.strip())
+        if kind is None:
+            return False
 
-    if not match:
+        found |= kind
+
+    return bin(found).count('1') >= PASSWORD_CONDITIONS
+
+
+def weak_password_filter():
+    """Returns memory-mapped filter of weak passwords, or None.
+
+    The file named by the WEAK_PASSWORD_FILTER setting is mapped once
+    per process; pages are shared by every worker on the machine. See
+    the buildpasswordfilter command.
+    """
+
+    global _weak_passwords
+
+    if _weak_passwords is None:
+        path = getattr(settings, 'WEAK_PASSWORD_FILTER', None)
+        _weak_passwords = False
+
+        if path:
+            try:
+                _weak_passwords = BloomFilter.load(path)
+            except (IOError, ValueError) as error:
+                logger.warning('Weak password filter not loaded: %s', error)
+
+    return _weak_passwords or None
+
+
+def valid_password(password):
+    """Checks to make sure a password is valid. Returns bool.
+
+    Passwords must meet the policy and, if a weak password filter is
+    configured, must not be in it. The filter holds lowercased words.
+    """
+
+    if not meets_policy(password):
         return False
 
-    captures = match.groupdict()
-    condition_keys = ('lower', 'upper', 'number', 'special')
-    num_conditions = 2 # Number of conditions required
+    weak_passwords = weak_password_filter()
+
+    if weak_passwords is not None and \
+            password.strip().lower() in weak_passwords:
+        return False
+
+    return True
+
+
+# Voluptuous validator form of valid_password
+Password = truth(valid_password)
+
+
+# Validation engine
+
+INVALID_REQUEST = 'invalid-request'
+# Voluptuous message for extra keys; kept so codes match list_errors
+EXTRA_KEYS = 'extra keys not allowed'
+
+
+class Field(object):
+    """Compiled validator for a single string value of a request.
+
+    Values must be str and pass every check; any failure gives the one
+    error code of the field, as All(str, ..., msg=message) does.
+
+    Args:
+        message: error code given when the value does not validate.
+        checks: compiled regexes, matched from the start of the value,
+            or functions taking the value and returning bool.
+        required: error code given when the key is missing; optional
+            keys leave this as None.
+    """
+
+    __slots__ = ('message', 'checks', 'required')
+
+    def __init__(self, message, *checks, required=None):
+        self.message = message
+        self.checks = tuple(getattr(check, 'match', check)
+                            for check in checks)
+        self.required = required
+
+    def valid(self, value):
+        """Returns true if value passes all checks."""
+
+        if not isinstance(value, str):
+            return False
+
+        for check in self.checks:
+            if not check(value):
+                return False
 
-    if captures['phrase']:
         return True
-    else:
-        # List comprehension that sums the number of met conditions
-        count = sum(1 for key in captures.keys() if key in condition_keys\
-                    and captures[key])
 
-        if count >= num_conditions:
-            return True
 
-    return False
\ No newline at end of file
+class CompiledSchema(object):
+    """Validates request dicts against a fixed set of Fields.
+
+    Built once and reused for every call. Errors are ordered as
+    Voluptuous orders them: one per invalid or unknown key in request
+    order, then missing required keys in declaration order.
+
+    Args:
+        fields: dict of key names to Field objects.
+    """
+
+    def __init__(self, fields):
+        self.fields = dict(fields)
+        self.required = tuple((key, field.required) for key, field
+                              in self.fields.items()
+                              if field.required)
+
+    def check(self, data):
+        """Validates data without raising.
+
+        Args:
+            data: request dict.
+
+        Returns:
+            Tuple of validated dict and tuple of error codes, which is
+            empty if data is valid.
+        """
+
+        if not isinstance(data, dict):
+            return {}, (INVALID_REQUEST,)
+
+        validated = {}
+        errors = []
+        fields = self.fields
+
+        for key, value in data.items():
+            field = fields.get(key)
+
+            if field is None:
+                errors.append(EXTRA_KEYS)
+            elif field.valid(value):
+                validated[key] = value
+            else:
+                errors.append(field.message)
+
+        for key, message in self.required:
+            if key not in data:
+                errors.append(message)
+
+        # Mirrors list_errors, which reports only this if it comes first
+        if errors and errors[0] == EXTRA_KEYS:
+            return validated, (INVALID_REQUEST,)
+
+        return validated, tuple(errors)
+
+    def __call__(self, data):
+        """Validates data.
+
+        Args:
+            data: request dict.
+
+        Returns:
+            New dict holding the validated keys.
+
+        Raises:
+            UserError: contains error codes.
+        """
+
+        validated, errors = self.check(data)
+
+        if errors:
+            raise UserError(*errors)
+
+        return validated
\ No newline at end of file
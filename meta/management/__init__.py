@@ -0,0 +1 @@
+"""Management commands for meta."""
@@ -0,0 +1,196 @@
+"""Moves a user's sharded rows to another shard while online."""
+
+from optparse import make_option
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import get_model
+import logging
+import time
+
+import meta.models
+from Notesapp.routers import shard_for
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    """Moves every SHARDED_MODELS row of a user to another shard.
+
+    The move happens in three steps:
+        1. The user's rows are locked on the source shard, copied to
+           the target and the directory is pointed at the target, so
+           writers block rather than write to the source mid-copy.
+        2. The command waits --wait seconds, by default long enough for
+           every process to reload the directory.
+        3. Source rows are locked again and compared with what was
+           copied. Rows that processes which had not yet reloaded
+           inserted, updated or deleted on the source are carried over
+           to the target, then the source rows are deleted. Rows left
+           alone on the source keep any newer writes made on the target.
+
+    Shards number rows from their own sequences, so copies are inserted
+    without their primary keys and take new ones from the target's
+    sequence. Rows are matched to their copies through a map of source
+    to target keys.
+    """
+
+    args = '<user_id> <alias>'
+    help = "Moves a user's sharded rows to another shard."
+
+    option_list = BaseCommand.option_list + (
+        make_option('--wait', type='float', dest='wait', default=None,
+                    help='Seconds to wait before deleting source rows.'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 2:
+            raise CommandError('Expected user id and target alias.')
+
+        try:
+            user_id = int(args[0])
+        except ValueError:
+            raise CommandError('User id must be an integer.')
+
+        target = args[1]
+
+        if target not in getattr(settings, 'SHARD_DATABASES', ()):
+            raise CommandError('%s is not in SHARD_DATABASES.' % target)
+
+        source = shard_for(user_id)
+
+        if source == target:
+            raise CommandError('User %d is already on %s.' % (user_id,
+                                                             target))
+
+        sharded_models = [get_model(*label.split('.'))
+                          for label in settings.SHARDED_MODELS]
+        wait = options['wait']
+
+        if wait is None:
+            wait = getattr(settings, 'META_DATA_CHECK_INTERVAL', 1) + 1
+
+        with transaction.atomic(using=source):
+            with transaction.atomic(using=target):
+                copied = self.copy(sharded_models, user_id, source, target)
+
+            meta.models.Shards.objects.assign(user_id, target)
+
+        copied_count = sum(len(rows) for rows in copied.values())
+        logger.info('User %d directed to %s; %d rows copied.', user_id,
+                    target, copied_count)
+
+        time.sleep(wait)
+
+        with transaction.atomic(using=source):
+            with transaction.atomic(using=target):
+                late = self.reconcile(sharded_models, user_id, source,
+                                      target, copied)
+
+            for model in sharded_models:
+                model.objects.using(source).filter(user_id=user_id).delete()
+
+        self.stdout.write('Moved user %d from %s to %s: %d rows, %d late.' % (
+            user_id, source, target, copied_count, late))
+
+    def copy(self, sharded_models, user_id, source, target):
+        """Copies user's rows from source to target, locking the source.
+
+        Leftovers of a failed move on target are replaced.
+
+        Args:
+            sharded_models: models to copy.
+            user_id: user whose rows are copied.
+            source: alias rows are copied from.
+            target: alias rows are copied to.
+
+        Returns:
+            Dict of model to dict of source primary key to tuples of
+            target primary key and values as copied.
+        """
+
+        copied = dict()
+
+        for model in sharded_models:
+            rows = list(model.objects.using(source).select_for_update()
+                        .filter(user_id=user_id))
+
+            model.objects.using(target).filter(user_id=user_id).delete()
+            copied[model] = dict((row.pk, (insert_copy(row, target),
+                                           row_values(row))) for row in rows)
+
+        return copied
+
+    def reconcile(self, sharded_models, user_id, source, target, copied):
+        """Carries writes made on the source since copy() to target.
+
+        Source rows are locked and diffed against the copied values, so
+        rows updated during the wait overwrite the target's rows rather
+        than being skipped as already present.
+
+        Args:
+            sharded_models: models to reconcile.
+            user_id: user whose rows are reconciled.
+            source: alias rows were copied from.
+            target: alias rows were copied to.
+            copied: values returned by copy().
+
+        Returns:
+            Number of rows inserted, updated or deleted on target.
+        """
+
+        changed = 0
+
+        for model in sharded_models:
+            before = copied[model]
+            rows = list(model.objects.using(source).select_for_update()
+                        .filter(user_id=user_id))
+            target_rows = model._base_manager.using(target)
+
+            for row in rows:
+                values = row_values(row)
+                target_pk, copied_values = before.get(row.pk, (None, None))
+
+                if copied_values == values:
+                    continue
+
+                # Updates in place so auto_now fields keep source values
+                if target_pk is None or not target_rows.filter(
+                        pk=target_pk).update(**values):
+                    insert_copy(row, target)
+
+                changed += 1
+
+            remaining = set(row.pk for row in rows)
+            deleted = [target_pk for pk, (target_pk, copied_values) in
+                       before.items() if pk not in remaining]
+
+            if deleted:
+                target_rows.filter(pk__in=deleted).delete()
+                changed += len(deleted)
+
+        return changed
+
+
+def insert_copy(row, alias):
+    """Inserts copy of row into alias under a new primary key.
+
+    Inserts raw values, so auto_now fields keep the source's values.
+
+    Returns:
+        Primary key of the copy.
+    """
+
+    fields = [field for field in row._meta.concrete_fields
+              if not field.primary_key]
+
+    return row._meta.model._base_manager._insert([row], fields=fields,
+        return_id=True, raw=True, using=alias)
+
+
+def row_values(row):
+    """Returns dict of field name to value of row, except primary key."""
+
+    return dict((field.name, getattr(row, field.attname))
+                for field in row._meta.concrete_fields
+                if not field.primary_key)
@@ -1,6 +1,27 @@
-"""Metadata key-value pair model."""
+"""Metadata key-value pair model.
 
+Data rows are read on nearly every request but rarely change, so reads
+should go through Data.objects.get_cached(), which serves all rows from
+a per-process copy. Saving or deleting a row bumps a version stamp in
+the cache; each process compares its copy against the stamp at most
+every META_DATA_CHECK_INTERVAL seconds and reloads when it changed.
+
+The shard directory, Shards, is cached the same way through
+shard_directory, under its own stamp so Data writes do not reload it;
+see Notesapp.routers for how it is used.
+"""
+
+import threading
+import time
+import uuid
+from django.conf import settings
+from django.core.cache import cache
 from django.db import models
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+VERSION_KEY = 'meta-data-version'
+SHARDS_VERSION_KEY = 'meta-shards-version'
 
 DEFAULT_DATA = {
     'new-users': {
@@ -16,6 +37,114 @@ DEFAULT_DATA = {
     },
 }
 
+class DataCache(object):
+    """Per-process copy of all Data rows, keyed by tag."""
+
+    def __init__(self, check_interval):
+        self.check_interval = check_interval
+        self.rows = None
+        self.version = None
+        self.checked = 0
+        self.lock = threading.Lock()
+
+    def get(self, tag):
+        """Returns row for tag, reloading if the version stamp changed.
+
+        Raises:
+            Data.DoesNotExist: if no row has the tag.
+        """
+
+        rows = self.rows
+
+        if rows is None or time.time() - self.checked >= self.check_interval:
+            rows = self.check()
+
+        try:
+            return rows[tag]
+        except KeyError:
+            raise Data.DoesNotExist('No data with tag %s.' % tag)
+
+    def check(self):
+        """Reloads rows if missing or if the version stamp changed.
+
+        Returns:
+            Dict of current rows keyed by tag.
+        """
+
+        with self.lock:
+            version = cache.get(VERSION_KEY)
+
+            if version is None:
+                version = bump_version()
+
+            if self.rows is None or version != self.version:
+                self.rows = dict((row.tag, row) for row in
+                                 Data.objects.all())
+                self.version = version
+
+            self.checked = time.time()
+
+            return self.rows
+
+
+class ShardDirectory(object):
+    """Per-process copy of all Shards rows, keyed by user id."""
+
+    def __init__(self, check_interval):
+        self.check_interval = check_interval
+        self.aliases = None
+        self.version = None
+        self.checked = 0
+        self.lock = threading.Lock()
+
+    def get(self, user_id):
+        """Returns alias user was moved to, or None if never moved."""
+
+        aliases = self.aliases
+
+        if aliases is None or \
+                time.time() - self.checked >= self.check_interval:
+            aliases = self.check()
+
+        return aliases.get(user_id)
+
+    def check(self):
+        """Reloads directory if missing or if the version stamp changed.
+
+        Returns:
+            Dict of aliases keyed by user id.
+        """
+
+        with self.lock:
+            version = cache.get(SHARDS_VERSION_KEY)
+
+            if version is None:
+                version = bump_version(SHARDS_VERSION_KEY)
+
+            if self.aliases is None or version != self.version:
+                self.aliases = dict(Shards.objects.values_list('user_id',
+                                                               'alias'))
+                self.version = version
+
+            self.checked = time.time()
+
+            return self.aliases
+
+
+def bump_version(key=VERSION_KEY):
+    """Sets a new version stamp so all processes reload cached rows.
+
+    Args:
+        key: cache key of the stamp; VERSION_KEY for Data rows,
+            SHARDS_VERSION_KEY for the shard directory.
+    """
+
+    version = uuid.uuid4().hex
+    cache.set(key, version, None)
+
+    return version
+
+
 class DataManager(models.Manager):
     """Manager for meta-data class."""
 
@@ -25,6 +154,34 @@ class DataManager(models.Manager):
         for tag in DEFAULT_DATA.keys():
             self.get_or_create(tag=tag, defaults=DEFAULT_DATA[tag])
 
+        bump_version()
+
+    def get_cached(self, tag):
+        """Returns Data row for tag from the per-process cache.
+
+        Returned objects are shared; do not modify them. Use set() to
+        change values.
+
+        Raises:
+            Data.DoesNotExist: if no row has the tag.
+        """
+
+        return data_cache.get(tag)
+
+    def set(self, tag, setting=None, data=''):
+        """Creates or updates row for tag, invalidating caches.
+
+        Returns:
+            Data object.
+        """
+
+        data_object, created = self.get_or_create(tag=tag)
+        data_object.setting = setting
+        data_object.data = data
+        data_object.save()
+
+        return data_object
+
 
 class Data(models.Model):
     """Model for meta-data. Needed for system-wide key/value pairs.
@@ -43,4 +200,66 @@ class Data(models.Model):
     objects = DataManager()
 
     def __str__(self):
-        return self.tag
\ No newline at end of file
+        return self.tag
+
+
+data_cache = DataCache(getattr(settings, 'META_DATA_CHECK_INTERVAL', 1))
+
+
+@receiver(post_save, sender=Data)
+@receiver(post_delete, sender=Data)
+def data_changed(sender, **kwargs):
+    """Invalidates Data caches in every process."""
+
+    bump_version()
+    data_cache.rows = None
+
+
+class ShardManager(models.Manager):
+    """Manager for the shard directory."""
+
+    def assign(self, user_id, alias):
+        """Records that user's rows now live on alias.
+
+        Returns:
+            Shards object.
+        """
+
+        shard_object, created = self.get_or_create(user_id=user_id,
+                                                   defaults={'alias': alias})
+
+        if not created:
+            shard_object.alias = alias
+            shard_object.save()
+
+        return shard_object
+
+
+class Shards(models.Model):
+    """Directory of users whose rows were moved off their hashed shard.
+
+    Users without a row live on the shard their id hashes to.
+    """
+
+    user_id = models.IntegerField(unique=True)
+    alias = models.CharField(max_length=30)
+    created = models.DateTimeField(auto_now_add=True)
+    modified = models.DateTimeField(auto_now=True, auto_now_add=True)
+
+    objects = ShardManager()
+
+    def __str__(self):
+        return '%d: %s' % (self.user_id, self.alias)
+
+
+shard_directory = ShardDirectory(getattr(settings,
+                                         'META_DATA_CHECK_INTERVAL', 1))
+
+
+@receiver(post_save, sender=Shards)
+@receiver(post_delete, sender=Shards)
+def shards_changed(sender, **kwargs):
+    """Invalidates shard directory caches in every process."""
+
+    bump_version(SHARDS_VERSION_KEY)
+    shard_directory.aliases = None
\ No newline at end of file
@@ -0,0 +1 @@
+"""Outbox app for project. Queues and delivers outgoing email."""
\ No newline at end of file
@@ -0,0 +1,248 @@
+"""Pooled SMTP email backend.
+
+Opening an SMTP connection costs a TCP handshake, EHLO, STARTTLS and
+AUTH. PooledEmailBackend keeps authenticated connections from the
+project's smtplib open between messages, so those costs are paid once
+per connection rather than once per message. Connections are reset
+with RSET when checked out, and MAIL and RCPT are pipelined by
+smtplib when the server supports it. Messages are streamed to the
+server, so large attachments are never copied into one string.
+
+Pool behaviour is defined in settings:
+    EMAIL_POOL_SIZE: idle connections kept per process.
+    EMAIL_POOL_IDLE_TIME: seconds an idle connection is kept open.
+"""
+
+from collections import deque
+import threading
+import time
+import logging
+import smtplib
+from django.conf import settings
+from django.core.mail.backends.base import BaseEmailBackend
+from django.core.mail.message import sanitize_address
+from django.core.mail.utils import DNS_NAME
+
+from Notesapp import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class SMTPPool(object):
+    """Per-process pool of authenticated SMTP connections.
+
+    Attributes:
+        opened: number of connections opened.
+        reused: number of checkouts served by an idle connection.
+    """
+
+    def __init__(self, host, port, username, password, use_tls, size,
+                 idle_time):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.use_tls = use_tls
+        self.size = size
+        self.idle_time = idle_time
+        self.idle = deque()
+        self.lock = threading.Lock()
+        self.opened = 0
+        self.reused = 0
+
+    def connect(self):
+        """Opens and authenticates a new connection."""
+
+        connection = smtplib.SMTP(self.host, self.port,
+                                  local_hostname=DNS_NAME.get_fqdn())
+
+        if self.use_tls:
+            connection.ehlo()
+            connection.starttls()
+            connection.ehlo()
+
+        if self.username and self.password:
+            connection.login(self.username, self.password)
+
+        self.opened += 1
+
+        return connection
+
+    def checkout(self):
+        """Returns an idle connection reset with RSET, or a new one."""
+
+        while True:
+            with self.lock:
+                if not self.idle:
+                    break
+
+                connection, returned = self.idle.pop()
+
+            if time.time() - returned > self.idle_time:
+                self.discard(connection)
+                continue
+
+            try:
+                code, message = connection.rset()
+            except smtplib.SMTPException:
+                code = None
+
+            if code == 250:
+                self.reused += 1
+                return connection
+
+            self.discard(connection)
+
+        return self.connect()
+
+    def checkin(self, connection):
+        """Returns connection to the pool, or closes it if pool is full."""
+
+        with self.lock:
+            if len(self.idle) < self.size:
+                self.idle.append((connection, time.time()))
+                return
+
+        self.discard(connection)
+
+    def discard(self, connection):
+        """Closes connection without returning it to the pool."""
+
+        try:
+            connection.quit()
+        except Exception:
+            connection.close()
+
+
+pools = dict()
+pools_lock = threading.Lock()
+
+
+def get_pool(host, port, username, password, use_tls):
+    """Returns shared pool for the given server and credentials."""
+
+    key = (host, port, username, password, use_tls)
+
+    with pools_lock:
+        if key not in pools:
+            pools[key] = SMTPPool(host, port, username, password, use_tls,
+                getattr(settings, 'EMAIL_POOL_SIZE', 4),
+                getattr(settings, 'EMAIL_POOL_IDLE_TIME', 60))
+
+        return pools[key]
+
+
+class PooledEmailBackend(BaseEmailBackend):
+    """Email backend that borrows connections from an SMTPPool."""
+
+    def __init__(self, host=None, port=None, username=None, password=None,
+                 use_tls=None, fail_silently=False, **kwargs):
+        super(PooledEmailBackend, self).__init__(fail_silently=fail_silently)
+
+        self.pool = get_pool(host or settings.EMAIL_HOST,
+            port or settings.EMAIL_PORT,
+            settings.EMAIL_HOST_USER if username is None else username,
+            settings.EMAIL_HOST_PASSWORD if password is None else password,
+            settings.EMAIL_USE_TLS if use_tls is None else use_tls)
+        self.connection = None
+        self.lock = threading.RLock()
+
+    def open(self):
+        """Borrows a connection from the pool.
+
+        Returns:
+            True if a connection was borrowed, false if one was held.
+        """
+
+        if self.connection:
+            return False
+
+        try:
+            self.connection = self.pool.checkout()
+        except Exception:
+            if not self.fail_silently:
+                raise
+            return False
+
+        return True
+
+    def close(self):
+        """Returns borrowed connection to the pool."""
+
+        if self.connection is None:
+            return
+
+        self.pool.checkin(self.connection)
+        self.connection = None
+
+    def send_messages(self, email_messages):
+        """Sends messages over a pooled connection.
+
+        Returns:
+            Number of messages sent.
+        """
+
+        if not email_messages:
+            return 0
+
+        with metrics.timed('mail'):
+            return self._send_messages(email_messages)
+
+    def _send_messages(self, email_messages):
+        """Sends messages while holding the backend lock."""
+
+        with self.lock:
+            new_connection = self.open()
+
+            if not self.connection:
+                return 0
+
+            sent = 0
+
+            try:
+                for message in email_messages:
+                    # Previous message may have broken the connection
+                    if self.connection is None:
+                        new_connection = self.open() or new_connection
+
+                        if not self.connection:
+                            break
+
+                    if self._send(message):
+                        sent += 1
+            finally:
+                if new_connection:
+                    self.close()
+
+        return sent
+
+    def _send(self, email_message):
+        """Sends one message. Discards connection if it breaks."""
+
+        recipients = email_message.recipients()
+
+        if not recipients:
+            return False
+
+        encoding = email_message.encoding or settings.DEFAULT_CHARSET
+        from_email = sanitize_address(email_message.from_email, encoding)
+        recipients = [sanitize_address(address, encoding)
+                      for address in recipients]
+        message = email_message.message()
+
+        # Message is streamed by smtplib; never flattened to one string
+        try:
+            self.connection.sendmail(from_email, recipients, message)
+        except smtplib.SMTPServerDisconnected:
+            self.pool.discard(self.connection)
+            self.connection = None
+
+            if not self.fail_silently:
+                raise
+            return False
+        except smtplib.SMTPException:
+            if not self.fail_silently:
+                raise
+            return False
+
+        return True
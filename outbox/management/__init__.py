@@ -0,0 +1 @@
+"""Management commands for outbox."""
\ No newline at end of file
@@ -0,0 +1,228 @@
+"""Benchmarks the email path against a local SMTP sink."""
+
+from optparse import make_option
+import time
+import smtplib
+from django.core.management.base import BaseCommand
+from django.db import router, transaction
+from django.test.utils import override_settings
+
+from authentication.helpers import random_string
+from authentication.models import Users
+from errors.exceptions import UserError
+from outbox.models import Messages
+from outbox.sink import SMTPSink
+
+BENCH_PASSWORD = 'Benchmark-Password-1'
+
+
+class Rollback(Exception):
+    """Raised to roll back benchmark database writes."""
+
+
+def percentile(timings, fraction):
+    """Returns value at given fraction of sorted timings."""
+
+    ordered = sorted(timings)
+    index = min(int(len(ordered) * fraction), len(ordered) - 1)
+
+    return ordered[index]
+
+
+class Command(BaseCommand):
+    """Measures email throughput and latency with no network use.
+
+    Starts an SMTPSink on the loopback interface and reports messages
+    per second and p50/p99 latency for:
+        connect: opening a connection and sending EHLO.
+        smtplib-fresh: one message per new smtplib.SMTP connection.
+        smtplib-reused: messages sent over one open connection.
+        create/recover: UserManager.create and Users.recover calls,
+            followed by draining the messages they queued.
+
+    Only messages to the benchmark's own users are delivered, so mail
+    queued for real users is left alone. Users and messages created are
+    rolled back at the end.
+    """
+
+    help = 'Benchmarks email delivery against a local SMTP sink.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--messages', type='int', dest='messages', default=200,
+                    help='Messages sent per smtplib scenario.'),
+        make_option('--users', type='int', dest='users', default=20,
+                    help='Users created for the create/recover scenarios.'),
+        make_option('--delay', type='float', dest='delay', default=0,
+                    help='Milliseconds the sink waits before each reply.'),
+        make_option('--skip-models', action='store_true', dest='skip_models',
+                    default=False, help='Only benchmark smtplib.'),
+    )
+
+    def handle(self, *args, **options):
+        sink = SMTPSink(delay=options['delay'] / 1000.0)
+        sink.start()
+
+        try:
+            self.bench_smtplib(sink, options['messages'])
+
+            if not options['skip_models']:
+                self.bench_models(sink, options['users'])
+        finally:
+            sink.stop()
+
+        self.stdout.write('sink accepted %d messages, %d bytes' %
+                          (sink.messages, sink.bytes))
+
+    def report(self, name, timings, elapsed=None):
+        """Writes rate and latency percentiles for a scenario."""
+
+        if not timings:
+            self.stdout.write('%-16s no samples' % name)
+            return
+
+        elapsed = elapsed or sum(timings)
+
+        self.stdout.write('%-16s %5d in %7.3fs %9.1f/s  p50 %7.2fms  '
+                          'p99 %7.2fms' % (name, len(timings), elapsed,
+                          len(timings) / elapsed,
+                          percentile(timings, 0.5) * 1000,
+                          percentile(timings, 0.99) * 1000))
+
+    def bench_smtplib(self, sink, count):
+        """Benchmarks the vendored smtplib directly."""
+
+        message = 'Subject: Benchmark\r\n\r\n' + 'Benchmark body.\r\n' * 20
+
+        timings = []
+
+        for i in range(count):
+            start = time.time()
+            connection = smtplib.SMTP('127.0.0.1', sink.port,
+                                      local_hostname='localhost')
+            connection.ehlo()
+            timings.append(time.time() - start)
+            connection.quit()
+
+        self.report('connect', timings)
+
+        timings = []
+
+        for i in range(count):
+            start = time.time()
+            connection = smtplib.SMTP('127.0.0.1', sink.port,
+                                      local_hostname='localhost')
+            connection.sendmail('bench@localhost', ['user@localhost'],
+                                message)
+            connection.quit()
+            timings.append(time.time() - start)
+
+        self.report('smtplib-fresh', timings)
+
+        timings = []
+        connection = smtplib.SMTP('127.0.0.1', sink.port,
+                                  local_hostname='localhost')
+
+        for i in range(count):
+            start = time.time()
+            connection.rset()
+            connection.sendmail('bench@localhost', ['user@localhost'],
+                                message)
+            timings.append(time.time() - start)
+
+        connection.quit()
+
+        self.report('smtplib-reused', timings)
+
+    def bench_models(self, sink, count):
+        """Benchmarks create and recover plus outbox delivery.
+
+        All writes are made in transactions that are rolled back.
+        """
+
+        aliases = set([router.db_for_write(Users),
+                       router.db_for_write(Messages)])
+
+        with override_settings(EMAIL_HOST='127.0.0.1', EMAIL_PORT=sink.port,
+                               EMAIL_HOST_USER='bench@localhost',
+                               EMAIL_HOST_PASSWORD='', EMAIL_USE_TLS=False):
+            try:
+                with AtomicAll(aliases):
+                    self.run_models(count)
+                    raise Rollback()
+            except Rollback:
+                pass
+
+    def run_models(self, count):
+        """Creates and recovers users, draining the outbox after each."""
+
+        prefix = 'bench_' + random_string(size=8)
+        users = []
+        timings = []
+
+        for i in range(count):
+            username = '%s_%d' % (prefix, i)
+
+            start = time.time()
+            try:
+                users.append(Users.users.create(username=username,
+                    email='%s@localhost' % username,
+                    password=BENCH_PASSWORD))
+            except UserError as error:
+                self.stderr.write('create failed: %s' % (error,))
+                return
+            timings.append(time.time() - start)
+
+        # Benchmark users are the only recipients starting with prefix
+        queued = Messages.objects.filter(recipients__startswith=prefix)
+
+        self.report('create', timings)
+        self.drain('create-drain', queued)
+
+        timings = []
+
+        for user_object in users:
+            start = time.time()
+            user_object.recover()
+            timings.append(time.time() - start)
+
+        self.report('recover', timings)
+        self.drain('recover-drain', queued)
+
+    def drain(self, name, queued):
+        """Delivers queued messages until none are due, reporting rate.
+
+        Args:
+            name: scenario name to report.
+            queued: queryset of the messages this run queued.
+        """
+
+        start = time.time()
+        delivered = 0
+
+        while True:
+            sent, failed = Messages.objects.deliver(100, queued)
+
+            if not sent and not failed:
+                break
+
+            delivered += sent + failed
+
+        elapsed = time.time() - start
+
+        self.stdout.write('%-16s %5d in %7.3fs %9.1f/s' % (name, delivered,
+                          elapsed, delivered / max(elapsed, 0.001)))
+
+
+class AtomicAll(object):
+    """Context manager opening transaction.atomic on several aliases."""
+
+    def __init__(self, aliases):
+        self.blocks = [transaction.atomic(using=alias) for alias in aliases]
+
+    def __enter__(self):
+        for block in self.blocks:
+            block.__enter__()
+
+    def __exit__(self, *exc_info):
+        for block in reversed(self.blocks):
+            block.__exit__(*exc_info)
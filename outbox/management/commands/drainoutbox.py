@@ -0,0 +1,60 @@
+"""Delivers queued outbox messages."""
+
+from optparse import make_option
+import time
+from django.core.management.base import BaseCommand
+
+from outbox.models import Messages, STATUS_PENDING, STATUS_SENDING,\
+    STATUS_SENT, STATUS_FAILED
+
+
+class Command(BaseCommand):
+    """Drains the outbox in batches until stopped.
+
+    Prints sent and failed counts and the drain rate after every batch.
+    With --status, prints message counts by status and exits.
+    """
+
+    help = 'Delivers queued email from the outbox.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', dest='batch_size',
+                    default=100, help='Messages delivered per batch.'),
+        make_option('--sleep', type='float', dest='sleep', default=5,
+                    help='Seconds to wait when the outbox is empty.'),
+        make_option('--once', action='store_true', dest='once',
+                    default=False, help='Drain until empty, then exit.'),
+        make_option('--status', action='store_true', dest='status',
+                    default=False, help='Print outbox counts and exit.'),
+    )
+
+    def handle(self, *args, **options):
+        if options['status']:
+            self.print_status()
+            return
+
+        while True:
+            start = time.time()
+            sent, failed = Messages.objects.deliver(options['batch_size'])
+            elapsed = time.time() - start
+
+            if sent or failed:
+                self.stdout.write('sent %d, failed %d in %.2fs '
+                                  '(%.1f msg/s)' % (sent, failed, elapsed,
+                                  (sent + failed) / max(elapsed, 0.001)))
+                continue
+
+            if options['once']:
+                return
+
+            time.sleep(options['sleep'])
+
+    def print_status(self):
+        """Prints message counts by status."""
+
+        counts = Messages.objects.status_counts()
+
+        self.stdout.write('pending: %d' % counts[STATUS_PENDING])
+        self.stdout.write('sending: %d' % counts[STATUS_SENDING])
+        self.stdout.write('sent:    %d' % counts[STATUS_SENT])
+        self.stdout.write('failed:  %d' % counts[STATUS_FAILED])
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+from south.utils import datetime_utils as datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        columns = ['status', 'next_attempt']
+
+        if db.backend_name != 'postgres':
+            # Adding index on 'Messages', fields ['status', 'next_attempt']
+            db.create_index('outbox_messages', columns)
+            return
+
+        # CREATE INDEX CONCURRENTLY cannot run inside a transaction, and
+        # the outbox may be large; built without blocking queued writes
+        db.commit_transaction()
+        db.execute('CREATE INDEX CONCURRENTLY %s ON outbox_messages (%s)' %
+                   (db.create_index_name('outbox_messages', columns),
+                    ', '.join(columns)))
+        db.start_transaction()
+
+
+    def backwards(self, orm):
+        # Removing index on 'Messages', fields ['status', 'next_attempt']
+        db.delete_index('outbox_messages', ['status', 'next_attempt'])
+
+
+    models = {
+        'outbox.messages': {
+            'Meta': {'object_name': 'Messages', 'index_together': "[['status', 'next_attempt']]"},
+            'attempts': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'body': ('django.db.models.fields.TextField', [], {}),
+            'created': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            'from_email': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last_error': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'next_attempt': ('django.db.models.fields.DateTimeField', [], {'db_index': 'True'}),
+            'recipients': ('django.db.models.fields.TextField', [], {}),
+            'sent': ('django.db.models.fields.DateTimeField', [], {'null': 'True'}),
+            'status': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'subject': ('django.db.models.fields.CharField', [], {'max_length': '255'})
+        }
+    }
+
+    complete_apps = ['outbox']
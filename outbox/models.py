@@ -0,0 +1,257 @@
+"""Durable email outbox.
+
+Requests never talk to the mail server. They queue messages here with
+Messages.objects.queue() and worker processes running the drainoutbox
+management command deliver them in batches. Failed deliveries are
+retried with exponential backoff until MAX_ATTEMPTS is reached. When
+the mail server cannot be reached at all, claimed messages are put back
+without using an attempt.
+
+Workers claim a batch by leasing it: claimed rows are marked sending
+until LEASE_TIME passes, so rows held by a crashed worker are picked up
+again once their lease expires.
+
+Sent and permanently failed messages are kept for OUTBOX_RETENTION days,
+then deleted by the sweepexpired command, as their bodies hold tokens.
+"""
+
+from django.db import models, router, transaction
+from django.core.mail import EmailMessage, get_connection
+import datetime
+import logging
+import pytz
+
+from Notesapp import metrics
+
+logger = logging.getLogger(__name__)
+
+# Static variables for clarity in database
+STATUS_PENDING = 0
+STATUS_SENDING = 1
+STATUS_SENT = 2
+STATUS_FAILED = 3
+
+# Constants for delivery
+MAX_ATTEMPTS = 8
+BACKOFF_TIME = datetime.timedelta(seconds=30) # Doubled after each failure
+LEASE_TIME = datetime.timedelta(minutes=5)
+ERROR_SIZE = 500 # Characters of delivery error kept
+
+
+class MessageManager(models.Manager):
+    """Manager for the Messages model. Queues and delivers messages."""
+
+    def queue(self, subject, body, from_email, recipients):
+        """Queues message for delivery.
+
+        Args:
+            subject: subject line.
+            body: plaintext body.
+            from_email: sender address.
+            recipients: list of recipient addresses.
+
+        Returns:
+            Message object.
+        """
+
+        with metrics.timed('mail'):
+            return self.get_queryset().create(subject=subject, body=body,
+                from_email=from_email, recipients='\n'.join(recipients),
+                next_attempt=datetime.datetime.now(pytz.utc))
+
+    def queue_many(self, messages):
+        """Queues several messages with a single insert.
+
+        Args:
+            messages: list of (subject, body, from_email, recipients)
+                tuples, as taken by queue().
+        """
+
+        now = datetime.datetime.now(pytz.utc)
+
+        with metrics.timed('mail'):
+            self.bulk_create([Messages(subject=subject, body=body,
+                from_email=from_email, recipients='\n'.join(recipients),
+                next_attempt=now) for subject, body, from_email, recipients
+                in messages])
+
+    def claim(self, batch_size, queryset=None):
+        """Leases up to batch_size messages that are due for delivery.
+
+        Args:
+            batch_size: maximum number of messages to claim.
+            queryset: optional queryset of messages to claim from;
+                defaults to all messages.
+
+        Returns:
+            List of claimed message objects.
+        """
+
+        now = datetime.datetime.now(pytz.utc)
+
+        if queryset is None:
+            queryset = self.get_queryset()
+
+        with transaction.atomic(using=router.db_for_write(Messages)):
+            claimed = list(queryset.select_for_update().filter(
+                status__in=(STATUS_PENDING, STATUS_SENDING),
+                next_attempt__lte=now).order_by('next_attempt')[:batch_size])
+
+            self.get_queryset().filter(
+                pk__in=[message.pk for message in claimed]).update(
+                status=STATUS_SENDING, next_attempt=now + LEASE_TIME)
+
+        return claimed
+
+    def deliver(self, batch_size, queryset=None):
+        """Claims and delivers a batch over a single connection.
+
+        Args:
+            batch_size: maximum number of messages to deliver.
+            queryset: optional queryset of messages to deliver from; see
+                claim().
+
+        Returns:
+            Tuple of sent and failed message counts.
+        """
+
+        claimed = self.claim(batch_size, queryset)
+        sent = 0
+        failed = 0
+
+        if not claimed:
+            return sent, failed
+
+        connection = get_connection()
+
+        try:
+            connection.open()
+        except Exception as error:
+            # Not the messages' fault, so no attempt is used up; an
+            # outage must not fail queued mail permanently
+            logger.warning('Could not connect to deliver %d messages: %s',
+                           len(claimed), error)
+            self.release(claimed, error)
+
+            return sent, len(claimed)
+
+        try:
+            for message in claimed:
+                try:
+                    connection.send_messages([message.email_message()])
+                except Exception as error:
+                    logger.warning('Delivery of message %s failed: %s',
+                                   message.pk, error)
+                    message.mark_failed(error)
+                    failed += 1
+                else:
+                    message.mark_sent()
+                    sent += 1
+        finally:
+            connection.close()
+
+        return sent, failed
+
+    def release(self, messages, error):
+        """Returns claimed messages to the queue without using an attempt.
+
+        They are due again after BACKOFF_TIME, so workers do not spin
+        while the mail server is unreachable.
+
+        Args:
+            messages: list of claimed message objects.
+            error: exception that prevented delivery.
+        """
+
+        self.get_queryset().filter(
+            pk__in=[message.pk for message in messages]).update(
+            status=STATUS_PENDING, last_error=str(error)[:ERROR_SIZE],
+            next_attempt=datetime.datetime.now(pytz.utc) + BACKOFF_TIME)
+
+    def status_counts(self):
+        """Returns dict of message counts keyed by status."""
+
+        counts = dict.fromkeys((STATUS_PENDING, STATUS_SENDING, STATUS_SENT,
+                                STATUS_FAILED), 0)
+
+        rows = self.get_queryset().values('status').annotate(
+            count=models.Count('id'))
+
+        for row in rows:
+            counts[row['status']] = row['count']
+
+        return counts
+
+
+class Messages(models.Model):
+    """Database model for queued email messages.
+
+    Fields requiring further explanation are as follows:
+        recipients: newline separated list of recipient addresses.
+        status: delivery status of the message:
+            0: pending
+            1: sending (claimed by a worker)
+            2: sent
+            3: failed permanently
+        next_attempt: when the message is next due. For messages being
+            sent, when the worker's lease expires.
+    """
+
+    objects = MessageManager()
+
+    subject = models.CharField(max_length=255)
+    body = models.TextField()
+    from_email = models.CharField(max_length=255)
+    recipients = models.TextField()
+    status = models.IntegerField(default=STATUS_PENDING)
+    attempts = models.IntegerField(default=0)
+    next_attempt = models.DateTimeField(db_index=True)
+    last_error = models.TextField(blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    sent = models.DateTimeField(null=True)
+
+    class Meta:
+        # Matches claims, and sweeps of delivered and failed messages
+        index_together = [['status', 'next_attempt']]
+
+    def recipient_list(self):
+        """Returns list of recipient addresses."""
+
+        return self.recipients.split('\n')
+
+    def email_message(self):
+        """Returns Django EmailMessage for this message."""
+
+        return EmailMessage(self.subject, self.body, self.from_email,
+                            self.recipient_list())
+
+    def mark_sent(self):
+        """Marks message as delivered."""
+
+        self.status = STATUS_SENT
+        self.attempts += 1
+        self.sent = datetime.datetime.now(pytz.utc)
+        self.save(update_fields=['status', 'attempts', 'sent'])
+
+    def mark_failed(self, error):
+        """Schedules retry with backoff, or fails message permanently.
+
+        Args:
+            error: exception raised by delivery.
+        """
+
+        self.attempts += 1
+        self.last_error = str(error)[:ERROR_SIZE]
+
+        if self.attempts >= MAX_ATTEMPTS:
+            self.status = STATUS_FAILED
+        else:
+            self.status = STATUS_PENDING
+            self.next_attempt = datetime.datetime.now(pytz.utc) + \
+                                BACKOFF_TIME * 2 ** (self.attempts - 1)
+
+        self.save(update_fields=['status', 'attempts', 'last_error',
+                                 'next_attempt'])
+
+    def __str__(self):
+        return self.subject
@@ -0,0 +1,121 @@
+"""Local SMTP stand-in server for benchmarks and development.
+
+SMTPSink accepts mail on a local port and throws it away, counting
+messages and bytes. It advertises PIPELINING, SIZE and AUTH so the
+same client code paths are exercised as against a real server, and can
+delay every reply to imitate a slow or distant server. It needs no
+network access beyond the loopback interface.
+"""
+
+import socketserver
+import threading
+import time
+
+EHLO_LINES = ('sink', 'PIPELINING', 'SIZE 52428800', 'AUTH PLAIN LOGIN',
+              '8BITMIME')
+
+
+class SinkHandler(socketserver.StreamRequestHandler):
+    """Handles one SMTP session, replying to every command."""
+
+    def reply(self, *lines):
+        """Sends reply lines, as a multiline reply if more than one."""
+
+        if self.server.delay:
+            time.sleep(self.server.delay)
+
+        output = []
+
+        for i, line in enumerate(lines):
+            separator = ' ' if i == len(lines) - 1 else '-'
+            output.append(line[:3] + separator + line[4:] + '\r\n')
+
+        self.wfile.write(''.join(output).encode('ascii'))
+
+    def read_data(self):
+        """Reads message data up to the terminating period line."""
+
+        size = 0
+
+        while True:
+            line = self.rfile.readline()
+
+            if not line or line == b'.\r\n':
+                return size
+
+            size += len(line)
+
+    def handle(self):
+        self.reply('220 sink ESMTP')
+
+        while True:
+            line = self.rfile.readline()
+
+            if not line:
+                return
+
+            command = line[:4].upper()
+
+            if command == b'EHLO':
+                self.reply(*['250 ' + each for each in EHLO_LINES])
+            elif command == b'AUTH':
+                self.reply('235 Authentication successful')
+            elif command == b'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                self.server.record(self.read_data())
+                self.reply('250 OK')
+            elif command == b'QUIT':
+                self.reply('221 Bye')
+                return
+            elif command in (b'HELO', b'MAIL', b'RCPT', b'RSET', b'NOOP'):
+                self.reply('250 OK')
+            else:
+                self.reply('502 Command not implemented')
+
+
+class SMTPSink(socketserver.ThreadingTCPServer):
+    """Threaded SMTP sink bound to a local port.
+
+    Attributes:
+        messages: number of messages accepted.
+        bytes: total size of accepted message data.
+        delay: seconds to wait before each reply.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host='127.0.0.1', port=0, delay=0):
+        socketserver.ThreadingTCPServer.__init__(self, (host, port),
+                                                 SinkHandler)
+        self.delay = delay
+        self.messages = 0
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.thread = None
+
+    @property
+    def port(self):
+        """Port the sink is listening on."""
+
+        return self.server_address[1]
+
+    def record(self, size):
+        """Counts an accepted message."""
+
+        with self.lock:
+            self.messages += 1
+            self.bytes += size
+
+    def start(self):
+        """Serves in a background thread."""
+
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """Stops serving and closes the listening socket."""
+
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,163 @@
+"""Django test module for the email outbox."""
+
+import datetime
+import io
+import pytz
+from django.conf import settings
+from django.core import mail
+from django.core.management import call_command
+from django.core.mail.backends.locmem import EmailBackend
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from outbox import models
+
+
+class FailingOpenBackend(EmailBackend):
+    """Backend whose server cannot be reached."""
+
+    def open(self):
+        raise IOError('Connection refused')
+
+
+class FailingSendBackend(EmailBackend):
+    """Backend whose server rejects every message."""
+
+    def send_messages(self, messages):
+        raise IOError('Recipient rejected')
+
+
+class OutboxTest(TestCase):
+    """Tests for claiming, delivering and retrying queued messages."""
+
+    def queue(self, subject='Subject'):
+        """Queues a message and returns it."""
+
+        return models.Messages.objects.queue(subject, 'Body',
+            'sender@example.com', ['recipient@example.com'])
+
+    def reload(self, message):
+        """Returns message as stored in the database."""
+
+        return models.Messages.objects.get(pk=message.pk)
+
+    def test_claim_leases_due_messages(self):
+        """Only due messages are claimed, and claimed ones are leased."""
+
+        due = self.queue()
+        later = self.queue()
+        later.next_attempt = datetime.datetime.now(pytz.utc) + \
+            datetime.timedelta(hours=1)
+        later.save()
+
+        claimed = models.Messages.objects.claim(10)
+
+        self.assertEqual([message.pk for message in claimed], [due.pk])
+        self.assertEqual(self.reload(due).status, models.STATUS_SENDING)
+        self.assertGreater(self.reload(due).next_attempt,
+                           datetime.datetime.now(pytz.utc))
+        self.assertEqual(models.Messages.objects.claim(10), [])
+
+    def test_claim_from_queryset(self):
+        """Claims are limited to the given queryset."""
+
+        mine = models.Messages.objects.queue('Subject', 'Body',
+            'sender@example.com', ['bench_1@localhost'])
+        other = self.queue()
+
+        claimed = models.Messages.objects.claim(10,
+            models.Messages.objects.filter(recipients__startswith='bench_'))
+
+        self.assertEqual([message.pk for message in claimed], [mine.pk])
+        self.assertEqual(self.reload(other).status, models.STATUS_PENDING)
+
+    @override_settings(
+        EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend')
+    def test_deliver_sends(self):
+        """Delivered messages are sent once and marked sent."""
+
+        message = self.queue()
+
+        self.assertEqual(models.Messages.objects.deliver(10), (1, 0))
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(self.reload(message).status, models.STATUS_SENT)
+        self.assertEqual(self.reload(message).attempts, 1)
+
+    @override_settings(EMAIL_BACKEND='outbox.tests.FailingSendBackend')
+    def test_deliver_send_failure(self):
+        """Rejected messages are scheduled for retry."""
+
+        message = self.queue()
+
+        self.assertEqual(models.Messages.objects.deliver(10), (0, 1))
+        self.assertEqual(self.reload(message).status, models.STATUS_PENDING)
+        self.assertEqual(self.reload(message).last_error,
+                         'Recipient rejected')
+
+    @override_settings(EMAIL_BACKEND='outbox.tests.FailingOpenBackend')
+    def test_deliver_connect_failure(self):
+        """A failed connection releases the batch without an attempt."""
+
+        messages = [self.queue(), self.queue()]
+
+        self.assertEqual(models.Messages.objects.deliver(10), (0, 2))
+
+        for message in messages:
+            message = self.reload(message)
+
+            self.assertEqual(message.status, models.STATUS_PENDING)
+            self.assertEqual(message.attempts, 0)
+            self.assertEqual(message.last_error, 'Connection refused')
+            self.assertGreater(message.next_attempt,
+                               datetime.datetime.now(pytz.utc))
+
+        self.assertEqual(models.Messages.objects.claim(10), [])
+
+    def test_backoff(self):
+        """Retries back off exponentially, then fail permanently."""
+
+        message = self.queue()
+        delays = []
+
+        for attempt in range(models.MAX_ATTEMPTS - 1):
+            before = datetime.datetime.now(pytz.utc)
+            message.mark_failed(IOError('Timed out'))
+            delays.append(message.next_attempt - before)
+
+            self.assertEqual(message.status, models.STATUS_PENDING)
+
+        for attempt, delay in enumerate(delays):
+            expected = models.BACKOFF_TIME * 2 ** attempt
+
+            self.assertGreaterEqual(delay, expected)
+            self.assertLess(delay, expected + datetime.timedelta(seconds=5))
+
+        message.mark_failed(IOError('Timed out'))
+
+        self.assertEqual(self.reload(message).status, models.STATUS_FAILED)
+        self.assertEqual(self.reload(message).attempts, models.MAX_ATTEMPTS)
+
+
+class OutboxSweepTest(TestCase):
+    """Tests for removing old messages with the sweepexpired command."""
+
+    multi_db = True
+
+    def test_sweep_old_messages(self):
+        """Old sent and failed messages are deleted; pending ones kept."""
+
+        old = datetime.datetime.now(pytz.utc) - datetime.timedelta(
+            days=settings.OUTBOX_RETENTION + 1)
+        messages = [models.Messages.objects.queue('Subject', 'Body',
+            'sender@example.com', ['recipient@example.com'])
+            for status in range(4)]
+
+        for status, message in enumerate(messages):
+            models.Messages.objects.filter(pk=message.pk).update(
+                status=status, next_attempt=old)
+
+        call_command('sweepexpired', sleep=0, stdout=io.StringIO())
+
+        self.assertEqual(sorted(models.Messages.objects.values_list(
+            'status', flat=True)), [models.STATUS_PENDING,
+                                    models.STATUS_SENDING])
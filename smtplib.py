@@ -172,6 +172,65 @@ def _quote_periods(bindata):
 def _fix_eols(data):
     return  re.sub(r'(?:\r\n|\n|\r(?!\n))', CRLF, data)
 
+# Bytes buffered by DataWriter before each write to the socket
+_DATA_CHUNK_SIZE = 65536
+
+class DataWriter:
+    """File-like object that streams message data to an SMTP server.
+
+    Data written is converted chunk by chunk: lone '\r' and '\n' are
+    converted to '\r\n' and lines beginning with a period are quoted
+    per RFC 821, as data() does for whole messages.  Output is
+    buffered up to _DATA_CHUNK_SIZE bytes, so memory use does not grow
+    with message size.  close() sends the terminating '.' line but
+    does not read the server's reply.
+    """
+
+    def __init__(self, smtp):
+        self.smtp = smtp
+        self.buffer = []
+        self.buffered = 0
+        self.at_line_start = True
+        self.ends_crlf = False
+        self.skip_lf = False
+
+    def write(self, data):
+        """Converts and buffers data, sending it when the buffer fills."""
+        if isinstance(data, str):
+            data = data.encode('ascii')
+        if not data:
+            return
+        # A '\r' ending the previous chunk was already sent as CRLF
+        if self.skip_lf and data[:1] == b"\n":
+            data = data[1:]
+            if not data:
+                self.skip_lf = False
+                return
+        self.skip_lf = data[-1:] == b"\r"
+        data = re.sub(br'\r\n|\n|\r', bCRLF, data)
+        data = re.sub(br'(?<=\n)\.', b'..', data)
+        if self.at_line_start and data[:1] == b".":
+            data = b"." + data
+        self.at_line_start = self.ends_crlf = data[-2:] == bCRLF
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered >= _DATA_CHUNK_SIZE:
+            self.flush()
+
+    def flush(self):
+        """Sends buffered data to the server."""
+        if self.buffer:
+            self.smtp.send(b"".join(self.buffer))
+        self.buffer = []
+        self.buffered = 0
+
+    def close(self):
+        """Sends remaining data and the end of data marker."""
+        if not self.ends_crlf:
+            self.buffer.append(bCRLF)
+        self.buffer.append(b"." + bCRLF)
+        self.flush()
+
 try:
     import ssl
 except ImportError:
@@ -483,22 +542,68 @@ class SMTP:
         """SMTP 'noop' command -- doesn't do anything :>"""
         return self.docmd("noop")
 
+    def _optionlist(self, options):
+        """Formats ESMTP options for the MAIL and RCPT commands."""
+        if options and self.does_esmtp:
+            return ' ' + ' '.join(options)
+        return ''
+
     def mail(self, sender, options=[]):
         """SMTP 'mail' command -- begins mail xfer session."""
-        optionlist = ''
-        if options and self.does_esmtp:
-            optionlist = ' ' + ' '.join(options)
-        self.putcmd("mail", "FROM:%s%s" % (quoteaddr(sender), optionlist))
+        self.putcmd("mail", "FROM:%s%s" % (quoteaddr(sender),
+                                           self._optionlist(options)))
         return self.getreply()
 
     def rcpt(self, recip, options=[]):
         """SMTP 'rcpt' command -- indicates 1 recipient for this mail."""
-        optionlist = ''
-        if options and self.does_esmtp:
-            optionlist = ' ' + ' '.join(options)
-        self.putcmd("rcpt", "TO:%s%s" % (quoteaddr(recip), optionlist))
+        self.putcmd("rcpt", "TO:%s%s" % (quoteaddr(recip),
+                                         self._optionlist(options)))
         return self.getreply()
 
+    def pipeline(self, commands):
+        """Sends several commands in one write and reads their replies.
+
+        `commands' is a list of (cmd, args) tuples.  Returns a list of
+        (code, msg) replies in the same order.  Only use this if the
+        server advertises PIPELINING (RFC 2920), and only for commands
+        that RFC 2920 allows to be pipelined, such as MAIL and RCPT.
+        """
+        lines = []
+        for cmd, args in commands:
+            if args == "":
+                lines.append('%s%s' % (cmd, CRLF))
+            else:
+                lines.append('%s %s%s' % (cmd, args, CRLF))
+        self.send(''.join(lines))
+        return [self.getreply() for each in commands]
+
+    def envelope(self, sender, recips, mail_options=[], rcpt_options=[]):
+        """Sends MAIL and a RCPT for each recipient.
+
+        The commands are pipelined into one round trip if the server
+        supports PIPELINING; otherwise they are sent one at a time.
+        Returns a tuple of the MAIL reply and a list of RCPT replies.
+        If MAIL is refused without pipelining, no RCPTs are sent and
+        the list is empty.
+        """
+        if self.does_esmtp and self.has_extn('pipelining'):
+            commands = [("mail", "FROM:%s%s" % (quoteaddr(sender),
+                         self._optionlist(mail_options)))]
+            for each in recips:
+                commands.append(("rcpt", "TO:%s%s" % (quoteaddr(each),
+                                 self._optionlist(rcpt_options))))
+            replies = self.pipeline(commands)
+            return replies[0], replies[1:]
+        mail_reply = self.mail(sender, mail_options)
+        if mail_reply[0] != 250:
+            return mail_reply, []
+        rcpt_replies = []
+        for each in recips:
+            rcpt_replies.append(self.rcpt(each, rcpt_options))
+            if rcpt_replies[-1][0] == 421:
+                break
+        return mail_reply, rcpt_replies
+
     def data(self, msg):
         """SMTP 'DATA' command -- sends message data to server.
 
@@ -528,6 +633,42 @@ class SMTP:
                 print("data:", (code, msg), file=stderr)
             return (code, msg)
 
+    def data_stream(self, source):
+        """SMTP 'DATA' command -- streams message data to server.
+
+        Like data(), but never holds the whole message in memory.
+        `source' may be an email.message.Message, which is serialized
+        straight to the connection, a binary file-like object with a
+        read() method, or an iterable of bytes chunks.  Data is
+        converted as data() converts str messages.  Raises
+        SMTPDataError if there is an unexpected reply to the DATA
+        command; returns the final reply once all data is sent.
+        """
+        self.putcmd("data")
+        (code, repl) = self.getreply()
+        if self.debuglevel > 0:
+            print("data:", (code, repl), file=stderr)
+        if code != 354:
+            raise SMTPDataError(code, repl)
+        writer = DataWriter(self)
+        if isinstance(source, email.message.Message):
+            g = email.generator.BytesGenerator(writer, mangle_from_=False)
+            g.flatten(source, linesep='\r\n')
+        elif hasattr(source, 'read'):
+            while 1:
+                chunk = source.read(_DATA_CHUNK_SIZE)
+                if not chunk:
+                    break
+                writer.write(chunk)
+        else:
+            for chunk in source:
+                writer.write(chunk)
+        writer.close()
+        (code, msg) = self.getreply()
+        if self.debuglevel > 0:
+            print("data:", (code, msg), file=stderr)
+        return (code, msg)
+
     def verify(self, address):
         """SMTP 'verify' command -- checks for address validity."""
         self.putcmd("vrfy", _addr_only(address))
@@ -701,7 +842,9 @@ class SMTP:
 
         msg may be a string containing characters in the ASCII range, or a byte
         string.  A string is encoded to bytes using the ascii codec, and lone
-        \\r and \\n characters are converted to \\r\\n characters.
+        \\r and \\n characters are converted to \\r\\n characters.  msg may
+        also be any source accepted by data_stream(), in which case it is
+        streamed to the server and no SIZE option is sent.
 
         If there has been no previous EHLO or HELO command this session, this
         method tries ESMTP EHLO first.  If the server does ESMTP, message size
@@ -750,14 +893,19 @@ class SMTP:
         esmtp_opts = []
         if isinstance(msg, str):
             msg = _fix_eols(msg).encode('ascii')
+        streamed = not isinstance(msg, (bytes, bytearray))
         if self.does_esmtp:
             # Hmmm? what's this? -ddm
             # self.esmtp_features['7bit']=""
-            if self.has_extn('size'):
+            if self.has_extn('size') and not streamed:
                 esmtp_opts.append("size=%d" % len(msg))
             for option in mail_options:
                 esmtp_opts.append(option)
-        (code, resp) = self.mail(from_addr, esmtp_opts)
+        if isinstance(to_addrs, str):
+            to_addrs = [to_addrs]
+        # MAIL and RCPTs share one round trip if the server pipelines
+        (code, resp), rcpt_replies = self.envelope(from_addr, to_addrs,
+                                                   esmtp_opts, rcpt_options)
         if code != 250:
             if code == 421:
                 self.close()
@@ -765,10 +913,7 @@ class SMTP:
                 self.rset()
             raise SMTPSenderRefused(code, resp, from_addr)
         senderrs = {}
-        if isinstance(to_addrs, str):
-            to_addrs = [to_addrs]
-        for each in to_addrs:
-            (code, resp) = self.rcpt(each, rcpt_options)
+        for each, (code, resp) in zip(to_addrs, rcpt_replies):
             if (code != 250) and (code != 251):
                 senderrs[each] = (code, resp)
             if code == 421:
@@ -778,7 +923,10 @@ class SMTP:
             # the server refused all our recipients
             self.rset()
             raise SMTPRecipientsRefused(senderrs)
-        (code, resp) = self.data(msg)
+        if streamed:
+            (code, resp) = self.data_stream(msg)
+        else:
+            (code, resp) = self.data(msg)
         if code != 250:
             if code == 421:
                 self.close()
@@ -799,8 +947,8 @@ class SMTP:
         one set of 'Resent-' headers).  Regardless of the values of from_addr and
         to_addr, any Bcc field (or Resent-Bcc field, when the Message is a
         resent) of the Message object won't be transmitted.  The Message
-        object is then serialized using email.generator.BytesGenerator and
-        sendmail is called to transmit the message.
+        object is then streamed to the server by sendmail, which serializes
+        it using email.generator.BytesGenerator.
 
         """
         # 'Resent-Date' is a mandatory field if the Message is resent (RFC 2822
@@ -835,11 +983,7 @@ class SMTP:
         msg_copy = copy.copy(msg)
         del msg_copy['Bcc']
         del msg_copy['Resent-Bcc']
-        with io.BytesIO() as bytesmsg:
-            g = email.generator.BytesGenerator(bytesmsg)
-            g.flatten(msg_copy, linesep='\r\n')
-            flatmsg = bytesmsg.getvalue()
-        return self.sendmail(from_addr, to_addrs, flatmsg, mail_options,
+        return self.sendmail(from_addr, to_addrs, msg_copy, mail_options,
                              rcpt_options)
 
     def close(self):